@@ -0,0 +1,43 @@
+# Benchmark writing info docs with many chunks
+#
+# python3 -m tests.bench_info_set
+
+import os
+import tempfile
+import timeit
+
+from worldai import db_access, elements, info_set
+
+
+def writeChunked(db, world_id, chunks):
+    # One commit per chunk
+    doc_id = info_set.InfoStore.addInfoDoc(db, world_id, "content")
+    for entry in chunks:
+        info_set.InfoStore.addInfoChunk(db, doc_id, entry)
+
+
+def writeBatched(db, world_id, chunks):
+    with info_set.InfoSetWriter(db) as writer:
+        writer.addInfoDoc(world_id, "content", chunks=chunks)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as dir_name:
+        db_access.init_config(os.path.join(dir_name, "bench.sqlite"))
+        db = db_access.open_db()
+        world = elements.createWorld(db, elements.World())
+        print("%8s %14s %14s" % ("chunks", "per chunk (ms)", "batched (ms)"))
+        for count in [10, 100, 500]:
+            chunks = ["chunk of info text %d " % index * 20 for index in range(count)]
+            number = max(1, 500 // count)
+            chunked = timeit.timeit(
+                lambda: writeChunked(db, world.getID(), chunks), number=number)
+            batched = timeit.timeit(
+                lambda: writeBatched(db, world.getID(), chunks), number=number)
+            print("%8d %14.3f %14.3f" % (count, chunked * 1000 / number,
+                                         batched * 1000 / number))
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
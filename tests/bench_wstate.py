@@ -0,0 +1,39 @@
+# Benchmark loading and saving world state
+#
+# python3 -m tests.bench_wstate
+
+import json
+import timeit
+
+from worldai import elements, world_state
+
+
+def buildState(count: int) -> world_state.WorldState:
+    wstate = world_state.WorldState("id0000")
+    for index in range(count):
+        cid = "idc%d" % index
+        wstate.setCharacterLocation(cid, "ids%d" % (index % 10))
+        wstate.setItemLocation("idi%d" % index, cid)
+        wstate.setSiteOpen("ids%d" % index, index % 2 == 0)
+        if index % 3 == 0:
+            wstate.addCharacterStatus(cid, elements.CharStatus.POISONED)
+    return wstate
+
+
+def main():
+    print("%8s %12s %12s %12s" % ("entities", "load (ms)", "validate (ms)", "save (ms)"))
+    for count in [10, 100, 1000]:
+        value = buildState(count).get_model_str()
+        wstate = world_state.WorldState("id0000")
+        number = max(1, 2000 // count)
+        load = timeit.timeit(lambda: wstate.set_model_str(value), number=number)
+        validate = timeit.timeit(
+            lambda: world_state.WorldStateModel(**json.loads(value)), number=number)
+        save = timeit.timeit(wstate.get_model_str, number=number)
+        print("%8d %12.3f %12.3f %12.3f" % (count, load * 1000 / number,
+                                            validate * 1000 / number,
+                                            save * 1000 / number))
+
+
+if __name__ == "__main__":
+    main()
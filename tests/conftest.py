@@ -48,6 +48,8 @@ def app():
 
     yield app
 
+    # Write pending usage before the database goes away
+    worldai.server.flush_at_exit()
     instance_path.cleanup()
 
 
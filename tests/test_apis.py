@@ -3,6 +3,13 @@ Test the basics of the JSON APIs
 """
 
 import json
+import os
+import shutil
+
+from flask import Response
+
+from worldai import (db_access, design_functions, elements, image_files, server,
+                    users, world_state)
 
 
 def test_no_access(client):
@@ -14,6 +21,26 @@ def bearer_token(app):
     return "Bearer " + app.config["AUTH_KEY"]
 
 
+def test_auth_token(client, app):
+    app.config["AUTH_TOKENS"] = True
+    db = db_access.open_db()
+    user_id = users.find_by_auth_key(db, app.config["AUTH_KEY"])
+    token = users.make_token(db, app.config["SECRET_KEY"], user_id, 60)
+    db.close()
+
+    response = client.get("/api/worlds", headers={"Authorization": "Bearer " + token})
+    assert response.status_code == 200
+    response = client.get("/api/worlds",
+                          headers={"Authorization": "Bearer " + token + "x"})
+    assert response.status_code == 401
+    response = client.get("/api/worlds",
+                          headers={"Authorization": "Bearer " + token + "\u00e9"})
+    assert response.status_code == 401
+    # Auth keys are still accepted
+    response = client.get("/api/worlds", headers={"Authorization": bearer_token(app)})
+    assert response.status_code == 200
+
+
 def test_world_chars(client, app):
     response = client.get("/api/worlds", headers={"Authorization": bearer_token(app)})
     assert response.status_code == 200
@@ -363,6 +390,199 @@ def test_command(client, app):
     assert response.status_code == 200
 
 
+def test_commands(client, app):
+    # /api/world/<wid>/commands
+    response = client.get("/api/worlds", headers={"Authorization": bearer_token(app)})
+    world_id = response.json[0]["id"]
+    response = client.get(
+        f"/api/worlds/{world_id}/sites", headers={"Authorization": bearer_token(app)}
+    )
+    site_ids = [entry["id"] for entry in response.json]
+    assert len(site_ids) > 1
+
+    response = client.post(
+        f"/api/worlds/{world_id}/commands",
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": bearer_token(app),
+        },
+        json={"commands": [{"name": "go", "to": site_ids[0]},
+                           {"name": "disengage"}]},
+    )
+    assert response.status_code == 200
+    assert response.json["failed"] == -1
+    assert len(response.json["messages"]) == 2
+    assert response.json["world_status"]["changed"]
+    assert response.json["world_status"]["location_id"] == site_ids[0]
+
+    # A failed command discards the batch
+    response = client.post(
+        f"/api/worlds/{world_id}/commands",
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": bearer_token(app),
+        },
+        json={"commands": [{"name": "go", "to": site_ids[1]},
+                           {"name": "take", "item": "id000"}]},
+    )
+    assert response.status_code == 200
+    assert response.json["failed"] == 1
+    assert response.json["call_status"]["result"] == "error"
+
+    response = client.get(
+        f"/api/worlds/{world_id}/instance",
+        headers={"Authorization": bearer_token(app)},
+    )
+    assert response.json["location_id"] == site_ids[0]
+
+
+def test_status_delta(client, app):
+    response = client.get("/api/worlds", headers={"Authorization": bearer_token(app)})
+    world_id = response.json[0]["id"]
+    response = client.get(
+        f"/api/worlds/{world_id}/sites", headers={"Authorization": bearer_token(app)}
+    )
+    site_id = response.json[0]["id"]
+
+    response = client.get(
+        f"/api/worlds/{world_id}/instance",
+        headers={"Authorization": bearer_token(app)},
+    )
+    version = response.json["version"]
+
+    response = client.post(
+        f"/api/worlds/{world_id}/command?since={version}",
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": bearer_token(app),
+        },
+        json={"name": "go", "to": site_id},
+    )
+    assert response.status_code == 200
+    assert "world_status" not in response.json
+    delta = response.json["world_status_delta"]
+    assert delta["base_version"] == version
+    assert delta["version"] > version
+    assert delta["changes"]["location_id"] == site_id
+    assert delta["inventory_added"] == []
+
+    # Nothing changed
+    version = delta["version"]
+    response = client.get(
+        f"/api/worlds/{world_id}/instance?since={version}",
+        headers={"Authorization": bearer_token(app)},
+    )
+    assert response.json["version"] == version
+    assert response.json["changes"] == {}
+    assert response.json["status_changes"] == {}
+
+    # Unknown version gets the full status
+    response = client.get(
+        f"/api/worlds/{world_id}/instance?since={version + 100}",
+        headers={"Authorization": bearer_token(app)},
+    )
+    assert response.json["location_id"] == site_id
+
+
+def test_status_unsaved_version(client, app):
+    # A version seen but never saved is not reused for other contents
+    headers = {"Authorization": bearer_token(app)}
+    world_id = client.get("/api/worlds", headers=headers).json[0]["id"]
+    sites = client.get(f"/api/worlds/{world_id}/sites", headers=headers).json
+    items = client.get(f"/api/worlds/{world_id}/items", headers=headers).json
+    characters = client.get(f"/api/worlds/{world_id}/characters", headers=headers).json
+    url = f"/api/worlds/{world_id}/command"
+
+    response = client.post(url, headers=headers, json={"name": "go", "to": sites[0]["id"]})
+    assert response.json["world_status"]["location_id"] == sites[0]["id"]
+    response = client.post(url, headers=headers,
+                           json={"name": "drop", "item": items[0]["id"],
+                                 "character": characters[0]["id"]})
+    assert response.status_code == 200
+    response = client.post(url, headers=headers, json={"name": "go", "to": sites[1]["id"]})
+    assert response.json["world_status"]["location_id"] == sites[1]["id"]
+    version = response.json["world_status"]["version"]
+    response = client.get(f"/api/worlds/{world_id}/instance", headers=headers)
+    assert response.json["version"] == version
+    assert response.json["location_id"] == sites[1]["id"]
+
+
+def test_failed_request_not_saved(app):
+    db = db_access.open_db()
+    world_id = elements.listWorlds(db)[0].getID()
+    user_id = users.find_by_auth_key(db, app.config["AUTH_KEY"])
+    wstate_id = world_state.getWorldStateID(db, user_id, world_id)
+    db.close()
+
+    for status, saved in [(500, False), (200, True)]:
+        with app.test_request_context():
+            wstate = world_state.loadWorldState(server.get_db(), wstate_id)
+            wstate.advanceTime(10)
+            world_state.saveWorldState(server.get_db(), wstate)
+            expected = wstate.getCurrentTime()
+            server.flush_world_state(Response(status=status))
+        db = db_access.open_db()
+        wstate = world_state.loadWorldState(db, wstate_id)
+        assert (wstate.getCurrentTime() == expected) == saved
+        db.close()
+
+
+def test_conditional_get(client, app):
+    headers = {"Authorization": bearer_token(app)}
+    response = client.get("/api/worlds", headers=headers)
+    assert response.status_code == 200
+    worlds = response.json
+    world_id = worlds[0]["id"]
+    worlds_etag = response.headers["ETag"]
+    response = client.get("/api/worlds", headers=headers | {"If-None-Match": worlds_etag})
+    assert response.status_code == 304
+
+    url = f"/api/worlds/{world_id}/characters"
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    response = client.get(url, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # Changed definition
+    db = db_access.open_db()
+    world = elements.loadWorld(db, world_id)
+    world.setDescription("A new description")
+    elements.updateWorld(db, world)
+    db.close()
+    response = client.get(url, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # The list of worlds changes with any world
+    response = client.get("/api/worlds", headers=headers | {"If-None-Match": worlds_etag})
+    assert response.status_code == 200
+    worlds_etag = response.headers["ETag"]
+    db = db_access.open_db()
+    elements.deleteWorld(db, app.instance_path, worlds[-1]["id"])
+    db.close()
+    response = client.get("/api/worlds", headers=headers | {"If-None-Match": worlds_etag})
+    assert response.status_code == 200
+    assert len(response.json) == len(worlds) - 1
+
+    # Instance changes with the world state
+    url = f"/api/worlds/{world_id}/instance"
+    response = client.get(url, headers=headers)
+    etag = response.headers["ETag"]
+    response = client.get(url, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 304
+    site_id = client.get(f"/api/worlds/{world_id}/sites", headers=headers).json[0]["id"]
+    client.post(f"/api/worlds/{world_id}/command", headers=headers,
+                json={"name": "go", "to": site_id})
+    response = client.get(url, headers=headers | {"If-None-Match": etag})
+    assert response.status_code == 200
+
+    # ETag is compared first, If-Modified-Since is then ignored
+    response = client.get(url, headers=headers | {
+        "If-None-Match": etag, "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+    assert response.status_code == 200
+
+
 def testLoadWorldStatus(client, app):
     response = client.get("/api/worlds", headers={"Authorization": bearer_token(app)})
     world_id = response.json[0]["id"]
@@ -460,3 +680,91 @@ def testCharacterAction(client, app):
     assert response.status_code == 200
     content = response.json
     assert content["chat_response"]["done"]
+
+
+def test_create_image_derivatives(client, app):
+    headers = {"Authorization": bearer_token(app)}
+    world_id = client.get("/api/worlds", headers=headers).json[0]["id"]
+    db = db_access.open_db()
+    world = elements.loadWorld(db, world_id)
+    before = {image.getID() for image in elements.getImages(db, world_id)}
+
+    # Default config creates the image during the request
+    functions = design_functions.DesignFunctions()
+    functions.current_view = world.getElemTag()
+    result = functions.FuncCreateImage(db, {"prompt": "a castle"})
+    assert result == {"status": "created image"}
+    images = [image for image in elements.getImages(db, world_id)
+              if image.getID() not in before]
+    db.close()
+    assert len(images) == 1
+
+    client.get("/?auth=" + app.config["AUTH_KEY"])
+    response = client.get(f"/images/{images[0].getID()}/small",
+                          headers={"Accept": "image/jpeg"})
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+
+
+def test_image_content(client, app):
+    headers = {"Authorization": bearer_token(app)}
+    db = db_access.open_db()
+    image = elements.getImage(db, "id0364d6db")
+    db.close()
+    logo = os.path.join(app.root_path, "static/logo.png")
+    shutil.copy(logo, os.path.join(app.instance_path, image.filename))
+
+    # Hash is not recorded yet
+    response = client.get(f"/api/worlds/{image.parent_id}", headers=headers)
+    assert not response.json["images"][0]["url"].startswith("/image-content/")
+
+    db = db_access.open_db()
+    image_files.recordFiles(db, app.instance_path, [image.filename])
+    db.close()
+    response = client.get(f"/api/worlds/{image.parent_id}", headers=headers)
+    url = response.json["images"][0]["url"]
+    assert url.startswith("/image-content/")
+    # Images use the session login
+    client.get("/?auth=" + app.config["AUTH_KEY"])
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.cache_control.immutable
+    assert response.cache_control.private
+    assert not response.cache_control.public
+    assert response.cache_control.max_age > 0
+    etag = response.headers["ETag"]
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.get(url, headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert len(response.data) == 10
+
+    app.config["IMAGE_ACCEL_REDIRECT"] = "/protected-images/"
+    response = client.get(url)
+    assert response.headers["X-Accel-Redirect"] == "/protected-images/" + image.filename
+    response = client.get("/image-content/" + "0" * 64 + ".png")
+    assert response.status_code == 404
+
+
+def test_image_job(client, app):
+    headers = {"Authorization": bearer_token(app)}
+    worlds = client.get("/api/worlds", headers=headers).json
+    db = db_access.open_db()
+    db.execute(
+        "INSERT INTO image_jobs (id, world_id, parent_id, prompt, request, filename, "
+        + "status, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)",
+        ("idjob1", worlds[0]["id"], worlds[0]["id"], "a castle", "a castle",
+         "castle.png", "pending"),
+    )
+    db.commit()
+    db.close()
+
+    response = client.get(f"/api/worlds/{worlds[0]['id']}/image_jobs/idjob1",
+                          headers=headers)
+    assert response.status_code == 200
+    assert response.json["status"] == "pending"
+    # Only found through the world of the job
+    response = client.get(f"/api/worlds/{worlds[1]['id']}/image_jobs/idjob1",
+                          headers=headers)
+    assert response.status_code == 404
@@ -18,6 +18,8 @@ class DesignTestCase(unittest.TestCase):
             self.db.executescript(f.read())
         self.user_dir = tempfile.TemporaryDirectory()
         self.chatFunctions = design_functions.DesignFunctions()
+        # Write token usage directly
+        chat_functions.TOKEN_USAGE = None
 
     def tearDown(self):
         self.db.close()
@@ -58,6 +60,62 @@ class DesignTestCase(unittest.TestCase):
         self.assertFalse(chat_functions.check_token_budgets(self.db))
         self.assertFalse(chat_functions.check_image_budget(self.db))
 
+    def test_token_totals(self):
+        chat_functions.track_tokens(self.db, "id1", 100, 50, 150)
+        chat_functions.count_image(self.db, "id2", 2)
+        self.assertEqual(tuple(chat_functions.get_totals(self.db)), (100, 50, 150, 2))
+
+        # Usage is held in memory until flushed
+        usage = chat_functions.TokenUsage()
+        chat_functions.TOKEN_USAGE = usage
+        try:
+            chat_functions.track_tokens(self.db, "id1", 100, 50, 150)
+            chat_functions.track_tokens(self.db, "id2", 10, 5, 15)
+            self.assertEqual(chat_functions.get_totals(self.db)[0], 100)
+            self.db.execute(
+                "INSERT INTO token_usage VALUES (?, 200, 500, 500, 5)", ("limits",)
+            )
+            self.db.commit()
+            self.assertFalse(chat_functions.check_token_budgets(self.db))
+
+            # A failed write keeps the usage for the next flush
+            bad_db = sqlite3.connect(":memory:")
+            with self.assertRaises(sqlite3.Error):
+                usage.flush(bad_db)
+            bad_db.close()
+            self.assertEqual(usage.pendingTokens(), (110, 55))
+            self.assertEqual(usage.flush(self.db), 2)
+            self.assertEqual(usage.flush(self.db), 0)
+        finally:
+            chat_functions.TOKEN_USAGE = None
+        self.assertEqual(tuple(chat_functions.get_totals(self.db)), (210, 105, 315, 2))
+        q = self.db.execute("SELECT prompt_tokens FROM token_usage WHERE world_id = ?",
+                            ("id1",))
+        self.assertEqual(q.fetchall(), [(200,)])
+
+    def testTotalsRow(self):
+        # Created from the world rows of an older database
+        self.db.executescript(
+            "DROP TABLE token_usage; CREATE TABLE token_usage (world_id STRING NOT NULL, "
+            + "prompt_tokens INTEGER NOT NULL, complete_tokens INTEGER NOT NULL, "
+            + "total_tokens INTEGER NOT NULL, images INTEGER NOT NULL DEFAULT 0);")
+        self.db.execute("INSERT INTO token_usage VALUES (?, 10, 10, 20, 1)", ("id1",))
+        self.db.execute("INSERT INTO token_usage VALUES (?, 3, 3, 6, 1)", ("id2",))
+        self.db.execute("INSERT INTO token_usage VALUES (?, 2, 2, 4, 1)", ("id2",))
+        self.db.execute("INSERT INTO token_usage VALUES (?, 500, 500, 500, 5)", ("limits",))
+        self.db.commit()
+        self.assertEqual(tuple(chat_functions.get_totals(self.db)), (0, 0, 0, 0))
+        chat_functions.migrate_token_usage(self.db)
+        q = self.db.execute("SELECT images FROM token_usage WHERE world_id = ?", ("id2",))
+        self.assertEqual(q.fetchall(), [(2,)])
+
+        # Budget checks only read
+        chat_functions.check_token_budgets(self.db)
+        self.assertFalse(self.db.in_transaction)
+        self.assertEqual(tuple(chat_functions.get_totals(self.db)), (15, 15, 30, 3))
+        chat_functions.count_image(self.db, "id1", 1)
+        self.assertEqual(tuple(chat_functions.get_totals(self.db)), (15, 15, 30, 4))
+
     def test_exec_calls_world(self):
         self.assertCallAvailable("CreateWorld")
         result = self.callFunction("CreateWorld", '{ "name": "world 2" }')
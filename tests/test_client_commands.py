@@ -4,7 +4,7 @@ Test Client Command Functions
 Integration test
 """
 
-from worldai import client_commands, db_access, elements, users, world_state
+from worldai import client, client_commands, db_access, elements, users, world_state
 
 
 class Environment:
@@ -237,3 +237,40 @@ def test_drop_item(app):
     assert world_status.response_message is not None
     assert world_status.last_event is not None
 
+
+    # Not held: no change and no event for the character
+    character_id = elements.listCharacters(env.db, env.world.getID())[0].getID()
+    world_state.writeWorldState(env.db, env.wstate)
+    command = client_commands.Command(name="drop", item=item_id, character=character_id)
+    response = client_actions.ApplyCommand(command)
+    assert not response.world_status.changed
+    assert len(env.wstate.changes) == 0
+
+
+def test_status_cache_versions():
+    # Only versions written by this process are used
+    cache = client.StatusCache()
+    wstate = world_state.WorldState("id0001")
+    wstate.advanceTime(10)
+    status = client.WorldStatus(version=wstate.getStateVersion(), current_time=10)
+    cache.put(wstate, 0, status)
+    assert cache.get(wstate.wstate_id, status.version, 0) is None
+
+    # Another process saved this version with other contents
+    cache.forget(wstate.wstate_id)
+    wstate.saved_version = status.version
+    cache.saved(wstate)
+    assert cache.get(wstate.wstate_id, status.version, 0) is None
+
+    # Saved here, including later changes
+    wstate = world_state.WorldState("id0002")
+    wstate.advanceTime(10)
+    status = client.WorldStatus(version=wstate.getStateVersion(), current_time=10)
+    cache.put(wstate, 0, status)
+    wstate.advanceTime(10)
+    wstate.saved_version = wstate.getStateVersion()
+    cache.saved(wstate)
+    cached = cache.get(wstate.wstate_id, status.version, 0)
+    assert cached is not None
+    assert cached.current_time == 10
+    assert cache.get(wstate.wstate_id, status.version, 1) is None
@@ -4,7 +4,7 @@ import sqlite3
 import tempfile
 import unittest
 
-from worldai import elements, threads, world_state
+from worldai import db_access, elements, threads, world_state
 
 
 class BasicTestCase(unittest.TestCase):
@@ -109,3 +109,141 @@ class BasicTestCase(unittest.TestCase):
         self.assertFalse(state.hasPlayerStatus(poisoned))
 
         self.assertEqual(site_id, state.getCharacterLocation(char_id))
+
+    def testCheckWorldState(self):
+        world = elements.createWorld(self.db, elements.World())
+        site = elements.Site(world.getID())
+        site.setName("site")
+        elements.createSite(self.db, site)
+        character = elements.Character(world.getID())
+        character.setName("character 1")
+        elements.createCharacter(self.db, character)
+
+        wstate_id = world_state.getWorldStateID(self.db, "1234", world.getID())
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertEqual(state.getCharacterLocation(character.getID()), site.getID())
+        version = state.model.world_version
+        self.assertEqual(version, elements.getWorldVersion(self.db, world.getID()))
+
+        # Unchanged definition is not checked again
+        self.db.execute(
+            "INSERT INTO elements (id, type, parent_id, name, properties) "
+            + "VALUES (?, ?, ?, ?, ?)",
+            (
+                "id999",
+                elements.ElementType.CHARACTER,
+                world.getID(),
+                "character 2",
+                elements.Character(world.getID()).getPropertiesStr(),
+            ),
+        )
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertEqual(state.getCharacterLocation("id999"), "")
+
+        # A changed definition is reconciled
+        elements.updateWorld(self.db, world)
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertEqual(state.getCharacterLocation("id999"), site.getID())
+        self.assertTrue(state.model.world_version > version)
+
+    def testMigrateWorldState(self):
+        wstate_id = world_state.getWorldStateID(self.db, "1234", "ida76")
+        props = json.loads(world_state.WorldState(wstate_id).get_model_str())
+        del props["schema_version"]
+        props["site_state"]["id456"] = {"locked": True}
+        self.db.execute(
+            "UPDATE world_state SET state = ? WHERE id = ?",
+            (json.dumps(props), wstate_id),
+        )
+        self.db.commit()
+        self.assertEqual(world_state.migrateWorldStates(self.db), 1)
+        self.assertEqual(world_state.migrateWorldStates(self.db), 0)
+
+        # Upgraded row is stored in the current format
+        r = self.db.execute("SELECT state FROM world_state WHERE id = ?", (wstate_id,))
+        props = json.loads(r.fetchone()[0])
+        self.assertEqual(props["schema_version"], world_state.SCHEMA_VERSION)
+        self.assertEqual(props["site_state"]["id456"], {"is_open": False})
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertFalse(state.isSiteOpen("id456"))
+        self.assertFalse(state.full_save)
+
+    def testWorldStateUnit(self):
+        path = os.path.join(self.dir_name, "../worldai/schema.sql")
+        db = sqlite3.connect("file::memory:", factory=db_access.Connection)
+        with open(path) as f:
+            db.executescript(f.read())
+        db.wstate_unit = world_state.WorldStateUnit()
+        wstate_id = world_state.getWorldStateID(db, "1234", "ida76")
+
+        # Loads share one instance
+        state = world_state.loadWorldState(db, wstate_id)
+        self.assertIs(world_state.loadWorldState(db, wstate_id), state)
+
+        # Saves are written on flush
+        state.setLocation("id789")
+        world_state.saveWorldState(db, state)
+        db.wstate_unit = world_state.WorldStateUnit()
+        self.assertEqual(world_state.loadWorldState(db, wstate_id).getLocation(), "")
+        db.wstate_unit.put(state)
+        world_state.saveWorldState(db, state)
+        db.wstate_unit.flush(db)
+        db.wstate_unit = world_state.WorldStateUnit()
+        self.assertEqual(
+            world_state.loadWorldState(db, wstate_id).getLocation(), "id789"
+        )
+
+        world_state.clearWorldState(db, wstate_id)
+        self.assertIsNone(db.wstate_unit.get(wstate_id))
+        db.close()
+
+    def testWorldStateChanges(self):
+        wstate_id = world_state.getWorldStateID(self.db, "1234", "ida76")
+        state = world_state.loadWorldState(self.db, wstate_id)
+        state.setLocation("id789")
+        state.setCharacterLocation("id123", "id789")
+        state.increaseFriendship("id123")
+        state.advanceTime(5)
+        world_state.saveWorldState(self.db, state)
+
+        # Only the changed entries are written
+        r = self.db.execute(
+            "SELECT section, key FROM world_state_changes WHERE wstate_id = ? "
+            + "ORDER BY seq",
+            (wstate_id,),
+        )
+        self.assertEqual(
+            r.fetchall(),
+            [
+                ("world", "state_version"),
+                ("char", "id0"),
+                ("char", "id123"),
+                ("player", ""),
+                ("world", "current_time"),
+            ],
+        )
+        r = self.db.execute("SELECT state FROM world_state WHERE id = ?", (wstate_id,))
+        self.assertNotIn("id789", r.fetchone()[0])
+
+        # Nothing changed, nothing written
+        world_state.saveWorldState(self.db, state)
+        r = self.db.execute("SELECT COUNT(*) FROM world_state_changes")
+        self.assertEqual(r.fetchone()[0], 5)
+
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertEqual(state.getCharacterLocation("id123"), "id789")
+        self.assertTrue(state.getFriendship("id123") > 0)
+        self.assertEqual(state.getCurrentTime(), 5)
+        self.assertEqual(state.getStateVersion(), 1)
+
+        # Log is compacted into the state
+        for count in range(world_state.CHANGE_LOG_LIMIT):
+            state.setCharacterHealth("id123", count)
+            world_state.saveWorldState(self.db, state)
+        r = self.db.execute("SELECT COUNT(*) FROM world_state_changes")
+        self.assertTrue(r.fetchone()[0] < world_state.CHANGE_LOG_LIMIT)
+        state = world_state.loadWorldState(self.db, wstate_id)
+        self.assertEqual(
+            state.getCharacterHealth("id123"), world_state.CHANGE_LOG_LIMIT - 1
+        )
+        self.assertEqual(state.getCharacterLocation("id123"), "id789")
@@ -3,7 +3,7 @@ import sqlite3
 import tempfile
 import unittest
 
-from worldai import client_commands, elements
+from worldai import client_commands, db_access, elements, image_derivatives
 
 
 class BasicTestCase(unittest.TestCase):
@@ -63,7 +63,161 @@ class BasicTestCase(unittest.TestCase):
         images = elements.getImages(self.db, parent_id)
         self.assertEqual(len(images), 1)
 
+        # Thumbnail and derivatives are removed with the image
+        other = [image.getThumbName(),
+                 image_derivatives.derivativeName(image.getFilename(), "small", "jpg")]
+        for filename in other:
+            self.createImageFile(filename)
         elements.deleteImage(self.db, self.user_dir.name, image.getID())
+        for filename in [image.getFilename()] + other:
+            self.assertFalse(os.path.exists(os.path.join(self.user_dir.name, filename)))
+
+    def testIdentityMap(self):
+        path = os.path.join(self.dir_name, "../worldai/schema.sql")
+        db = sqlite3.connect("file::memory:", factory=db_access.Connection)
+        with open(path) as f:
+            db.executescript(f.read())
+        db.element_map = elements.IdentityMap()
+
+        world = elements.World()
+        world.setName("world 1")
+        world = elements.createWorld(db, world)
+        character = elements.Character(world.getID())
+        character.setName("character 1")
+        character = elements.createCharacter(db, character)
+
+        # Repeated loads are parsed once and return copies
+        world1 = elements.loadWorld(db, world.getID())
+        world2 = elements.loadWorld(db, world.getID())
+        self.assertIsNot(world1, world2)
+        self.assertEqual(db.element_map.hits, 2)
+        world1.setName("not saved")
+        self.assertEqual(elements.loadWorld(db, world.getID()).getName(), "world 1")
+
+        # Wrong type is not found
+        self.assertIsNone(elements.loadCharacter(db, world.getID()))
+        self.assertIsNone(elements.loadSite(db, character.getID()))
+        self.assertEqual(elements.loadCharacter(db, character.getID()).getName(),
+                         "character 1")
+
+        # Image changes refresh the image list
+        self.assertFalse(elements.loadCharacter(db, character.getID()).hasImage())
+        image = elements.Image()
+        image.setPrompt("a prompt")
+        image.setParentId(character.getID())
+        image = elements.createImage(db, image)
+        self.assertTrue(elements.loadCharacter(db, character.getID()).hasImage())
+        elements.hideImage(db, image.getID())
+        self.assertFalse(elements.loadCharacter(db, character.getID()).hasImage())
+
+        # Deleting a world removes its elements
+        elements.deleteWorld(db, self.user_dir.name, world.getID())
+        self.assertIsNone(elements.loadWorld(db, world.getID()))
+        self.assertIsNone(elements.loadCharacter(db, character.getID()))
+        self.assertEqual(len(db.element_map.elements), 0)
+        db.close()
+
+    def testLoadElements(self):
+        world = elements.createWorld(self.db, elements.World())
+        names = ["character 1", "character 2", "character 3"]
+        for name in names:
+            character = elements.Character(world.getID())
+            character.setName(name)
+            elements.createCharacter(self.db, character)
+        characters = elements.loadCharacters(self.db, world.getID())
+        self.assertEqual([c.getName() for c in characters], names)
+        self.assertEqual(len(elements.loadSites(self.db, world.getID())), 0)
+        worlds = elements.loadWorlds(self.db)
+        self.assertEqual([w.getID() for w in worlds], [world.getID()])
+        self.assertEqual(worlds[0].version,
+                         elements.getWorldVersion(self.db, world.getID()))
+
+        # First visible image and count for each element
+        images = []
+        for parent_id in [world.getID(), characters[0].getID(), characters[0].getID()]:
+            image = elements.Image()
+            image.setPrompt("a prompt")
+            image.setParentId(parent_id)
+            image.getFilename()
+            images.append(elements.createImage(self.db, image))
+        elements.hideImage(self.db, images[0].getID())
+
+        summaries = elements.getImageSummaries(self.db, world.getID())
+        self.assertNotIn(world.getID(), summaries)
+        summary = summaries[characters[0].getID()]
+        self.assertEqual(summary.count, 2)
+        self.assertEqual(summary.image.getID(), images[1].getID())
+        self.assertEqual(summary.image.filename, images[1].filename)
+        self.assertIsNone(summary.thumb_hash)
+
+        # Hashes come from the same query
+        self.db.execute(
+            "INSERT INTO image_files (name, sha256, size) VALUES (?, ?, ?)",
+            (images[1].getThumbName(), "abc", 10))
+        summaries = elements.getImageSummaries(self.db, world.getID())
+        self.assertEqual(summaries[characters[0].getID()].thumb_hash, "abc")
+        found = elements.getImageHashes(self.db, [images[1].getID(), images[2].getID()])
+        self.assertIsNone(found[images[1].getID()][1])
+        self.assertEqual(found[images[2].getID()][0].filename, images[2].filename)
+        found = elements.getImageHashes(self.db, [images[1].getID()], thumb=True)
+        self.assertEqual(found[images[1].getID()][1], "abc")
+
+        characters = elements.loadCharacters(self.db, world.getID())
+        self.assertEqual(characters[0].getImages(), [images[1].getID(), images[2].getID()])
+        self.assertEqual(characters[0].getImages(),
+                         elements.loadCharacter(self.db, characters[0].getID()).getImages())
+        self.assertFalse(characters[1].hasImage())
+
+    def testElementCache(self):
+        saved = elements.ELEMENT_CACHE
+        cache = elements.ElementCache(2)
+        elements.ELEMENT_CACHE = cache
+        try:
+            world = elements.World()
+            world.setName("world 1")
+            world = elements.createWorld(self.db, world)
+            site = elements.Site(world.getID())
+            site.setName("site 1")
+            site = elements.createSite(self.db, site)
+
+            # Second load is a copy from the cache
+            site1 = elements.loadSite(self.db, site.getID())
+            site2 = elements.loadSite(self.db, site.getID())
+            self.assertEqual(cache.hits, 1)
+            self.assertIsNot(site1, site2)
+            site2.setDescription("changed")
+            self.assertEqual(elements.loadSite(self.db, site.getID()).getDescription(), "")
+
+            # Changes to the world retire cached entries
+            site2 = elements.loadSite(self.db, site.getID())
+            site2.setDescription("updated")
+            elements.updateSite(self.db, site2)
+            hits = cache.hits
+            self.assertEqual(
+                elements.loadSite(self.db, site.getID()).getDescription(), "updated"
+            )
+            self.assertEqual(cache.hits, hits)
+
+            # As do changes made by another process
+            elements.loadWorld(self.db, world.getID())
+            self.db.execute(
+                "UPDATE world_version SET version = version + 1 WHERE world_id = ?",
+                (world.getID(),),
+            )
+            hits = cache.hits
+            elements.loadWorld(self.db, world.getID())
+            self.assertEqual(cache.hits, hits)
+
+            # Least recently used entries are dropped
+            item = elements.Item(world.getID())
+            item.setName("item 1")
+            item = elements.createItem(self.db, item)
+            elements.loadItem(self.db, item.getID())
+            elements.loadSite(self.db, site.getID())
+            self.assertNotIn(world.getID(), cache.entries)
+            self.assertEqual(len(cache.entries), 2)
+        finally:
+            elements.ELEMENT_CACHE = saved
 
     def testBasic(self):
         self.assertEqual(elements.ElementTypes.WorldType(), "World")
@@ -397,6 +551,59 @@ class BasicTestCase(unittest.TestCase):
         world = elements.loadWorld(self.db, world.getID())
         self.assertEqual(len(world.endConditions()), 2)
 
+    def testStartConditionIndex(self):
+        props = []
+        props.extend(
+            elements.Condition.makeProps(
+                elements.ConditionVerb.AT, "idc1", elements.ELEM_ID_NONE, "ids1"
+            )
+        )
+        props.extend(
+            elements.Condition.makeProps(
+                elements.ConditionVerb.AT, elements.ELEM_ID_NONE, "idi1", "ids2"
+            )
+        )
+        props.extend(
+            elements.Condition.makeProps(
+                elements.ConditionVerb.HAS, "idc1", "idi2", elements.ELEM_ID_NONE
+            )
+        )
+        props.append(
+            elements.Condition.characterIs("idc2", elements.CharStatus.SLEEPING)
+        )
+        props.append(
+            elements.Condition.characterIs("idc2", elements.CharStatus.POISONED)
+        )
+        props.append(elements.Condition.characterAt("idc1", "ids3"))
+
+        index = elements.StartConditionIndex(props)
+        for cid in ["idc1", "idc2", "idc3"]:
+            self.assertEqual(
+                index.getCharStartSite(cid),
+                elements.Condition.getCharStartSite(props, cid),
+            )
+            for status in elements.CharStatus:
+                self.assertEqual(
+                    index.isCharStatus(cid, status),
+                    elements.Condition.isCharStatus(props, cid, status),
+                )
+        for iid in ["idi1", "idi2", "idi3"]:
+            self.assertEqual(
+                index.getItemStartPlace(iid),
+                elements.Condition.getItemStartPlace(props, iid),
+            )
+
+        # Shared for a loaded world until it changes
+        world = elements.World()
+        world.setName("world")
+        world.startConditions().extend(props)
+        world = elements.createWorld(self.db, world)
+        world = elements.loadWorld(self.db, world.getID())
+        index = elements.StartConditionIndex.forWorld(world)
+        self.assertIs(elements.StartConditionIndex.forWorld(world), index)
+        elements.updateWorld(self.db, world)
+        self.assertIsNot(elements.StartConditionIndex.forWorld(world), index)
+
 
 
 if __name__ == "__main__":
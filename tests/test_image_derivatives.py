@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from worldai import image_derivatives
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        logo = os.path.join(os.path.dirname(image_derivatives.__file__), "static/logo.png")
+        self.filenames = ["image1.png", "image2.png"]
+        for filename in self.filenames:
+            shutil.copy(logo, os.path.join(self.dir.name, filename))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testDerivatives(self):
+        sizes = { "small": 32, "medium": 64 }
+        count = image_derivatives.createDerivatives(
+            self.dir.name, "image1.png", sizes, ["webp", "jpg"])
+        self.assertEqual(count, 4)
+        # Existing files are kept
+        count = image_derivatives.createDerivatives(
+            self.dir.name, "image1.png", sizes, ["webp", "jpg"])
+        self.assertEqual(count, 0)
+
+        path = os.path.join(self.dir.name,
+                            image_derivatives.derivativeName("image1.png", "small", "jpg"))
+        with Image.open(path) as image:
+            self.assertTrue(max(image.size) <= 32)
+            self.assertEqual(image.format, "JPEG")
+
+        # Format chosen by what the client accepts
+        entry = image_derivatives.findDerivative(
+            self.dir.name, "image1.png", "small", ["image/webp", "*/*"])
+        self.assertEqual(entry[1], "image/webp")
+        entry = image_derivatives.findDerivative(
+            self.dir.name, "image1.png", "small", ["*/*"])
+        self.assertEqual(entry[1], "image/jpeg")
+        self.assertIsNone(image_derivatives.findDerivative(
+            self.dir.name, "image2.png", "small", ["*/*"]))
+
+    def testAllDerivatives(self):
+        count = image_derivatives.createAllDerivatives(self.dir.name, self.filenames, 2)
+        self.assertEqual(count, len(self.filenames) * len(image_derivatives.SIZES) *
+                         len(image_derivatives.FORMATS))
+        self.assertIn("jpg", image_derivatives.FORMATS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from worldai import db_access, image_files
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        db_access.init_config(os.path.join(self.dir.name, "test.sqlite"))
+        self.db = db_access.open_db()
+        logo = os.path.join(os.path.dirname(image_files.__file__), "static/logo.png")
+        shutil.copy(logo, os.path.join(self.dir.name, "image1.png"))
+        with open(logo, "rb") as f:
+            self.digest = hashlib.sha256(f.read()).hexdigest()
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def testContentName(self):
+        name = image_files.hashName(self.digest, "image1.png")
+        self.assertEqual(name, self.digest + ".png")
+        # Not recorded until the file is written
+        self.assertIsNone(image_files.findFile(self.db, name))
+        self.assertEqual(image_files.recordFiles(self.db, self.dir.name,
+                                                 ["image1.png", "missing.png"]), 1)
+        self.assertEqual(image_files.findFile(self.db, name), "image1.png")
+        self.assertIsNone(image_files.findFile(self.db, self.digest + ".jpg"))
+        self.assertIsNone(image_files.findFile(self.db, "0" * 64 + ".png"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import functools
+import hashlib
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from worldai import db_access, design_functions, elements, image_jobs
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        db_access.init_config(os.path.join(self.dir.name, "test.sqlite"))
+        self.db = db_access.open_db()
+        self.world = elements.createWorld(self.db, elements.World())
+        self.completed = []
+
+    def tearDown(self):
+        design_functions.TESTING = False
+        self.db.close()
+        self.dir.cleanup()
+
+    def newQueue(self, generate):
+        return image_jobs.ImageJobQueue(self.dir.name, generate,
+                                        lambda db, image: self.completed.append(image), 2)
+
+    def imageCount(self):
+        q = self.db.execute("SELECT images FROM token_usage WHERE world_id = ?",
+                            (self.world.getID(),))
+        return q.fetchone()[0]
+
+    def newImage(self):
+        image = elements.Image()
+        image.setPrompt("a castle")
+        image.setParentId(self.world.getID())
+        return image
+
+    def testJobs(self):
+        # Copies an existing image
+        design_functions.TESTING = True
+        queue = self.newQueue(design_functions.image_get_request)
+        jobs = [queue.submit(self.db, self.world.getID(), self.newImage(), "a castle")
+                for count in range(3)]
+        self.assertEqual(self.imageCount(), 3)
+        queue.wait(10)
+
+        for job in jobs:
+            job = image_jobs.loadJob(self.db, job.id)
+            self.assertEqual(job.status, image_jobs.JobStatus.DONE)
+            image = elements.getImage(self.db, job.image_id)
+            self.assertTrue(os.path.exists(
+                os.path.join(self.dir.name, image.getFilename())))
+        self.assertEqual(len(self.completed), 3)
+        self.assertEqual(len(elements.listImages(self.db, self.world.getID())), 3)
+        self.assertIsNone(image_jobs.loadJob(self.db, "id0"))
+
+    def testFailedJob(self):
+        def generate(prompt, dest_file):
+            raise ValueError("no images today")
+
+        queue = self.newQueue(generate)
+        job = queue.submit(self.db, self.world.getID(), self.newImage(), "a castle")
+        queue.wait(10)
+        job = image_jobs.loadJob(self.db, job.id)
+        self.assertEqual(job.status, image_jobs.JobStatus.FAILED)
+        self.assertEqual(job.error, "no images today")
+        self.assertEqual(self.imageCount(), 0)
+        self.assertEqual(len(self.completed), 0)
+        self.assertEqual(image_jobs.failInterrupted(self.db), 0)
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.src_dir = os.path.join(self.dir.name, "src")
+        os.mkdir(self.src_dir)
+        logo = os.path.join(os.path.dirname(design_functions.__file__), "static/logo.png")
+        shutil.copy(logo, os.path.join(self.src_dir, "image.png"))
+        with open(os.path.join(self.src_dir, "page.html"), "w") as f:
+            f.write("<html></html>")
+        with open(logo, "rb") as f:
+            self.checksum = hashlib.sha256(f.read()).hexdigest()
+
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler,
+                                    directory=self.src_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def testDownload(self):
+        dest_file = os.path.join(self.dir.name, "image.png")
+        result = design_functions.download_image(self.url + "image.png", dest_file)
+        self.assertEqual(result, self.checksum)
+        self.assertTrue(os.path.exists(dest_file))
+        self.assertEqual(os.stat(dest_file).st_mode & 0o777, 0o644)
+
+        # Not an image, not found. No partial files left behind.
+        dest_file = os.path.join(self.dir.name, "other.png")
+        self.assertIsNone(design_functions.download_image(self.url + "page.html", dest_file))
+        self.assertIsNone(design_functions.download_image(self.url + "none.png", dest_file))
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["image.png", "src"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -189,6 +189,32 @@ class BasicTestCase(unittest.TestCase):
         content = info_set.getInformation(self.db, self.world.getID(), embed, 2)
         self.assertTrue(len(content) > 0)
 
+    def testWriter(self):
+        chunks = ["chunk %d" % i for i in range(150)]
+        with info_set.InfoSetWriter(self.db) as writer:
+            doc_id = writer.addInfoDoc(self.world.getID(), "content", chunks=chunks)
+            doc_id2 = writer.addInfoDoc(self.world.getID(), "content 2", chunks=["a"],
+                                        embeds=[[0.1, 0.2]])
+        q = self.db.execute("SELECT COUNT(*) FROM info_chunks WHERE doc_id = ?", (doc_id,))
+        self.assertEqual(q.fetchone()[0], 150)
+        self.assertEqual(len(info_set.InfoStore.getAvailableChunks(
+            self.db, self.world.getID())), 1)
+
+        # Nothing is written when the block fails
+        with self.assertRaises(ValueError):
+            with info_set.InfoSetWriter(self.db) as writer:
+                writer.updateInfoDoc(doc_id, "new content", chunks=["x", "y"])
+                raise ValueError()
+        self.assertEqual(info_set.getInfoDoc(self.db, doc_id), "content")
+        q = self.db.execute("SELECT COUNT(*) FROM info_chunks WHERE doc_id = ?", (doc_id,))
+        self.assertEqual(q.fetchone()[0], 150)
+
+        with info_set.InfoSetWriter(self.db) as writer:
+            writer.updateInfoDoc(doc_id, "new content", chunks=["x", "y"])
+            writer.updateInfoDoc(doc_id2, "new content 2", chunks=["z"])
+        q = self.db.execute("SELECT COUNT(*) FROM info_chunks")
+        self.assertEqual(q.fetchone()[0], 3)
+
     def testChunk(self):
         result = chunk.chunk_text(TEXT, 200, 0.2)
         self.assertEqual(len(result), 1)
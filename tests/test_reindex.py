@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import unittest
+
+from worldai import elements, info_set, reindex
+
+
+def splitText(content):
+    # Stands in for token based chunking
+    return content.split(". ")
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        info_set.TEST = True
+        path = os.path.join(os.path.dirname(__file__), "../worldai/schema.sql")
+        self.db = sqlite3.connect("file::memory:")
+        with open(path) as f:
+            self.db.executescript(f.read())
+        world = elements.World()
+        world.setName("world")
+        world.setDescription("A place. With rivers. And hills")
+        self.world = elements.createWorld(self.db, world)
+        for name in ["one", "two", "three"]:
+            character = elements.Character(self.world.getID())
+            character.setName(name)
+            character.setDescription("A character. Named " + name)
+            elements.createCharacter(self.db, character)
+
+    def tearDown(self):
+        reindex.BATCH_SIZE = 32
+        self.db.close()
+
+    def chunkCount(self):
+        q = self.db.execute("SELECT COUNT(*) FROM info_chunks WHERE embedding IS NOT NULL")
+        return q.fetchone()[0]
+
+    def testReindex(self):
+        self.assertEqual(reindex.planTasks(self.db, self.world.getID()), 4)
+        # Interrupted run: first element done
+        reindex.BATCH_SIZE = 1
+        self.db.execute("UPDATE reindex_tasks SET done = TRUE WHERE element_id = ?",
+                        (self.world.getID(),))
+        self.db.commit()
+        self.assertEqual(len(reindex.pendingTasks(self.db)), 3)
+
+        checkpoints = []
+        stats = reindex.reindex(self.db, workers=2, chunker=splitText,
+                                progress=checkpoints.append)
+        self.assertEqual(stats.elements, 3)
+        self.assertEqual(len(checkpoints), 3)
+        self.assertEqual(len(reindex.pendingTasks(self.db)), 0)
+        count = self.chunkCount()
+        self.assertEqual(stats.chunks, count)
+        self.assertTrue(stats.chunkRate() > 0)
+
+        # A second run replaces the chunks of each element
+        reindex.BATCH_SIZE = 32
+        reindex.planTasks(self.db)
+        stats = reindex.reindex(self.db, workers=2, chunker=splitText)
+        self.assertEqual(stats.elements, 4)
+        self.assertEqual(self.chunkCount(), count + 3)
+        q = self.db.execute("SELECT COUNT(*) FROM element_info")
+        self.assertEqual(q.fetchone()[0], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -51,6 +51,60 @@ class BasicTestCase(unittest.TestCase):
 
 
 
+    def testAuthCache(self):
+        users.AUTH_CACHE = users.AuthCache(60)
+        users.ACCESS_LOG = users.AccessLog()
+        try:
+            key = users.add_user(self.db, "Jim")
+            user_id = users.find_by_auth_key(self.db, key)
+            self.assertEqual(users.AUTH_CACHE.get(key), user_id)
+            q = self.db.execute("SELECT accessed FROM users WHERE id = ?", (user_id,))
+            accessed = q.fetchone()[0]
+
+            # Access time is written on flush, once per user
+            users.find_by_auth_key(self.db, key)
+            q = self.db.execute("SELECT accessed FROM users WHERE id = ?", (user_id,))
+            self.assertEqual(q.fetchone()[0], accessed)
+            self.assertEqual(users.ACCESS_LOG.flush(self.db), 1)
+            q = self.db.execute("SELECT accessed FROM users WHERE id = ?", (user_id,))
+            self.assertTrue(q.fetchone()[0] > accessed)
+            self.assertEqual(users.ACCESS_LOG.flush(self.db), 0)
+
+            # A new key revokes the old one
+            new_key = users.reset_auth_key(self.db, user_id)
+            self.assertIsNone(users.find_by_auth_key(self.db, key))
+            self.assertEqual(users.find_by_auth_key(self.db, new_key), user_id)
+            self.assertIsNone(users.reset_auth_key(self.db, "1"))
+
+            # Entries expire
+            users.AUTH_CACHE.ttl = -1
+            users.AUTH_CACHE.put(key, user_id)
+            self.assertIsNone(users.AUTH_CACHE.get(key))
+        finally:
+            users.AUTH_CACHE = None
+            users.ACCESS_LOG = None
+
+    def testTokens(self):
+        key = users.add_user(self.db, "Jim")
+        user_id = users.find_by_auth_key(self.db, key)
+        token = users.make_token(self.db, "secret", user_id, 60)
+        self.assertIsNotNone(token)
+        props = users.find_by_token(self.db, "secret", token)
+        self.assertEqual(props["uid"], user_id)
+        self.assertIsNone(users.make_token(self.db, "secret", "1", 60))
+
+        # Wrong secret, altered or expired tokens fail
+        self.assertIsNone(users.read_token("other", token))
+        self.assertIsNone(users.read_token("secret", "x" + token))
+        self.assertIsNone(users.read_token("secret", "garbage"))
+        expired = users.make_token(self.db, "secret", user_id, -1)
+        self.assertIsNone(users.read_token("secret", expired))
+
+        # A new auth key invalidates the token
+        users.reset_auth_key(self.db, user_id)
+        self.assertIsNotNone(users.read_token("secret", token))
+        self.assertIsNone(users.find_by_token(self.db, "secret", token))
+
     def testAuthFind(self):
         username = "Jim"
         key1 = users.add_user(self.db, username)
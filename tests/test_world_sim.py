@@ -0,0 +1,107 @@
+import unittest
+
+import numpy as np
+
+from worldai import elements, world_sim, world_state
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.world = elements.World()
+        self.world.eid = "idw1"
+        self.sites = []
+        for index in range(3):
+            site = elements.Site(self.world.getID())
+            site.eid = "ids%d" % index
+            self.sites.append(site)
+        self.sites[2].setDefaultOpen(False)
+        self.characters = []
+        for index in range(4):
+            character = elements.Character(self.world.getID())
+            character.eid = "idc%d" % index
+            self.characters.append(character)
+        self.items = []
+        for index in range(3):
+            item = elements.Item(self.world.getID())
+            item.eid = "idi%d" % index
+            self.items.append(item)
+        self.items[2].setIsMobile(False)
+
+        starts = self.world.startConditions()
+        starts.append(elements.Condition.characterAt("idc0", "ids1"))
+        starts.append(elements.Condition.characterIs("idc1", elements.CharStatus.POISONED))
+        starts.append(elements.Condition.characterHas("idc0", "idi0"))
+
+    def newBatch(self, count):
+        return world_sim.WorldStateBatch.fromWorld(
+            self.world, self.characters, self.sites, self.items, count,
+            np.random.default_rng(1))
+
+    def testRandomStarts(self):
+        batch = self.newBatch(500)
+        open_sites = [0, 1]
+        self.assertTrue((batch.char_location[:, 1] == 1).all())
+        for cid in ["idc1", "idc2", "idc3"]:
+            locations = batch.char_location[:, batch.char_index[cid]]
+            self.assertTrue(np.isin(locations, open_sites).all())
+            self.assertEqual(set(locations), set(open_sites))
+        self.assertTrue((batch.item_location[:, 0] == batch.placeIndex("idc0")).all())
+        self.assertTrue(np.isin(batch.item_location[:, 2], open_sites).all())
+        self.assertTrue(batch.hasStatus(elements.CharStatus.POISONED)[:, 2].all())
+        # Player is not placed
+        self.assertTrue((batch.char_location[:, 0] == world_sim.NO_PLACE).all())
+
+    def testModels(self):
+        batch = self.newBatch(20)
+        models = batch.toModels()
+        self.assertEqual(len(models), 20)
+        wstate = world_state.WorldState("id0000")
+        wstate.set_model_str(models[3].model_dump_json())
+        self.assertEqual(wstate.getCharacterLocation("idc0"), "ids1")
+        self.assertTrue(wstate.hasCharacterItem("idc0", "idi0"))
+        self.assertTrue(wstate.hasCharacterStatus("idc1", elements.CharStatus.POISONED))
+        self.assertFalse(wstate.isSiteOpen("ids2"))
+
+        batch2 = world_sim.WorldStateBatch.fromModels(models)
+        self.assertEqual(batch2.toModels(), models)
+
+    def testAdvanceTime(self):
+        # Bulk status processing matches the world state
+        batch = self.newBatch(10)
+        wstates = []
+        for model in batch.toModels():
+            wstate = world_state.WorldState("id0000")
+            wstate.set_model_str(model.model_dump_json())
+            wstates.append(wstate)
+
+        for minutes in [30, 30, 61, 5, 500]:
+            batch.advanceTime(minutes)
+            for wstate in wstates:
+                wstate.advanceTime(minutes)
+            models = batch.toModels()
+            for wstate, model in zip(wstates, models):
+                self.assertEqual(wstate.get_model().char_state, model.char_state)
+
+        self.assertFalse(batch.hasStatus(elements.CharStatus.POISONED).any())
+        self.assertTrue((batch.health[:, 2] == 7).all())
+
+    def testEndConditions(self):
+        batch = self.newBatch(200)
+        self.assertFalse(batch.checkEndConditions(self.world).any())
+
+        self.world.endConditions().append(elements.Condition.characterAt("idc2", "ids0"))
+        self.world.endConditions().append(elements.Condition.characterHas("idc3", "idi1"))
+        result = batch.evalEndConditions(self.world)
+        for row, model in enumerate(batch.toModels()):
+            wstate = world_state.WorldState("id0000")
+            wstate.set_model(model)
+            self.assertEqual(result[row],
+                             world_state.evalEndConditions(wstate, self.world))
+        self.assertTrue(result.any())
+        self.assertFalse(result.all())
+        self.assertTrue((batch.checkEndConditions(self.world) == result).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
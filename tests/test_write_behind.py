@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from worldai import db_access, write_behind
+
+
+class BasicTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        db_access.init_config(os.path.join(self.dir.name, "test.sqlite"))
+        self.db = db_access.open_db()
+        self.db.execute("CREATE TABLE counts (name TEXT PRIMARY KEY, count INTEGER)")
+        self.buffer = write_behind.WriteBehind(
+            "counts",
+            "INSERT INTO counts (name, count) VALUES (?, ?) "
+            + "ON CONFLICT (name) DO UPDATE SET count = count + excluded.count",
+            lambda pending: list(pending.items()),
+            lambda old, new: old + new)
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def counts(self):
+        return dict(self.db.execute("SELECT name, count FROM counts").fetchall())
+
+    def testFlush(self):
+        self.buffer.add("a", 1)
+        self.buffer.add("a", 2)
+        self.buffer.add("b", 1)
+        self.assertEqual(self.counts(), {})
+        self.assertEqual(self.buffer.flush(self.db), 2)
+        self.assertEqual(self.buffer.flush(self.db), 0)
+        self.assertEqual(self.counts(), {"a": 3, "b": 1})
+
+    def testFailedFlush(self):
+        self.buffer.add("a", 1)
+        bad_db = sqlite3.connect(":memory:")
+        with self.assertRaises(sqlite3.Error):
+            self.buffer.flush(bad_db)
+        # Logged, not raised
+        self.buffer.tryFlush(bad_db)
+        bad_db.close()
+
+        # Kept and merged with later values
+        self.buffer.add("a", 2)
+        write_behind.flushAll([None, self.buffer])
+        self.assertEqual(self.counts(), {"a": 3})
+        self.assertEqual(len(self.buffer.pending), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 # Unit test for world state
 
+import json
 import random
 import unittest
 
@@ -37,6 +38,26 @@ class BasicTestCase(unittest.TestCase):
         for cid in self.char_ids:
             self.assertTrue(wstate.getCharacterLocation(cid) in self.site_ids)
 
+    def testSchemaVersion(self):
+        # Legacy state is validated, fixed up and saved in full
+        self.wstate.addCharacterStatus("idc1", elements.CharStatus.POISONED)
+        props = json.loads(self.wstate.get_model_str())
+        del props["schema_version"]
+        props["site_state"]["ids1"] = { "locked": True }
+        wstate = world_state.WorldState("id0001")
+        wstate.set_model_str(json.dumps(props))
+        self.assertTrue(wstate.full_save)
+        self.assertFalse(wstate.isSiteOpen("ids1"))
+        self.assertEqual(wstate.model.schema_version, world_state.SCHEMA_VERSION)
+
+        # Current state loads directly and matches the validated model
+        wstate2 = world_state.WorldState("id0001")
+        wstate2.set_model_str(wstate.get_model_str())
+        self.assertFalse(wstate2.full_save)
+        self.assertEqual(wstate2.get_model(), wstate.get_model())
+        self.assertTrue(wstate2.hasCharacterStatus("idc1", elements.CharStatus.POISONED))
+        self.assertEqual(wstate2.model.status_schedule, wstate.model.status_schedule)
+
     def testCharFunctions(self):
         # Functions for character state
 
@@ -91,6 +112,81 @@ class BasicTestCase(unittest.TestCase):
         self.wstate.addCharacterItem(cid, iid)
         self.assertTrue(self.wstate.hasCharacterItem(cid, iid))
 
+    def testLocationIndexes(self):
+        def scanItems(wstate, location):
+            return sorted(iid for iid, state in wstate.model.item_state.items()
+                          if state.location == location)
+
+        def scanChars(wstate, location):
+            return sorted(cid for cid, state in wstate.model.char_state.items()
+                          if state.location == location and cid != elements.PLAYER_ID)
+
+        def check(wstate):
+            for place in self.char_ids + self.site_ids + [elements.PLAYER_ID]:
+                self.assertEqual(wstate.getItemsAtLocation(place),
+                                 scanItems(wstate, place))
+                self.assertEqual(wstate.getCharactersAtLocation(place),
+                                 scanChars(wstate, place))
+            self.assertEqual(wstate.getItems(),
+                             scanItems(wstate, elements.PLAYER_ID))
+
+        check(self.wstate)
+        self.wstate.setLocation(self.site_ids[0])
+        self.wstate.addItem(self.item_ids[0])
+        self.wstate.addCharacterItem(self.char_ids[1], self.item_ids[1])
+        self.wstate.setItemLocation(self.item_ids[2], self.site_ids[2])
+        self.wstate.setCharacterLocation(self.char_ids[0], self.site_ids[1])
+        check(self.wstate)
+        self.wstate.dropItem(self.item_ids[0])
+        self.assertIn(self.item_ids[0], self.wstate.getItemsAtLocation(self.site_ids[0]))
+        check(self.wstate)
+
+        # Rebuilt on load
+        wstate = world_state.WorldState("id0001")
+        wstate.set_model_str(self.wstate.get_model_str())
+        check(wstate)
+        for place in self.char_ids + self.site_ids + [elements.PLAYER_ID]:
+            self.assertEqual(wstate.getItemsAtLocation(place),
+                             self.wstate.getItemsAtLocation(place))
+            self.assertEqual(wstate.getCharactersAtLocation(place),
+                             self.wstate.getCharactersAtLocation(place))
+
+    def testStatusSchedule(self):
+        cid1 = self.char_ids[0]
+        cid2 = self.char_ids[1]
+        self.wstate.addCharacterStatus(cid1, elements.CharStatus.POISONED)
+        self.wstate.addCharacterStatus(cid2, elements.CharStatus.SLEEPING)
+        self.wstate.addCharacterStatus(cid2, elements.CharStatus.BRAINWASHED)
+
+        self.wstate.advanceTime(59)
+        self.assertEqual(self.wstate.getCharacterHealth(cid1), 10)
+        self.wstate.advanceTime(1)
+        self.assertEqual(self.wstate.getCharacterHealth(cid1), 9)
+
+        # Removed status is not updated
+        self.wstate.removeCharacterStatus(cid2, elements.CharStatus.SLEEPING)
+        self.assertEqual(len(self.wstate.model.status_schedule), 2)
+
+        # Large time jump catches up and expires
+        self.wstate.advanceTime(600)
+        self.assertFalse(self.wstate.hasCharacterStatus(cid1, elements.CharStatus.POISONED))
+        self.assertEqual(self.wstate.getCharacterHealth(cid1), 7)
+        self.assertEqual(self.wstate.getCharacterEvents(cid1),
+                         ["{name} is no longer poisoned"])
+        self.assertEqual(self.wstate.getCharacterEvents(cid2), [])
+        self.assertTrue(self.wstate.hasCharacterStatus(cid2, elements.CharStatus.BRAINWASHED))
+        self.assertEqual(len(self.wstate.model.status_schedule), 0)
+
+        # Schedule is rebuilt for states saved without one
+        self.wstate.addCharacterStatus(cid2, elements.CharStatus.PARALIZED)
+        props = json.loads(self.wstate.get_model_str())
+        del props["status_schedule"]
+        wstate = world_state.WorldState("id0001")
+        wstate.set_model_str(json.dumps(props))
+        self.assertEqual(len(wstate.model.status_schedule), 1)
+        wstate.advanceTime(180)
+        self.assertFalse(wstate.hasCharacterStatus(cid2, elements.CharStatus.PARALIZED))
+
     def testSiteFunctions(self):
         site_id = self.site_ids[0]
         self.assertTrue(self.wstate.isSiteOpen(site_id))
@@ -233,3 +329,83 @@ class BasicTestCase(unittest.TestCase):
 
 
 
+
+    def testEndConditionTracker(self):
+        cid1 = self.char_ids[0]
+        sid1 = self.site_ids[0]
+        sid2 = self.site_ids[1]
+        iid1 = self.item_ids[0]
+
+        world = elements.World()
+        world.eid = "idw1"
+        world.version = 1
+        world.endConditions().append(elements.Condition.characterAt(cid1, sid1))
+        world.endConditions().append(elements.Condition.characterHas(cid1, iid1))
+        world.endConditions().append(
+            elements.Condition.characterIs(cid1, elements.CharStatus.SLEEPING))
+
+        self.wstate.setCharacterLocation(cid1, sid2)
+        self.wstate.setItemLocation(iid1, sid1)
+        self.assertFalse(self.wstate.checkEndConditions(world))
+        tracker = self.wstate.end_tracker
+        self.assertEqual(tracker.count, 0)
+
+        # Compiled once per world version
+        self.assertIs(world_state.EndConditionSet.forWorld(world), tracker.condition_set)
+        self.assertEqual(tracker.condition_set.by_entity[cid1], [0, 2])
+        self.assertEqual(tracker.condition_set.by_entity[iid1], [1])
+
+        # Changes update the count as they happen
+        self.wstate.setCharacterLocation(cid1, sid1)
+        self.wstate.addCharacterItem(cid1, iid1)
+        self.assertEqual(tracker.count, 2)
+        self.wstate.setItemLocation(iid1, sid2)
+        self.assertEqual(tracker.count, 1)
+        self.wstate.addCharacterItem(cid1, iid1)
+        self.wstate.addCharacterStatus(cid1, elements.CharStatus.SLEEPING)
+        self.assertEqual(tracker.count, 3)
+        self.assertTrue(self.wstate.checkEndConditions(world))
+        self.assertIs(self.wstate.end_tracker, tracker)
+
+    def testEndConditionsReadOnly(self):
+        # Checking conditions on entities without state changes nothing
+        world = elements.World()
+        world.eid = "idw3"
+        world.version = 1
+        world.endConditions().append(elements.Condition.characterAt("idc9", "ids1"))
+        world.endConditions().append(elements.Condition.characterHas("idc9", "idi9"))
+        world.endConditions().append(elements.Condition.itemAt("idi8", "ids1"))
+        world.endConditions().append(
+            elements.Condition.characterIs("idc8", elements.CharStatus.SLEEPING))
+
+        version = self.wstate.getStateVersion()
+        self.wstate.changes = {}
+        self.assertFalse(self.wstate.checkEndConditions(world))
+        self.assertEqual(self.wstate.changes, {})
+        self.assertEqual(self.wstate.getStateVersion(), version)
+        self.assertNotIn("idc9", self.wstate.model.char_state)
+        self.assertNotIn("idi9", self.wstate.model.item_state)
+
+    def testEndConditionBothIds(self):
+        cid1 = self.char_ids[0]
+        sid1 = self.site_ids[0]
+        sid2 = self.site_ids[1]
+        iid1 = self.item_ids[0]
+
+        # AT with a character and an item depends on either
+        world = elements.World()
+        world.eid = "idw2"
+        world.version = 1
+        world.endConditions().append(elements.ConditionProp(
+            verb=elements.ConditionVerb.AT, char_id=cid1, item_id=iid1, site_id=sid1))
+
+        self.wstate.setCharacterLocation(cid1, sid2)
+        self.assertFalse(self.wstate.checkEndConditions(world))
+        tracker = self.wstate.end_tracker
+        self.assertEqual(tracker.condition_set.by_entity[cid1], [0])
+        self.assertEqual(tracker.condition_set.by_entity[iid1], [0])
+
+        self.wstate.setCharacterLocation(cid1, sid1)
+        self.assertEqual(tracker.count, 1)
+        self.assertTrue(self.wstate.checkEndConditions(world))
+        self.assertIs(self.wstate.end_tracker, tracker)
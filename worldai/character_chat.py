@@ -138,7 +138,8 @@ class CharacterChat:
             world_state.saveWorldState(db, wstate)
 
         if len(event) > 0:
-            events.append(event)
+            # Do not add to the list held by the world state
+            events = events + [event]
 
         if len(events) > 0:
             system = "\n".join(events)
@@ -8,6 +8,8 @@ Base class for Character and Design Functions
 
 import logging
 
+from . import write_behind
+
 
 class BaseChatFunctions:
     """
@@ -72,11 +74,64 @@ class BaseChatFunctions:
         return {"status": status_string}
 
 
+# token_usage rows that are not worlds
+LIMITS_ID = "limits"
+TOTALS_ID = "totals"
+
+USAGE_UPSERT = (
+    "INSERT INTO token_usage (world_id, prompt_tokens, complete_tokens, "
+    + "total_tokens, images) VALUES (?, ?, ?, ?, ?) "
+    + "ON CONFLICT (world_id) DO UPDATE SET "
+    + "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+    + "complete_tokens = complete_tokens + excluded.complete_tokens, "
+    + "total_tokens = total_tokens + excluded.total_tokens, "
+    + "images = images + excluded.images"
+)
+
+
+def usage_rows(usage):
+    """
+    Rows for USAGE_UPSERT from usage per world, with the totals row.
+    """
+    rows = [(world_id, *values) for world_id, values in usage.items()]
+    totals = [sum(column) for column in zip(*usage.values())]
+    rows.append((TOTALS_ID, *totals))
+    return rows
+
+
+class TokenUsage(write_behind.WriteBehind):
+    """
+    Write-behind of token use.
+    Keeps running totals per world until flushed.
+    """
+
+    def __init__(self) -> None:
+        write_behind.WriteBehind.__init__(
+            self, "token usage", USAGE_UPSERT, usage_rows,
+            lambda old, new: [a + b for a, b in zip(old, new)])
+
+    def record(self, world_id, prompt_tokens: int, complete_tokens: int,
+               total_tokens: int) -> None:
+        self.add(world_id, [prompt_tokens, complete_tokens, total_tokens, 0])
+
+    def pendingTokens(self) -> tuple[int, int]:
+        """
+        Return the prompt and complete tokens not yet written.
+        """
+        with self.lock:
+            return (sum(usage[0] for usage in self.pending.values()),
+                    sum(usage[1] for usage in self.pending.values()))
+
+
+# Set to defer token usage writes. Flushed by the owner.
+TOKEN_USAGE: TokenUsage | None = None
+
+
 def get_budgets(db):
     c = db.execute(
         "SELECT prompt_tokens, complete_tokens, "
         + " images FROM token_usage WHERE world_id = ?",
-        ("limits",),
+        (LIMITS_ID,),
     )
     r = c.fetchone()
     if r is None:
@@ -85,14 +140,69 @@ def get_budgets(db):
     return {"prompt_tokens": prompt, "complete_tokens": complete, "images": images}
 
 
-def check_token_budgets(db):
-    budgets = get_budgets(db)
+# Upgrade token_usage of an older database: merge duplicate rows for a
+# world, add the index used by upserts and create the totals row.
+TOKEN_USAGE_MIGRATION = """
+CREATE TEMP TABLE IF NOT EXISTS token_usage_merge AS
+  SELECT world_id, MIN(rowid) AS keep, SUM(prompt_tokens) AS prompt_tokens,
+    SUM(complete_tokens) AS complete_tokens, SUM(total_tokens) AS total_tokens,
+    SUM(images) AS images
+  FROM token_usage GROUP BY world_id HAVING COUNT(*) > 1;
+UPDATE token_usage SET
+  prompt_tokens = (SELECT m.prompt_tokens FROM token_usage_merge m WHERE m.keep = token_usage.rowid),
+  complete_tokens = (SELECT m.complete_tokens FROM token_usage_merge m WHERE m.keep = token_usage.rowid),
+  total_tokens = (SELECT m.total_tokens FROM token_usage_merge m WHERE m.keep = token_usage.rowid),
+  images = (SELECT m.images FROM token_usage_merge m WHERE m.keep = token_usage.rowid)
+  WHERE rowid IN (SELECT keep FROM token_usage_merge);
+DELETE FROM token_usage WHERE world_id IN (SELECT world_id FROM token_usage_merge)
+  AND rowid NOT IN (SELECT keep FROM token_usage_merge);
+DROP TABLE token_usage_merge;
+CREATE UNIQUE INDEX IF NOT EXISTS token_usage_world_id ON token_usage(world_id);
+INSERT OR IGNORE INTO token_usage
+  SELECT 'totals', COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(complete_tokens), 0),
+    COALESCE(SUM(total_tokens), 0), COALESCE(SUM(images), 0)
+  FROM token_usage WHERE world_id NOT IN ('limits', 'totals');
+"""
+
+
+def migrate_token_usage(db):
+    """
+    Upgrade the token_usage table of an older database.
+    """
+    db.executescript("BEGIN;" + TOKEN_USAGE_MIGRATION + "COMMIT;")
+
+
+def get_totals(db):
+    """
+    Return the usage of all worlds: prompt, complete and total tokens, images.
+    The totals row is kept by add_usage, or made by migrate_token_usage.
+    """
     q = db.execute(
-        "SELECT SUM(prompt_tokens), SUM(complete_tokens) "
-        + "FROM token_usage WHERE world_id != ?",
-        ("limits",),
+        "SELECT prompt_tokens, complete_tokens, total_tokens, images "
+        + "FROM token_usage WHERE world_id = ?",
+        (TOTALS_ID,),
     )
-    (prompt_tokens, complete_tokens) = q.fetchone()
+    r = q.fetchone()
+    if r is None:
+        return (0, 0, 0, 0)
+    return r
+
+
+def add_usage(db, usage):
+    """
+    Add usage per world: world id -> [prompt, complete, total, images].
+    Also added to the totals row. Not committed.
+    """
+    db.executemany(USAGE_UPSERT, usage_rows(usage))
+
+
+def check_token_budgets(db):
+    budgets = get_budgets(db)
+    (prompt_tokens, complete_tokens, _, _) = get_totals(db)
+    if TOKEN_USAGE is not None:
+        (pending_prompt, pending_complete) = TOKEN_USAGE.pendingTokens()
+        prompt_tokens += pending_prompt
+        complete_tokens += pending_complete
     return (
         prompt_tokens < budgets["prompt_tokens"]
         and complete_tokens < budgets["complete_tokens"]
@@ -101,45 +211,28 @@ def check_token_budgets(db):
 
 def check_image_budget(db):
     budgets = get_budgets(db)
-    q = db.execute(
-        "SELECT SUM(images) FROM token_usage WHERE world_id != ?", ("limits",)
-    )
-    (images,) = q.fetchone()
+    (_, _, _, images) = get_totals(db)
     return images < budgets["images"]
 
 
-def ensure_token_entry(db, world_id):
-    q = db.execute("SELECT COUNT(*) FROM token_usage WHERE world_id = ?", (world_id,))
-    if q.fetchone()[0] == 0:
-        db.execute("INSERT INTO token_usage VALUES (?, 0, 0, 0, 0)", (world_id,))
-
-
 def count_image(db, world_id, count):
-    ensure_token_entry(db, world_id)
-
-    db.execute(
-        "UPDATE token_usage SET images = images + ? " + "WHERE world_id = ?",
-        (count, world_id),
-    )
+    add_usage(db, {world_id: [0, 0, 0, count]})
     db.commit()
 
 
 def track_tokens(db, world_id, prompt_tokens, complete_tokens, total_tokens):
-    ensure_token_entry(db, world_id)
-
-    db.execute(
-        "UPDATE token_usage SET prompt_tokens = prompt_tokens + ?, "
-        + "complete_tokens = complete_tokens + ?, "
-        + "total_tokens = total_tokens + ? WHERE world_id = ?",
-        (prompt_tokens, complete_tokens, total_tokens, world_id),
-    )
+    if TOKEN_USAGE is not None:
+        TOKEN_USAGE.record(world_id, prompt_tokens, complete_tokens, total_tokens)
+        return
+    add_usage(db, {world_id: [prompt_tokens, complete_tokens, total_tokens, 0]})
     db.commit()
 
 
 def dump_token_usage(db):
     q = db.execute(
         "SELECT world_id, prompt_tokens, complete_tokens, "
-        + "total_tokens FROM token_usage"
+        + "total_tokens FROM token_usage WHERE world_id != ?",
+        (TOTALS_ID,),
     )
     for world_id, prompt_tokens, complete_tokens, total_tokens in q.fetchall():
         print(
@@ -148,12 +241,7 @@ def dump_token_usage(db):
         )
 
     print()
-    q = db.execute(
-        "SELECT SUM(prompt_tokens), SUM(complete_tokens), "
-        + "SUM(total_tokens) FROM token_usage WHERE world_id != ?",
-        ("limits",),
-    )
-    (prompt_tokens, complete_tokens, total_tokens) = q.fetchone()
+    (prompt_tokens, complete_tokens, total_tokens, _) = get_totals(db)
     print(
         f"total: prompt: {prompt_tokens}, complete: "
         + f"{complete_tokens}, total: {total_tokens}"
@@ -6,8 +6,10 @@ Standard structures for client communication.
 """
 
 
+import collections
 import enum
 import logging
+import threading
 import typing
 
 import pydantic
@@ -71,6 +73,123 @@ class WorldStatus(pydantic.BaseModel):
     response_message: str = ""
     last_event: str = ""
     player: PlayerData = PlayerData()
+    # Version of the world state, send as 'since' to get a delta
+    version: int = 0
+
+
+class WorldStatusDelta(pydantic.BaseModel):
+    """
+    Changes to a WorldStatus since a version the client has seen
+    """
+
+    base_version: int = 0
+    version: int = 0
+    # Always sent, describe this call
+    changed: bool = False
+    response_message: str = ""
+    last_event: str = ""
+    # Other WorldStatus fields that changed
+    changes: dict[str, typing.Any] = {}
+    # Player fields that changed
+    selected_item: typing.Optional[str] = None
+    status_changes: dict[str, typing.Any] = {}
+    inventory_added: list[ElemInfo] = []
+    inventory_removed: list[str] = []
+
+
+# Fields of WorldStatus that describe a call rather than the world state
+CALL_FIELDS = ["changed", "response_message", "last_event"]
+
+
+class StatusCache:
+    """
+    Process wide LRU cache of the WorldStatus sent for each world
+    state version. Used as the base for deltas, and to skip
+    rebuilding the status of an unchanged state.
+
+    Versions are the persisted state_version, so only statuses of
+    versions this process has read or written are cached: a version
+    discarded here may be saved with other content by another
+    process. A status built before its version is saved is held as
+    pending until saved() is called for it. Statuses are kept
+    serialized.
+    """
+
+    def __init__(self, size: int = 256) -> None:
+        self.size = size
+        # (wstate_id, version) -> (world_version, status JSON)
+        self.entries: collections.OrderedDict[
+            tuple[world_state.WorldStateID, int], tuple[int, str]
+        ] = collections.OrderedDict()
+        # wstate_id -> (version, world_version, status JSON)
+        self.pending: collections.OrderedDict[
+            world_state.WorldStateID, tuple[int, int, str]
+        ] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, wstate_id: world_state.WorldStateID, version: int,
+            world_version: int) -> WorldStatus | None:
+        """
+        Return the status for a saved state version, if it was built
+        against the same version of the world definition.
+        """
+        key = (wstate_id, version)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != world_version:
+                return None
+            self.entries.move_to_end(key)
+        return WorldStatus.model_validate_json(entry[1])
+
+    def put(self, wstate: world_state.WorldState, world_version: int,
+            status: WorldStatus) -> None:
+        status = status.model_copy()
+        for field in CALL_FIELDS:
+            setattr(status, field, WorldStatus.model_fields[field].default)
+        value = status.model_dump_json()
+        with self.lock:
+            if wstate.saved_version < status.version:
+                self.pending[wstate.wstate_id] = (status.version, world_version, value)
+                self.pending.move_to_end(wstate.wstate_id)
+                while len(self.pending) > self.size:
+                    self.pending.popitem(last=False)
+            else:
+                self.add(wstate.wstate_id, status.version, world_version, value)
+
+    def saved(self, wstate: world_state.WorldState) -> None:
+        """
+        Record that this process wrote a version of the world state.
+        A pending status of that or an earlier version is now kept.
+        """
+        with self.lock:
+            entry = self.pending.pop(wstate.wstate_id, None)
+            if entry is not None and entry[0] <= wstate.saved_version:
+                self.add(wstate.wstate_id, *entry)
+
+    def add(self, wstate_id: world_state.WorldStateID, version: int,
+            world_version: int, value: str) -> None:
+        # Called with the lock held
+        key = (wstate_id, version)
+        self.entries[key] = (world_version, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def forget(self, wstate_id: world_state.WorldStateID) -> None:
+        """
+        Drop the status of a version of a world state not yet saved.
+        """
+        with self.lock:
+            self.pending.pop(wstate_id, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.pending.clear()
+
+
+# Set to a StatusCache to support delta responses.
+STATUS_CACHE: StatusCache | None = None
 
 
 def LoadCharacterData(db, wstate, cid):
@@ -120,7 +239,11 @@ def LoadCharacterData(db, wstate, cid):
     return data
 
 
-def LoadPlayerData(db, wstate):
+def LoadPlayerData(db, wstate, known: dict[str, ElemInfo] | None = None):
+    """
+    Build the player data. Inventory entries in known are used
+    rather than loading the item.
+    """
     data = PlayerData()
     data.selected_item = wstate.getSelectedItem()
     data.status.name = "Traveler"
@@ -142,6 +265,9 @@ def LoadPlayerData(db, wstate):
     data.status.strength = wstate.getPlayerStrengthPercent()
 
     for item_id in wstate.getItems():
+        if known is not None and item_id in known:
+            data.status.inventory.append(known[item_id])
+            continue
         item = elements.loadItem(db, item_id)
         if item is None:
             logging.error("unknown item in inventory: %s", item_id)
@@ -156,9 +282,71 @@ def LoadPlayerData(db, wstate):
 
 
 def update_world_status(db, wstate: world_state.WorldState, status: WorldStatus):
+    version = wstate.getStateVersion()
+    world_version = wstate.model.world_version
+    cached = None
+    known = None
+    if STATUS_CACHE is not None:
+        cached = STATUS_CACHE.get(wstate.wstate_id, version, world_version)
+        if cached is None:
+            # Reuse the inventory of the previous version
+            previous = STATUS_CACHE.get(wstate.wstate_id, version - 1, world_version)
+            if previous is not None:
+                known = { info.id: info for info in previous.player.status.inventory }
+
+    status.version = version
+    if cached is not None:
+        status.current_time = cached.current_time
+        status.game_won = cached.game_won
+        status.location_id = cached.location_id
+        status.player_alive = cached.player_alive
+        status.engaged_character_id = cached.engaged_character_id
+        status.player = cached.player
+        return
+
     status.current_time = wstate.getCurrentTime()
     status.game_won = wstate.gameWonStatus()
     status.location_id = wstate.getLocation()
     status.player_alive = wstate.getPlayerHealth() > 0
     status.engaged_character_id = wstate.getChatCharacter()
-    status.player = LoadPlayerData(db, wstate)
+    status.player = LoadPlayerData(db, wstate, known)
+    if STATUS_CACHE is not None:
+        STATUS_CACHE.put(wstate, world_version, status)
+
+
+def get_status_delta(wstate: world_state.WorldState, since: int,
+                     status: WorldStatus) -> WorldStatusDelta | None:
+    """
+    Return the changes to status since a version sent earlier,
+    or None if that version is not known.
+    """
+    if STATUS_CACHE is None:
+        return None
+    base = STATUS_CACHE.get(wstate.wstate_id, since, wstate.model.world_version)
+    if base is None:
+        return None
+
+    delta = WorldStatusDelta(base_version=since, version=status.version,
+                             changed=status.changed,
+                             response_message=status.response_message,
+                             last_event=status.last_event)
+    for field in ["current_time", "game_won", "player_alive", "location_id",
+                  "engaged_character_id"]:
+        if getattr(status, field) != getattr(base, field):
+            delta.changes[field] = getattr(status, field)
+
+    player = status.player
+    if player.selected_item != base.player.selected_item:
+        delta.selected_item = player.selected_item
+    base_values = base.player.status.model_dump(exclude={"inventory"})
+    for field, value in player.status.model_dump(exclude={"inventory"}).items():
+        if value != base_values[field]:
+            delta.status_changes[field] = value
+
+    base_ids = { info.id for info in base.player.status.inventory }
+    ids = { info.id for info in player.status.inventory }
+    delta.inventory_added = [ info for info in player.status.inventory
+                              if info.id not in base_ids ]
+    delta.inventory_removed = [ info.id for info in base.player.status.inventory
+                                if info.id not in ids ]
+    return delta
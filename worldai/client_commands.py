@@ -53,6 +53,33 @@ class CommandResponse(pydantic.BaseModel):
     # response_message - Return message in response to command. E.G. Nothing happened.
     # changed - indicates if the state of the world was changed
     world_status: client.WorldStatus = client.WorldStatus()
+    # Sent instead of world_status when the client asks for a delta
+    world_status_delta: typing.Optional[client.WorldStatusDelta] = None
+
+
+class BatchCommand(pydantic.BaseModel):
+    """
+    Ordered list of commands applied together
+    """
+
+    commands: list[Command] = []
+
+
+class BatchCommandResponse(pydantic.BaseModel):
+    """
+    Response to a batch of client commands.
+    If a command fails, none of the batch is applied.
+    """
+
+    call_status: client.CallStatus = client.CallStatus()
+    # Index of the failed command, -1 if all succeeded
+    failed: int = -1
+    # Response message of each command applied
+    messages: list[str] = []
+    # Status after the last command
+    world_status: client.WorldStatus = client.WorldStatus()
+    # Sent instead of world_status when the client asks for a delta
+    world_status_delta: typing.Optional[client.WorldStatusDelta] = None
 
 
 class ClientActions:
@@ -67,6 +94,39 @@ class ClientActions:
         Implement a command from the client.
         Return a json result for the client
         """
+        response = self.ApplyCommand(command)
+        client.update_world_status(self.db, self.wstate, response.world_status)
+        logging.info("Client command response: %s", response.model_dump())
+        return response
+
+    def ExecCommands(self, batch: BatchCommand) -> BatchCommandResponse:
+        """
+        Implement a list of commands in order.
+        Stops at the first failed command. The caller discards the
+        world state on failure.
+        """
+        response = BatchCommandResponse()
+        changed = False
+        for index, command in enumerate(batch.commands):
+            result = self.ApplyCommand(command)
+            if result.call_status.result != client.StatusCode.OK:
+                response.call_status = result.call_status
+                response.failed = index
+                return response
+            changed = changed or result.world_status.changed
+            response.messages.append(result.world_status.response_message)
+            response.world_status.response_message = result.world_status.response_message
+            response.world_status.last_event = result.world_status.last_event
+
+        response.world_status.changed = changed
+        client.update_world_status(self.db, self.wstate, response.world_status)
+        return response
+
+    def ApplyCommand(self, command):
+        """
+        Apply a command to the world state.
+        The world status in the response is not filled in.
+        """
         response = CommandResponse()
 
         if command.name == CommandName.go:
@@ -117,7 +177,7 @@ class ClientActions:
                 response.call_status.result = client.StatusCode.ERROR
             else:
                 response.world_status = self.DropItem(item)
-            if command.character is not None:
+            if response.world_status.changed and command.character is not None:
                 if elements.loadCharacter(self.db, command.character) is not None:
                     self.wstate.addCharacterEvent(
                         command.character, 
@@ -184,9 +244,6 @@ class ClientActions:
         # Check if end conditions completed
         if  response.world_status.changed:
             response.world_status.game_won = self.wstate.checkEndConditions(self.world)
-
-        client.update_world_status(self.db, self.wstate, response.world_status)
-        logging.info("Client command response: %s", response.model_dump())
         return response
 
     def DropItem(self, item: elements.Item) -> client.WorldStatus:
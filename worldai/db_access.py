@@ -12,6 +12,13 @@ import sqlite3
 DATABASE = None
 
 
+class Connection(sqlite3.Connection):
+    """
+    sqlite3 connection that can carry state scoped to its use,
+    such as the element identity map for a request.
+    """
+
+
 def init_config(database):
     global DATABASE
     DATABASE = database
@@ -19,7 +26,7 @@ def init_config(database):
 
 
 def open_db():
-    db = sqlite3.connect(DATABASE)
+    db = sqlite3.connect(DATABASE, factory=Connection)
     # Enforce foreign keys
     db.execute("PRAGMA foreign_keys = 1;")
     return db
@@ -30,9 +37,10 @@ def check_init_db():
     if len(data_dir) > 0 and not os.path.exists(data_dir):
         os.makedirs(data_dir)
 
-    if not os.path.exists(DATABASE):
-        path = os.path.join(os.path.dirname(__file__), "schema.sql")
-        db = open_db()
-        with open(path) as f:
-            db.executescript(f.read())
-        db.close()
+    # Create tables that do not yet exist, including tables
+    # added after the database was created.
+    path = os.path.join(os.path.dirname(__file__), "schema.sql")
+    db = open_db()
+    with open(path) as f:
+        db.executescript(f.read())
+    db.close()
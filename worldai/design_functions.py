@@ -7,15 +7,18 @@ Functions called by the GPT
 """
 
 
+import hashlib
 import json
 import logging
 import os
+import tempfile
 
 import openai
 import requests
 from PIL import Image
 
-from . import chat_functions, element_info, elements
+from . import (chat_functions, element_info, elements, image_derivatives,
+               image_files, image_jobs)
 
 IMAGE_DIRECTORY = "/tmp"
 TESTING = False
@@ -1254,18 +1257,23 @@ class DesignFunctions(chat_functions.BaseChatFunctions):
             logging.info("create image error: empty parent_id")
             return self.funcError("internal error - no id")
 
+        request = "Produce a realistic visual image that captures the following: " + image.prompt
+        if image_jobs.IMAGE_JOBS is not None:
+            # Generate in the background
+            job = image_jobs.IMAGE_JOBS.submit(db, self.getCurrentWorldID(), image, request)
+            status = self.funcStatus("image requested")
+            status["image_job"] = job.id
+            return status
+
         dest_file = os.path.join(IMAGE_DIRECTORY, image.getFilename())
         logging.info("dest file: %s", dest_file)
-        result = image_get_request(
-            "Produce a realistic visual image that captures the following: " + image.prompt,
-            dest_file,
-        )
+        result = image_get_request(request, dest_file)
 
         if result:
             logging.info("file create done, create image record")
             chat_functions.count_image(db, self.getCurrentWorldID(), 1)
             image = elements.createImage(db, image)
-            create_image_thumbnail(image)
+            complete_image(db, image)
             self.modified = True
             status = self.funcStatus("created image")
             return status
@@ -1377,15 +1385,80 @@ def create_image_thumbnail(image_element):
     image.save(out_file)
 
 
+def complete_image(db, image: elements.Image) -> None:
+    """
+    Create the thumbnail and derivatives for a new image, and
+    record the content hashes.
+    """
+    create_image_thumbnail(image)
+    image_derivatives.createDerivatives(
+        IMAGE_DIRECTORY, image.getFilename(),
+        image_derivatives.SIZES, image_derivatives.FORMATS)
+    image_files.recordFiles(db, IMAGE_DIRECTORY,
+                            [image.getFilename(), image.getThumbName()])
+
+
+# Size of reads when downloading images
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def download_image(url: str, dest_file: str) -> str | None:
+    """
+    Stream an image to dest_file. Written to a temporary file in the
+    same directory and renamed into place when complete.
+    Return the sha256 of the file, or None on failure.
+    """
+    with requests.get(url, stream=True, timeout=20) as response:
+        if response.status_code != 200:
+            logging.info("image download failed: %d", response.status_code)
+            return None
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"):
+            logging.info("image download unexpected type: %s", content_type)
+            return None
+
+        digest = hashlib.sha256()
+        size = 0
+        fd, path = tempfile.mkstemp(dir=os.path.dirname(dest_file), suffix=".part")
+        temp_file: str | None = path
+        try:
+            with os.fdopen(fd, "wb") as f:
+                # mkstemp creates the file 0600. Image files are read by
+                # the web server, e.g. nginx with X-Accel-Redirect.
+                os.fchmod(f.fileno(), 0o644)
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+
+            # Length is of the encoded content if compressed
+            length = response.headers.get("Content-Length")
+            if (length is not None and "Content-Encoding" not in response.headers
+                    and int(length) != size):
+                logging.info("image download incomplete: %d of %s", size, length)
+                return None
+            os.replace(path, dest_file)
+            temp_file = None
+        finally:
+            if temp_file is not None:
+                os.unlink(temp_file)
+    return digest.hexdigest()
+
+
 def image_get_request(prompt, dest_file):
+    """
+    Generate an image and save in dest_file.
+    Return the sha256 of the file, or None on failure.
+    """
     # Testing stub. Just copy existing file.
     if TESTING:
         dir_name = os.path.dirname(__file__)
         path = os.path.join(dir_name, "static/logo.png")
         with open(dest_file, "wb") as fout:
             with open(path, "rb") as fin:
-                fout.write(fin.read())
-        return True
+                data = fin.read()
+                fout.write(data)
+        return hashlib.sha256(data).hexdigest()
 
     # Functional code. Generate image and copy to dest_file.
     headers = {
@@ -1405,18 +1478,9 @@ def image_get_request(prompt, dest_file):
         result = response.json()
         logging.info("image complete")
         if result.get("data") is None:
-            return False
+            return None
 
-        response = requests.get(result["data"][0]["url"], stream=True, timeout=20)
-        if response.status_code != 200:
-            return False
-
-        with open(dest_file, "wb") as f:
-            response.raw.decode_content = True
-            # Probably uses more memory than necessary
-            # TODO: make more efficient
-            f.write(response.raw.read())
-        return True
+        return download_image(result["data"][0]["url"], dest_file)
 
     except Exception as e:
         logging.info("Unable to generate ChatCompletion response")
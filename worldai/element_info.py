@@ -23,23 +23,24 @@ def UpdateElementInfo(db, element: elements.Element):
     if element.type == elements.ElementType.WORLD:
         world_id = elements.WorldID(element.getID())
 
-    for index, content in element.getInfoText():
-        c = db.cursor()
-        c.execute(
-            "SELECT doc_id FROM element_info WHERE element_id = ? and info_index = ?",
-            (element.getID(), index),
-        )
-        r = c.fetchone()
-        if r is None:
-            doc_id = info_set.addInfoDoc(db, world_id, content)
+    # All sections are written in one transaction
+    with info_set.InfoSetWriter(db) as writer:
+        for index, content in element.getInfoText():
+            c = db.cursor()
             c.execute(
-                "INSERT INTO element_info (element_id, info_index, doc_id) VALUES (?,?,?)",
-                (element.getID(), index, doc_id),
+                "SELECT doc_id FROM element_info WHERE element_id = ? and info_index = ?",
+                (element.getID(), index),
             )
-            db.commit()
-        else:
-            doc_id = r[0]
-            info_set.updateInfoDoc(db, doc_id, content)
+            r = c.fetchone()
+            if r is None:
+                doc_id = writer.addInfoDoc(world_id, content)
+                c.execute(
+                    "INSERT INTO element_info (element_id, info_index, doc_id) VALUES (?,?,?)",
+                    (element.getID(), index, doc_id),
+                )
+            else:
+                doc_id = r[0]
+                writer.updateInfoDoc(doc_id, content)
 
 
 def DeleteElementInfo(db, element_id):
@@ -7,16 +7,22 @@ Represets the element of a world definition.
     http://github.com/jmwanderer
 """
 
+import collections
+import copy
 import enum
 import io
 import json
 import logging
 import os
+import threading
+import time
 import typing
 from typing import Optional
 
 import pydantic
 
+from . import image_derivatives
+
 # Types for IDs
 ElemID = typing.NewType("ElemID", str)
 WorldID = typing.NewType("WorldID", ElemID)
@@ -300,7 +306,7 @@ class Condition:
 
     #
     # Methods for start conditions:
-    # Note, the implementation produces n-squared behavior. Probably OK, but worth noting.
+    # Note, these scan the list. Use StartConditionIndex for repeated lookups.
     #
 
     @staticmethod
@@ -328,6 +334,83 @@ class Condition:
                 return True
         return False
 
+class StartConditionIndex:
+    """
+    Start conditions of a world definition indexed by character and item.
+    Lookups give the same results as the Condition start condition methods.
+    """
+
+    def __init__(self, properties: list[ConditionProp]) -> None:
+        self.char_site: dict[ElemID, ElemID] = {}
+        self.item_place: dict[ElemID, ElemID] = {}
+        self.char_status: dict[ElemID, set[CharStatus]] = {}
+
+        for entry in properties:
+            if (
+                entry.verb == ConditionVerb.AT
+                and entry.char_id != ELEM_ID_NONE
+                and entry.char_id not in self.char_site
+            ):
+                self.char_site[entry.char_id] = entry.site_id
+            if entry.item_id != ELEM_ID_NONE and entry.item_id not in self.item_place:
+                if entry.verb == ConditionVerb.AT:
+                    self.item_place[entry.item_id] = entry.site_id
+                else:
+                    self.item_place[entry.item_id] = entry.char_id
+            if entry.verb == ConditionVerb.IS:
+                self.char_status.setdefault(entry.char_id, set()).add(entry.char_status)
+
+    @staticmethod
+    def forWorld(world: "World") -> "StartConditionIndex":
+        """
+        Return the index for the world.
+        """
+        return START_CONDITIONS.forWorld(world)
+
+    def getCharStartSite(self, char_id: ElemID) -> ElemID:
+        return self.char_site.get(char_id, ELEM_ID_NONE)
+
+    def getItemStartPlace(self, item_id: ElemID) -> ElemID:
+        return self.item_place.get(item_id, ELEM_ID_NONE)
+
+    def isCharStatus(self, char_id: ElemID, char_status: CharStatus) -> bool:
+        return char_status in self.char_status.get(char_id, ())
+
+
+T = typing.TypeVar("T")
+
+
+class WorldVersionCache(typing.Generic[T]):
+    """
+    Values built from a world definition, by world id and version.
+    Shared while the world definition is unchanged. Worlds without
+    a version are not cached.
+    """
+
+    def __init__(self, build: typing.Callable[["World"], T], size: int = 100) -> None:
+        self.build = build
+        self.size = size
+        self.entries: dict[tuple[ElemID, int], T] = {}
+
+    def forWorld(self, world: "World") -> T:
+        if world.version is None:
+            return self.build(world)
+        key = (world.getID(), world.version)
+        value = self.entries.get(key)
+        if value is None:
+            if len(self.entries) > self.size:
+                self.entries.clear()
+            value = self.build(world)
+            self.entries[key] = value
+        return value
+
+
+# Start condition indexes by world id and version
+START_CONDITIONS = WorldVersionCache(
+    lambda world: StartConditionIndex(world.startConditions())
+)
+
+
 class WorldProps(BaseProps):
     plans: typing.Optional[str] = ""
     start_conditions: list[ConditionProp] = []
@@ -481,11 +564,22 @@ class Element:
         self.name = ""
         self.prop_model = BaseProps()
         self.images: list[ElemID] = []  # List of image ids
+        # Version of the world when loaded, None if unknown or changed since
+        self.version: int | None = None
         self._setProperties({})
 
     def getID(self) -> ElemID:
         return self.eid
 
+    def copy(self) -> "Element":
+        """
+        Return an instance that shares no mutable state with this one.
+        """
+        element = copy.copy(self)
+        element.prop_model = self.prop_model.model_copy(deep=True)
+        element.images = list(self.images)
+        return element
+
     def hasImage(self) -> bool:
         return len(self.images) > 0
 
@@ -892,16 +986,207 @@ class Item(Element):
         return content
 
 
+class IdentityMap:
+    """
+    Request scoped map of loaded elements.
+
+    Each element is loaded, parsed and validated at most once while
+    the map is attached to a DB connection (as 'element_map').
+    Like ElementCache, callers get a copy and may modify it freely;
+    changes are seen by later loads only once saved.
+    """
+
+    def __init__(self) -> None:
+        self.elements: dict[ElemID, Element] = {}
+        self.versions: dict[WorldID, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, eid: ElemID, element_type: ElementType) -> Element | None:
+        element = self.elements.get(eid)
+        if element is None or element.type != element_type:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return element.copy()
+
+    def put(self, element: Element) -> None:
+        self.elements[element.eid] = element.copy()
+
+    def remove(self, eid: ElemID) -> None:
+        self.elements.pop(eid, None)
+
+    def removeWorld(self, world_id: WorldID) -> None:
+        """
+        Remove a world and all of its elements.
+        """
+        for eid in [
+            eid
+            for eid, element in self.elements.items()
+            if eid == world_id or element.parent_id == world_id
+        ]:
+            del self.elements[eid]
+
+    def clear(self) -> None:
+        self.elements.clear()
+        self.versions.clear()
+
+
+def getIdentityMap(db) -> IdentityMap | None:
+    """
+    Return the identity map attached to the DB connection, if any.
+    """
+    return getattr(db, "element_map", None)
+
+
+def getWorldVersion(db, world_id: WorldID) -> int:
+    """
+    Return the current version of the world definition.
+    Read once per request when an identity map is attached.
+    """
+    element_map = getIdentityMap(db)
+    if element_map is not None and world_id in element_map.versions:
+        return element_map.versions[world_id]
+
+    q = db.execute("SELECT version FROM world_version WHERE world_id = ?", (world_id,))
+    r = q.fetchone()
+    version = r[0] if r is not None else 0
+    if element_map is not None:
+        element_map.versions[world_id] = version
+    return version
+
+
+def getWorldModified(db, world_id: WorldID) -> tuple[int, int]:
+    """
+    Return the version of the world definition and the time it was
+    last changed. The time is 0 if not known.
+    """
+    q = db.execute(
+        "SELECT version, updated FROM world_version WHERE world_id = ?", (world_id,)
+    )
+    r = q.fetchone()
+    if r is None:
+        return (0, 0)
+    return (r[0], int(r[1]))
+
+
+def getWorldsModified(db) -> tuple[int, int]:
+    """
+    Return a version covering the definitions of all worlds and the
+    time any was last changed. Bumped on every change, including
+    creating and deleting worlds.
+    """
+    return getWorldModified(db, WORLD_ID_NONE)
+
+
+def bumpWorldVersion(db, eid: ElemID) -> None:
+    """
+    Mark the world containing the element as changed.
+    Executed within the transaction that changes the element.
+    """
+    db.execute(
+        "INSERT INTO world_version (world_id, version, updated) "
+        + "SELECT CASE WHEN type = ? THEN id ELSE parent_id END, 1, ? "
+        + "FROM elements WHERE id = ? "
+        + "ON CONFLICT (world_id) DO UPDATE SET "
+        + "version = version + 1, updated = excluded.updated",
+        (ElementType.WORLD, int(time.time()), eid),
+    )
+    # Change counter for the list of worlds
+    db.execute(
+        "INSERT INTO world_version (world_id, version, updated) VALUES (?, 1, ?) "
+        + "ON CONFLICT (world_id) DO UPDATE SET "
+        + "version = version + 1, updated = excluded.updated",
+        (WORLD_ID_NONE, int(time.time())),
+    )
+    element_map = getIdentityMap(db)
+    if element_map is not None:
+        element_map.versions.clear()
+
+
+class ElementCache:
+    """
+    Process wide LRU cache of parsed elements.
+
+    Entries are tagged with the version of their world when loaded and
+    are used only while that version is current. Any change to the world
+    definition, from this or another process, retires all of its entries.
+    Callers get a copy and may modify it freely.
+    """
+
+    def __init__(self, size: int = 1000) -> None:
+        self.size = size
+        self.entries: collections.OrderedDict[ElemID, tuple[WorldID, int, Element]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db, eid: ElemID, element_type: ElementType) -> Element | None:
+        with self.lock:
+            entry = self.entries.get(eid)
+        if entry is not None:
+            world_id, version, element = entry
+            if (
+                element.type == element_type
+                and getWorldVersion(db, world_id) == version
+            ):
+                with self.lock:
+                    if eid in self.entries:
+                        self.entries.move_to_end(eid)
+                    self.hits += 1
+                return element.copy()
+
+        with self.lock:
+            if entry is not None and self.entries.get(eid) is entry:
+                del self.entries[eid]
+            self.misses += 1
+        return None
+
+    def put(self, world_id: WorldID, version: int, element: Element) -> None:
+        with self.lock:
+            self.entries[element.eid] = (world_id, version, element.copy())
+            self.entries.move_to_end(element.eid)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+# Set to an ElementCache to share parsed elements across requests.
+ELEMENT_CACHE: ElementCache | None = None
+
+
 class ElementStore:
     @staticmethod
     def loadElement(db, eid: ElemID, element: Element):
         """
         Return an element insance
         """
+        element_map = getIdentityMap(db)
+        if element_map is not None:
+            cached = element_map.get(eid, element.type)
+            if cached is not None:
+                return cached
+
+        if ELEMENT_CACHE is not None:
+            cached = ELEMENT_CACHE.get(db, eid, element.type)
+            if cached is not None:
+                if element_map is not None:
+                    element_map.put(cached)
+                return cached
+
+        # Read the world version with the element so the cache
+        # entry is never tagged newer than its content.
         q = db.execute(
-            "SELECT parent_id, name, properties "
-            + "FROM elements WHERE id = ? and type = ?",
-            (eid, element.type),
+            "SELECT e.parent_id, e.name, e.properties, v.world_id, v.version "
+            + "FROM elements e LEFT JOIN world_version v ON v.world_id = "
+            + "CASE WHEN e.type = ? THEN e.id ELSE e.parent_id END "
+            + "WHERE e.id = ? and e.type = ?",
+            (ElementType.WORLD, eid, element.type),
         )
         r = q.fetchone()
         if r is None:
@@ -913,13 +1198,74 @@ class ElementStore:
         element.setPropertiesStr(r[2])
 
         c = db.execute(
-            "SELECT id FROM images WHERE parent_id = ? " + "AND is_hidden = FALSE",
+            "SELECT id FROM images WHERE parent_id = ? "
+            + "AND is_hidden = FALSE ORDER BY rowid",
             (eid,),
         )
         for entry in c.fetchall():
             element.images.append(entry[0])
+
+        element.version = r[4] if r[3] is not None else 0
+        if ELEMENT_CACHE is not None:
+            world_id = element.getElemTag().getWorldID()
+            ELEMENT_CACHE.put(world_id, element.version, element)
+        if element_map is not None:
+            element_map.put(element)
         return element
 
+    @staticmethod
+    def loadElements(
+        db,
+        pid: WorldID,
+        element_type: ElementType,
+        factory: typing.Callable[[], Element],
+    ) -> list[Element]:
+        """
+        Return all visible elements of a type in a world, read with
+        one query for the elements and one for their images.
+        """
+        q = db.execute(
+            "SELECT e.id, e.name, e.properties, v.version FROM elements e "
+            + "LEFT JOIN world_version v ON v.world_id = "
+            + "CASE WHEN e.type = ? THEN e.id ELSE e.parent_id END "
+            + "WHERE e.parent_id = ? AND e.type = ? AND e.is_hidden = FALSE",
+            (ElementType.WORLD, pid, element_type),
+        )
+        rows = q.fetchall()
+        images: dict[ElemID, list[ElemID]] = {}
+        c = db.execute(
+            "SELECT i.parent_id, i.id FROM images i "
+            + "JOIN elements e ON e.id = i.parent_id "
+            + "WHERE e.parent_id = ? AND e.type = ? AND i.is_hidden = FALSE "
+            + "ORDER BY i.rowid",
+            (pid, element_type),
+        )
+        for parent_id, iid in c.fetchall():
+            images.setdefault(parent_id, []).append(iid)
+
+        element_map = getIdentityMap(db)
+        result = []
+        for eid, name, properties, version in rows:
+            if element_map is not None:
+                cached = element_map.get(eid, element_type)
+                if cached is not None:
+                    result.append(cached)
+                    continue
+            element = factory()
+            element.eid = eid
+            element.parent_id = pid
+            element.name = name
+            element.setPropertiesStr(properties)
+            element.images = images.get(eid, [])
+            element.version = version if version is not None else 0
+            if ELEMENT_CACHE is not None:
+                world_id = element.getElemTag().getWorldID()
+                ELEMENT_CACHE.put(world_id, element.version, element)
+            if element_map is not None:
+                element_map.put(element)
+            result.append(element)
+        return result
+
     @staticmethod
     def findElement(db, pid: WorldID, name: str, element: Element):
         """
@@ -945,7 +1291,12 @@ class ElementStore:
             + "WHERE id = ? and type = ?",
             (element.name, element.getPropertiesStr(), element.eid, element.type),
         )
+        bumpWorldVersion(db, element.eid)
         db.commit()
+        element.version = None
+        element_map = getIdentityMap(db)
+        if element_map is not None:
+            element_map.put(element)
 
     @staticmethod
     def createElement(db, element: Element) -> ElemID:
@@ -964,7 +1315,11 @@ class ElementStore:
                 element.getPropertiesStr(),
             ),
         )
+        bumpWorldVersion(db, element.eid)
         db.commit()
+        element_map = getIdentityMap(db)
+        if element_map is not None:
+            element_map.put(element)
         return element.eid
 
     @staticmethod
@@ -992,6 +1347,7 @@ class ElementStore:
                 "UPDATE elements SET is_hidden = TRUE WHERE id = ? AND " + "type = ?",
                 (instance.eid, element.type),
             )
+            bumpWorldVersion(db, instance.eid)
             db.commit()
             return c.rowcount
         return 0
@@ -1004,10 +1360,28 @@ class ElementStore:
             + "parent_id = ? AND type = ? and is_hidden = TRUE",
             (parent_id, element_type),
         )
+        if c.rowcount > 0:
+            bumpWorldVersion(db, parent_id)
         db.commit()
         return c.rowcount
 
 
+def forgetElement(db, eid: ElemID) -> None:
+    """
+    Drop an element from the identity map after a change that
+    is not made through the element instance.
+    """
+    element_map = getIdentityMap(db)
+    if element_map is not None:
+        element_map.remove(eid)
+
+
+def clearIdentityMap(db) -> None:
+    element_map = getIdentityMap(db)
+    if element_map is not None:
+        element_map.clear()
+
+
 class Image:
     """
     The image class represents an image attached to a particular element.
@@ -1039,13 +1413,84 @@ class Image:
         return filename[0:-4] + ".thmb" + filename[-4:]
 
 
+# Image.getThumbName() in SQL, to join image_files on the thumbnail
+THUMB_NAME_SQL = (
+    "substr(images.filename, 1, length(images.filename) - 4) "
+    + "|| '.thmb' || substr(images.filename, -4)"
+)
+
+
+class ImageSummary:
+    """
+    The first visible image of an element, the number of
+    visible images, and the recorded hash of the thumbnail.
+    """
+
+    def __init__(self, image: Image, count: int, thumb_hash: str | None = None):
+        self.image = image
+        self.count = count
+        self.thumb_hash = thumb_hash
+
+
+def getImageSummaries(db, wid: WorldID) -> dict[ElemID, ImageSummary]:
+    """
+    Return image summaries for a world and all of its elements,
+    keyed by element id, with one grouped query.
+    """
+    # SQLite takes the bare columns from the row that matches MIN().
+    q = db.execute(
+        "SELECT images.parent_id, images.id, images.filename, MIN(images.rowid), "
+        + "COUNT(*), image_files.sha256 FROM images "
+        + f"LEFT JOIN image_files ON image_files.name = {THUMB_NAME_SQL} "
+        + "WHERE images.is_hidden = FALSE AND (images.parent_id = ? OR "
+        + "images.parent_id IN (SELECT id FROM elements WHERE parent_id = ?)) "
+        + "GROUP BY images.parent_id",
+        (wid, wid),
+    )
+    result = {}
+    for parent_id, iid, filename, _, count, thumb_hash in q.fetchall():
+        image = Image(iid)
+        image.parent_id = parent_id
+        image.filename = filename
+        result[parent_id] = ImageSummary(image, count, thumb_hash)
+    return result
+
+
+def getImageHashes(
+    db, iids: list[ElemID], thumb: bool = False
+) -> dict[ElemID, tuple[Image, str | None]]:
+    """
+    Return images by id with the recorded hash of each image file,
+    or of its thumbnail, with one query.
+    """
+    if len(iids) == 0:
+        return {}
+    name = THUMB_NAME_SQL if thumb else "images.filename"
+    params = ",".join("?" * len(iids))
+    q = db.execute(
+        "SELECT images.id, images.parent_id, images.filename, image_files.sha256 "
+        + f"FROM images LEFT JOIN image_files ON image_files.name = {name} "
+        + f"WHERE images.id IN ({params})",
+        tuple(iids),
+    )
+    result = {}
+    for iid, parent_id, filename, digest in q.fetchall():
+        image = Image(iid)
+        image.parent_id = parent_id
+        image.filename = filename
+        result[iid] = (image, digest)
+    return result
+
+
 def createImage(db, image: Image):
     image.iid = ElemID("id%s" % os.urandom(4).hex())
     db.execute(
         "INSERT INTO images (id, parent_id, prompt, filename) " + "VALUES (?, ?, ?, ?)",
         (image.iid, image.parent_id, image.prompt, image.filename),
     )
+    bumpWorldVersion(db, image.parent_id)
     db.commit()
+    forgetElement(db, image.parent_id)
     return image
 
 
@@ -1059,8 +1504,12 @@ def getImageFromIndex(db, parent_id: ElemID, index: int) -> Image | None:
 
 
 def hideImage(db, iid: ElemID):
+    image = getImage(db, iid)
     db.execute("UPDATE images SET is_hidden = TRUE WHERE id = ?", (iid,))
+    if image is not None:
+        bumpWorldVersion(db, image.parent_id)
     db.commit()
+    clearIdentityMap(db)
 
 
 def recoverImages(db, parent_id: ElemID):
@@ -1070,7 +1519,10 @@ def recoverImages(db, parent_id: ElemID):
         + "AND is_hidden = TRUE",
         (parent_id,),
     )
+    if c.rowcount > 0:
+        bumpWorldVersion(db, parent_id)
     db.commit()
+    forgetElement(db, parent_id)
     return c.rowcount
 
 
@@ -1171,6 +1623,16 @@ def listWorlds(db) -> list[IdName]:
     return ElementStore.getElements(db, ElementType.WORLD, WORLD_ID_NONE)
 
 
+def loadWorlds(db) -> list[World]:
+    """
+    Return all world instances
+    """
+    return typing.cast(
+        list[World],
+        ElementStore.loadElements(db, WORLD_ID_NONE, ElementType.WORLD, World),
+    )
+
+
 def loadWorld(db, eid: ElemID) -> Optional[World]:
     """
     Return a world instance
@@ -1237,6 +1699,16 @@ def listCharacters(db, world_id: WorldID) -> list[IdName]:
     return ElementStore.getElements(db, ElementType.CHARACTER, world_id)
 
 
+def loadCharacters(db, world_id: WorldID) -> list[Character]:
+    """
+    Return all character instances of a world
+    """
+    return typing.cast(
+        list[Character],
+        ElementStore.loadElements(db, world_id, ElementType.CHARACTER, Character),
+    )
+
+
 def loadCharacter(db, eid: ElemID) -> Optional[Character]:
     """
     Return a character instance
@@ -1286,6 +1758,15 @@ def listSites(db, world_id: WorldID) -> list[IdName]:
     return ElementStore.getElements(db, ElementType.SITE, world_id)
 
 
+def loadSites(db, world_id: WorldID) -> list[Site]:
+    """
+    Return all site instances of a world
+    """
+    return typing.cast(
+        list[Site], ElementStore.loadElements(db, world_id, ElementType.SITE, Site)
+    )
+
+
 def loadSite(db, eid: ElemID) -> Optional[Site]:
     """
     Return a site instance
@@ -1328,6 +1809,15 @@ def listItems(db, world_id: WorldID) -> list[IdName]:
     return ElementStore.getElements(db, ElementType.ITEM, world_id)
 
 
+def loadItems(db, world_id: WorldID) -> list[Item]:
+    """
+    Return all item instances of a world
+    """
+    return typing.cast(
+        list[Item], ElementStore.loadElements(db, world_id, ElementType.ITEM, Item)
+    )
+
+
 def loadItem(db, eid: ElemID) -> Optional[Item]:
     """
     Return an item instance
@@ -1379,14 +1869,24 @@ def deleteImage(db, data_dir: str, image_id: ElemID):
         return
 
     db.execute("DELETE FROM images WHERE id = ?", (image_id,))
+    bumpWorldVersion(db, image.parent_id)
     db.commit()
+    forgetElement(db, image.parent_id)
     logging.info("remove image: %s", image_id)
-    path = os.path.join(data_dir, image.filename)
-    try:
-        os.unlink(path)
-        logging.info("delete file: %s", path)
-    except FileNotFoundError:
-        pass
+    # Original, thumbnail and derivatives
+    filenames = [image.getFilename(), image.getThumbName()]
+    for size in image_derivatives.SIZES:
+        for fmt in image_derivatives.FORMAT_TYPES:
+            filenames.append(
+                image_derivatives.derivativeName(image.getFilename(), size, fmt)
+            )
+    for filename in filenames:
+        path = os.path.join(data_dir, filename)
+        try:
+            os.unlink(path)
+            logging.info("delete file: %s", path)
+        except FileNotFoundError:
+            pass
 
 
 def deleteCharacter(db, data_dir: str, eid: ElemID):
@@ -1400,10 +1900,12 @@ def deleteCharacter(db, data_dir: str, eid: ElemID):
     for image in images:
         deleteImage(db, data_dir, image["id"])
 
+    bumpWorldVersion(db, eid)
     db.execute(
         "DELETE FROM elements WHERE id = ? AND type = ?", (eid, ElementType.CHARACTER)
     )
     db.commit()
+    forgetElement(db, eid)
 
 
 def deleteWorld(db, data_dir: str, world_id: WorldID):
@@ -1421,10 +1923,14 @@ def deleteWorld(db, data_dir: str, world_id: WorldID):
     for image in images:
         deleteImage(db, data_dir, image["id"])
 
+    bumpWorldVersion(db, world.eid)
     db.execute(
         "DELETE FROM elements WHERE id = ? AND type = ?", (world.eid, ElementType.WORLD)
     )
     db.commit()
+    element_map = getIdentityMap(db)
+    if element_map is not None:
+        element_map.removeWorld(world_id)
 
 
 def getAdjacentElements(id_name: IdName, id_name_list: list[IdName]):
@@ -0,0 +1,125 @@
+"""
+Smaller versions of images for list views and mobile clients.
+
+Each image is resized to a set of sizes and saved in the formats
+the installed Pillow supports. Derivatives are built off the request
+path: by the image job when an image is created, or in bulk by the
+create-derivatives command.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import concurrent.futures
+import logging
+import os
+
+from PIL import Image, features
+
+# Size name -> maximum width and height
+SIZES: dict[str, int] = {
+    "small": 256,
+    "medium": 512,
+}
+
+# Preferred formats first. JPEG is always available.
+FORMAT_TYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "jpg": "image/jpeg",
+}
+
+
+def availableFormats() -> list[str]:
+    """
+    Formats supported by the installed Pillow, preferred first.
+    """
+    result = []
+    for fmt in FORMAT_TYPES.keys():
+        if fmt == "jpg" or (fmt in features.get_supported_modules() and
+                            features.check(fmt)):
+            result.append(fmt)
+    return result
+
+
+FORMATS = availableFormats()
+
+
+def derivativeName(filename: str, size: str, fmt: str) -> str:
+    """
+    Return the file name of a derivative of an image file.
+    """
+    return "%s.%s.%s" % (os.path.splitext(filename)[0], size, fmt)
+
+
+def createDerivatives(image_dir: str, filename: str,
+                      sizes: dict[str, int], formats: list[str]) -> int:
+    """
+    Create the derivatives of an image file. Existing files are kept.
+    Return the number created.
+    """
+    count = 0
+    with Image.open(os.path.join(image_dir, filename)) as source:
+        source.load()
+        for size, pixels in sizes.items():
+            image = None
+            for fmt in formats:
+                out_file = os.path.join(image_dir, derivativeName(filename, size, fmt))
+                if os.path.exists(out_file):
+                    continue
+                if image is None:
+                    image = source.copy()
+                    image.thumbnail((pixels, pixels))
+                saveImage(image, out_file, fmt)
+                count += 1
+    return count
+
+
+def saveImage(image: Image.Image, out_file: str, fmt: str) -> None:
+    """
+    Write to a temporary name and rename, readers never see a partial file.
+    """
+    temp_file = out_file + ".part"
+    if fmt == "jpg":
+        image.convert("RGB").save(temp_file, "JPEG", quality=85, optimize=True,
+                                  progressive=True)
+    elif fmt == "webp":
+        image.save(temp_file, "WEBP", quality=80)
+    else:
+        image.save(temp_file, fmt.upper(), quality=60)
+    os.replace(temp_file, out_file)
+
+
+def findDerivative(image_dir: str, filename: str, size: str,
+                   accept: list[str]) -> tuple[str, str] | None:
+    """
+    Return the path and mime type of the first existing derivative in
+    a format the client accepts, or None.
+    """
+    for fmt in FORMATS:
+        mimetype = FORMAT_TYPES[fmt]
+        if fmt != "jpg" and mimetype not in accept:
+            continue
+        path = os.path.join(image_dir, derivativeName(filename, size, fmt))
+        if os.path.isfile(path):
+            return (path, mimetype)
+    return None
+
+
+def createAllDerivatives(image_dir: str, filenames: list[str],
+                         workers: int | None = None) -> int:
+    """
+    Create derivatives for many images using a pool of processes.
+    Return the number created.
+    """
+    count = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = { executor.submit(createDerivatives, image_dir, filename,
+                                    SIZES, FORMATS): filename
+                    for filename in filenames }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                count += future.result()
+            except Exception:
+                logging.exception("derivatives failed: %s", futures[future])
+    return count
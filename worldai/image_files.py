@@ -0,0 +1,53 @@
+"""
+Content addressed access to image files.
+
+Each image file is identified by the sha256 of its content. URLs
+built from the hash never change meaning, so clients may cache them
+forever. Hashes are recorded when image files are written.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import hashlib
+import os
+
+
+def recordFiles(db, image_dir: str, names: list[str]) -> int:
+    """
+    Compute and record the sha256 of image files.
+    Return the number recorded. Missing files are skipped.
+    """
+    rows = []
+    for name in names:
+        path = os.path.join(image_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        rows.append((name, digest, os.path.getsize(path)))
+    db.executemany(
+        "INSERT OR REPLACE INTO image_files (name, sha256, size) VALUES (?, ?, ?)",
+        rows,
+    )
+    db.commit()
+    return len(rows)
+
+
+def hashName(digest: str, name: str) -> str:
+    """
+    Return the content addressed name for a file with a known hash.
+    """
+    return digest + os.path.splitext(name)[1]
+
+
+def findFile(db, content_name: str) -> str | None:
+    """
+    Return the file name for a content addressed name.
+    """
+    digest, ext = os.path.splitext(content_name)
+    q = db.execute("SELECT name FROM image_files WHERE sha256 = ?", (digest,))
+    for (name,) in q.fetchall():
+        if os.path.splitext(name)[1] == ext:
+            return name
+    return None
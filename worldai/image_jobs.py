@@ -0,0 +1,178 @@
+"""
+Background generation of images.
+
+Design functions submit a job and return at once. A pool of worker
+threads runs the generations and records the image when complete.
+Clients poll the job for its status.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import concurrent.futures
+import enum
+import logging
+import os
+import threading
+import time
+import typing
+
+import pydantic
+
+from . import chat_functions, db_access, elements
+
+
+class JobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class ImageJob(pydantic.BaseModel):
+    """
+    State of an image generation request
+    """
+
+    id: str = ""
+    world_id: str = ""
+    parent_id: str = ""
+    prompt: str = ""
+    status: JobStatus = JobStatus.PENDING
+    image_id: typing.Optional[str] = None
+    error: typing.Optional[str] = None
+
+
+# Generate an image for a prompt into a file.
+# Returns the sha256 of the file, None on failure.
+Generator = typing.Callable[[str, str], str | None]
+
+
+def loadJob(db, job_id: str) -> ImageJob | None:
+    q = db.execute(
+        "SELECT id, world_id, parent_id, prompt, status, image_id, error "
+        + "FROM image_jobs WHERE id = ?",
+        (job_id,),
+    )
+    r = q.fetchone()
+    if r is None:
+        return None
+    return ImageJob(id=r[0], world_id=r[1], parent_id=r[2], prompt=r[3],
+                    status=JobStatus(r[4]), image_id=r[5], error=r[6])
+
+
+def setJobStatus(db, job_id: str, status: JobStatus,
+                 image_id: str | None = None, error: str | None = None) -> None:
+    db.execute(
+        "UPDATE image_jobs SET status = ?, image_id = ?, error = ?, updated = ? "
+        + "WHERE id = ?",
+        (status, image_id, error, int(time.time()), job_id),
+    )
+    db.commit()
+
+
+class ImageJobQueue:
+    """
+    Runs image jobs on a pool of threads.
+
+    An image is counted against the budget when submitted and
+    refunded if the generation fails.
+    """
+
+    def __init__(self, image_dir: str, generate: Generator,
+                 complete: typing.Callable[[typing.Any, elements.Image], None],
+                 workers: int = 4) -> None:
+        self.image_dir = image_dir
+        self.generate = generate
+        # Called with the DB and the new image, e.g. to create a thumbnail
+        self.complete = complete
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="image_job")
+        self.futures: dict[str, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+
+    def submit(self, db, world_id: elements.WorldID, image: elements.Image,
+               request: str) -> ImageJob:
+        """
+        Queue generation of an image. Return the pending job.
+        """
+        job = ImageJob(id="id%s" % os.urandom(4).hex(), world_id=world_id,
+                       parent_id=image.parent_id, prompt=image.prompt)
+        now = int(time.time())
+        db.execute(
+            "INSERT INTO image_jobs (id, world_id, parent_id, prompt, request, "
+            + "filename, status, created, updated) "
+            + "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, world_id, image.parent_id, image.prompt, request,
+             image.getFilename(), JobStatus.PENDING, now, now),
+        )
+        chat_functions.count_image(db, world_id, 1)
+        db.commit()
+        with self.lock:
+            self.futures[job.id] = self.executor.submit(self.run, job.id)
+        return job
+
+    def run(self, job_id: str) -> None:
+        db = db_access.open_db()
+        try:
+            self.runJob(db, job_id)
+        finally:
+            with self.lock:
+                self.futures.pop(job_id, None)
+            db.close()
+
+    def runJob(self, db, job_id: str) -> None:
+        q = db.execute(
+            "SELECT world_id, parent_id, prompt, request, filename "
+            + "FROM image_jobs WHERE id = ?",
+            (job_id,),
+        )
+        (world_id, parent_id, prompt, request, filename) = q.fetchone()
+        setJobStatus(db, job_id, JobStatus.RUNNING)
+
+        image = elements.Image()
+        image.setPrompt(prompt)
+        image.setParentId(parent_id)
+        image.filename = filename
+        dest_file = os.path.join(self.image_dir, image.getFilename())
+        error = "problem generating image"
+        try:
+            logging.info("image job %s: generate %s", job_id, dest_file)
+            if self.generate(request, dest_file) is not None:
+                image = elements.createImage(db, image)
+                self.complete(db, image)
+                setJobStatus(db, job_id, JobStatus.DONE, image_id=image.getID())
+                logging.info("image job %s: done", job_id)
+                return
+        except Exception as e:
+            logging.exception("image job %s failed", job_id)
+            error = str(e)
+
+        chat_functions.count_image(db, world_id, -1)
+        setJobStatus(db, job_id, JobStatus.FAILED, error=error)
+
+    def wait(self, timeout: float | None = None) -> None:
+        """
+        Wait for the submitted jobs to finish.
+        """
+        with self.lock:
+            futures = list(self.futures.values())
+        concurrent.futures.wait(futures, timeout=timeout)
+
+
+def failInterrupted(db) -> int:
+    """
+    Fail jobs left unfinished by a previous process and refund them.
+    Return the number of jobs.
+    """
+    q = db.execute("SELECT id, world_id FROM image_jobs WHERE status IN (?, ?)",
+                   (JobStatus.PENDING, JobStatus.RUNNING))
+    entries = q.fetchall()
+    for job_id, world_id in entries:
+        chat_functions.count_image(db, world_id, -1)
+        setJobStatus(db, job_id, JobStatus.FAILED, error="interrupted")
+    return len(entries)
+
+
+# Set to an ImageJobQueue to generate images in the background.
+IMAGE_JOBS: ImageJobQueue | None = None
@@ -201,6 +201,81 @@ class InfoStore:
         db.commit()
 
 
+class InfoSetWriter:
+    """
+    Groups info doc and chunk writes into one transaction.
+    Commits when the with block ends, rolls back on an exception.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self) -> "InfoSetWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.db.commit()
+        else:
+            self.db.rollback()
+
+    def addInfoDoc(
+        self,
+        world_id: elements.WorldID,
+        content: str,
+        owner_id: elements.ElemID | None = None,
+        wstate_id: str | None = None,
+        chunks: list[str] | None = None,
+        embeds: list[list[float]] | None = None,
+    ) -> DocID:
+        """
+        Add a doc and its chunks. Content is chunked if chunks is None.
+        """
+        doc_id: DocID = DocID("id%s" % os.urandom(8).hex())
+        self.db.execute(
+            "INSERT INTO info_docs (id, world_id, owner_id, "
+            + "wstate_id, content) VALUES (?, ?, ?, ?, ?)",
+            (doc_id, world_id, owner_id, wstate_id, content),
+        )
+        self.addChunks(doc_id, content, chunks, embeds)
+        return doc_id
+
+    def updateInfoDoc(
+        self,
+        doc_id: DocID,
+        content: str,
+        chunks: list[str] | None = None,
+        embeds: list[list[float]] | None = None,
+    ) -> None:
+        """
+        Replace the content and chunks of a doc.
+        """
+        self.db.execute("UPDATE info_docs SET content = ? WHERE id = ?", (content, doc_id))
+        self.db.execute("DELETE FROM info_chunks WHERE doc_id = ?", (doc_id,))
+        self.addChunks(doc_id, content, chunks, embeds)
+
+    def addChunks(
+        self,
+        doc_id: DocID,
+        content: str,
+        chunks: list[str] | None,
+        embeds: list[list[float]] | None,
+    ) -> None:
+        if chunks is None:
+            chunks = chunk.chunk_text(content, 200, 0.2)
+        rows = []
+        for index, text in enumerate(chunks):
+            str_val = None
+            if embeds is not None:
+                str_val = json.dumps(embeds[index])
+            rows.append(("id%s" % os.urandom(8).hex(), doc_id, text, str_val))
+        self.db.executemany(
+            "INSERT INTO info_chunks (id, doc_id, content, embedding) "
+            + "VALUES (?, ?, ?, ?)",
+            rows,
+        )
+
+
 client = None
 
 
@@ -224,6 +299,19 @@ def generateEmbedding(content: str) -> list[float]:
     return response.data[0].embedding
 
 
+def generateEmbeddings(contents: list[str]) -> list[list[float]]:
+    """
+    Return embeddings for several texts from one request.
+    """
+    if TEST:
+        return [generateEmbedding(content) for content in contents]
+
+    response = _get_aiclient().embeddings.create(
+        input=contents, model="text-embedding-3-small"
+    )
+    return [entry.embedding for entry in response.data]
+
+
 def addInfoDoc(
     db,
     world_id: elements.WorldID,
@@ -231,22 +319,17 @@ def addInfoDoc(
     owner_id: elements.ElemID | None = None,
     wstate_id: str | None = None,
 ) -> DocID:
-    doc_id = InfoStore.addInfoDoc(db, world_id, content, owner_id, wstate_id)
+    with InfoSetWriter(db) as writer:
+        doc_id = writer.addInfoDoc(world_id, content, owner_id, wstate_id)
     logging.info("Add info doc id:%s, world id: %s", doc_id, world_id)
-    result = chunk.chunk_text(content, 200, 0.2)
-    for entry in result:
-        InfoStore.addInfoChunk(db, doc_id, entry)
     return doc_id
 
 
 def updateInfoDoc(db, doc_id: DocID, content: str) -> None:
     logging.info("Update info doc id:%s ", doc_id)
     # TODO: consider checking if the document changed.
-    InfoStore.updateInfoDoc(db, doc_id, content)
-    InfoStore.deleteDocChunks(db, doc_id)
-    result = chunk.chunk_text(content, 200, 0.2)
-    for entry in result:
-        InfoStore.addInfoChunk(db, doc_id, entry)
+    with InfoSetWriter(db) as writer:
+        writer.updateInfoDoc(doc_id, content)
 
 
 def addInfoNote(
@@ -260,10 +343,11 @@ def addInfoNote(
     Add a short entry that isn't chunked and will get an embedding immediately.
     """
     # Entry that isn't chunked and has an embedding generated immediately
-    doc_id = InfoStore.addInfoDoc(db, world_id, content, owner_id, wstate_id)
-    logging.info("Add info note id:%s, world id: %s", doc_id, world_id)
     embed = generateEmbedding(content)
-    InfoStore.addInfoChunk(db, doc_id, content, embed)
+    with InfoSetWriter(db) as writer:
+        doc_id = writer.addInfoDoc(world_id, content, owner_id, wstate_id,
+                                   chunks=[content], embeds=[embed])
+    logging.info("Add info note id:%s, world id: %s", doc_id, world_id)
     return doc_id
 
 
@@ -275,10 +359,9 @@ def updateInfoNote(db, doc_id: DocID, content: str) -> bool:
     # Arbitrary limit in characters.
     if len(content) > 1200:
         return False
-    InfoStore.updateInfoDoc(db, doc_id, content)
-    InfoStore.deleteDocChunks(db, doc_id)
     embed = generateEmbedding(content)
-    InfoStore.addInfoChunk(db, doc_id, content, embed)
+    with InfoSetWriter(db) as writer:
+        writer.updateInfoDoc(doc_id, content, chunks=[content], embeds=[embed])
     return True
 
 
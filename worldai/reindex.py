@@ -0,0 +1,180 @@
+"""
+Rebuild the InfoSet entries of world elements in bulk.
+
+The work is planned up front into the reindex_tasks table, one row
+per element. Text is chunked in a pool of processes and embeddings
+are requested in batches from a pool of threads. Each batch of
+elements is written in one transaction that also marks its tasks
+done, so an interrupted run resumes where it stopped.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import concurrent.futures
+import logging
+import time
+import typing
+
+from . import chunk, elements, info_set
+
+# Elements written per checkpoint
+BATCH_SIZE = 32
+
+# Texts sent in one embedding request
+EMBED_BATCH_SIZE = 64
+
+Chunker = typing.Callable[[str], list[str]]
+
+LOADERS: dict[elements.ElementType, typing.Callable] = {
+    elements.ElementType.WORLD: elements.loadWorld,
+    elements.ElementType.CHARACTER: elements.loadCharacter,
+    elements.ElementType.SITE: elements.loadSite,
+    elements.ElementType.ITEM: elements.loadItem,
+    elements.ElementType.DOCUMENT: elements.loadDocument,
+}
+
+
+class ReindexStats:
+    """
+    Progress of a reindex run.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.elements = 0
+        self.chunks = 0
+        self.start = time.monotonic()
+
+    def chunkRate(self) -> float:
+        """
+        Return chunks processed per second.
+        """
+        elapsed = time.monotonic() - self.start
+        if elapsed <= 0:
+            return 0.0
+        return self.chunks / elapsed
+
+
+def chunkText(content: str) -> list[str]:
+    return chunk.chunk_text(content, 200, 0.2)
+
+
+def planTasks(db, world_id: elements.WorldID | None = None) -> int:
+    """
+    Replace any previous plan with a task for each visible element,
+    optionally limited to one world. Return the number of tasks.
+    """
+    db.execute("DELETE FROM reindex_tasks")
+    sql = (
+        "INSERT INTO reindex_tasks (element_id, type) "
+        + "SELECT id, type FROM elements WHERE is_hidden = FALSE"
+    )
+    params: tuple = ()
+    if world_id is not None:
+        sql += " AND (id = ? OR parent_id = ?)"
+        params = (world_id, world_id)
+    c = db.execute(sql, params)
+    db.commit()
+    return c.rowcount
+
+
+def pendingTasks(db) -> list[tuple[elements.ElemID, elements.ElementType]]:
+    """
+    Return the elements not yet reindexed, in plan order.
+    """
+    q = db.execute(
+        "SELECT element_id, type FROM reindex_tasks WHERE done = FALSE ORDER BY rowid"
+    )
+    return [(eid, elements.ElementType(etype)) for eid, etype in q.fetchall()]
+
+
+def embedAll(executor, texts: list[str]) -> list[list[float]]:
+    """
+    Return embeddings for texts, requested in concurrent batches.
+    """
+    batches = [
+        texts[i : i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)
+    ]
+    result: list[list[float]] = []
+    for embeds in executor.map(info_set.generateEmbeddings, batches):
+        result.extend(embeds)
+    return result
+
+
+def writeDoc(
+    writer: info_set.InfoSetWriter,
+    element_id: elements.ElemID,
+    world_id: elements.WorldID,
+    index: int,
+    content: str,
+    chunks: list[str],
+    embeds: list[list[float]],
+) -> None:
+    """
+    Replace the info doc and chunks of one element text.
+    """
+    q = writer.db.execute(
+        "SELECT doc_id FROM element_info WHERE element_id = ? and info_index = ?",
+        (element_id, index),
+    )
+    r = q.fetchone()
+    if r is None:
+        doc_id = writer.addInfoDoc(world_id, content, chunks=chunks, embeds=embeds)
+        writer.db.execute(
+            "INSERT INTO element_info (element_id, info_index, doc_id) VALUES (?,?,?)",
+            (element_id, index, doc_id),
+        )
+    else:
+        writer.updateInfoDoc(r[0], content, chunks=chunks, embeds=embeds)
+
+
+def reindex(
+    db,
+    workers: int | None = None,
+    embed_workers: int = 4,
+    chunker: Chunker = chunkText,
+    progress: typing.Callable[[ReindexStats], None] | None = None,
+) -> ReindexStats:
+    """
+    Run the pending tasks. Call progress after each checkpoint.
+    """
+    tasks = pendingTasks(db)
+    stats = ReindexStats(len(tasks))
+    with (
+        concurrent.futures.ProcessPoolExecutor(max_workers=workers) as chunk_pool,
+        concurrent.futures.ThreadPoolExecutor(max_workers=embed_workers) as embed_pool,
+    ):
+        for start in range(0, len(tasks), BATCH_SIZE):
+            batch = tasks[start : start + BATCH_SIZE]
+            docs = []
+            for eid, etype in batch:
+                element = LOADERS[etype](db, eid)
+                if element is None:
+                    continue
+                world_id = element.parent_id
+                if element.type == elements.ElementType.WORLD:
+                    world_id = elements.WorldID(element.getID())
+                for index, content in element.getInfoText():
+                    docs.append((element.getID(), world_id, index, content))
+
+            doc_chunks = list(chunk_pool.map(chunker, [doc[3] for doc in docs]))
+            embeds = embedAll(embed_pool, [text for chunks in doc_chunks for text in chunks])
+
+            pos = 0
+            with info_set.InfoSetWriter(db) as writer:
+                for (eid, world_id, index, content), chunks in zip(docs, doc_chunks):
+                    writeDoc(writer, eid, world_id, index, content, chunks,
+                             embeds[pos : pos + len(chunks)])
+                    pos += len(chunks)
+                db.executemany(
+                    "UPDATE reindex_tasks SET done = TRUE WHERE element_id = ?",
+                    [(eid,) for eid, _ in batch],
+                )
+
+            stats.elements += len(batch)
+            stats.chunks += pos
+            logging.info("reindexed %d of %d elements", stats.elements, stats.total)
+            if progress is not None:
+                progress(stats)
+    return stats
@@ -4,9 +4,11 @@
 --    Jim Wanderer
 --    http://github.com/jmwanderer
 --
+-- Applied on every start. New tables are added to existing databases.
+--
 
 -- All elements: worlds, characters, items, sites, docs
-CREATE TABLE elements (
+CREATE TABLE IF NOT EXISTS elements (
   id TEXT PRIMARY KEY,
   type INTEGER,    
   parent_id TEXT,                   -- TODO: foreign key of this table
@@ -15,23 +17,26 @@ CREATE TABLE elements (
   is_hidden BOOLEAN DEFAULT FALSE   -- designer has removed from view
 );      
 
-CREATE TABLE images (
+CREATE TABLE IF NOT EXISTS images (
   id TEXT PRIMARY KEY,
   parent_id TEXT NOT NULL,
   prompt TEXT NOT NULL,
   filename TEXT NOT NULL,
   is_hidden BOOLEAN DEFAULT FALSE
 );
+CREATE INDEX IF NOT EXISTS images_parent_id ON images(parent_id);
 
-CREATE TABLE token_usage (
-  world_id STRING NOT NULL,
+-- Usage is added with upserts on world_id. Older databases are
+-- upgraded with the migrate-token-usage command.
+CREATE TABLE IF NOT EXISTS token_usage (
+  world_id STRING NOT NULL UNIQUE,
   prompt_tokens INTEGER NOT NULL,
   complete_tokens INTEGER NOT NULL,
   total_tokens INTEGER NOT NULL,
   images INTEGER NOT NULL DEFAULT 0
 );
 
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
   id TEXT NOT NULL PRIMARY KEY,
   username TEXT,
   auth_key TEXT UNIQUE NOT NULL,
@@ -41,7 +46,7 @@ CREATE TABLE users (
 );
 
 -- Message threads. Used directly by design and supports character threads
-CREATE TABLE threads (
+CREATE TABLE IF NOT EXISTS threads (
   id TEXT PRIMARY KEY,        -- user_id for design threads, generated for character threads
   created INTEGER NOT NULL,   -- timstamp creation
   updated INTEGER NOT NULL,   -- timestamp last changed
@@ -49,7 +54,7 @@ CREATE TABLE threads (
 );
 
 -- Dynamic game state for an instance of a world
-CREATE TABLE world_state (
+CREATE TABLE IF NOT EXISTS world_state (
   id TEXT PRIMARY KEY,
   user_id TEXT NOT NULL,
   world_id TEXT NOT NULL,
@@ -59,8 +64,20 @@ CREATE TABLE world_state (
   FOREIGN KEY (world_id) REFERENCES elements(id) ON DELETE CASCADE,
   FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 );
+
+-- Changes to a world state made since the state column was written.
+-- Applied in order on load and compacted into the state column.
+CREATE TABLE IF NOT EXISTS world_state_changes (
+  wstate_id TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  section TEXT NOT NULL,            -- char, item, site, events, player, world
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,              -- JSON encoded entry
+  PRIMARY KEY (wstate_id, seq),
+  FOREIGN KEY (wstate_id) REFERENCES world_state(id) ON DELETE CASCADE
+);
  
-CREATE TABLE character_threads (
+CREATE TABLE IF NOT EXISTS character_threads (
   character_id TEXT NOT NULL,
   thread_id TEXT NOT NULL,
   world_state_id TEXT NOT NULL,
@@ -70,7 +87,7 @@ CREATE TABLE character_threads (
   FOREIGN KEY (thread_id) REFERENCES threads(id) ON DELETE CASCADE
 );
 
-CREATE TABLE info_docs (
+CREATE TABLE IF NOT EXISTS info_docs (
   id TEXT NOT NULL,
   world_id TEXT NOT NULL,  
   owner_id TEXT NULL,
@@ -82,7 +99,7 @@ CREATE TABLE info_docs (
   FOREIGN KEY (owner_id) REFERENCES elements(id) ON DELETE CASCADE
 );
 
-CREATE TABLE info_chunks(
+CREATE TABLE IF NOT EXISTS info_chunks(
   id TEXT NOT NULL,
   doc_id TEXT NOT NULL,
   content TEXT NOT NULL,
@@ -91,7 +108,7 @@ CREATE TABLE info_chunks(
   FOREIGN KEY (doc_id) REFERENCES info_docs(id) ON DELETE CASCADE
 );
   
-CREATE TABLE element_info(
+CREATE TABLE IF NOT EXISTS element_info(
   element_id TEXT NOT NULL,
   info_index INTEGER DEFAULT 0,
   doc_id TEXT NOT NULL,
@@ -99,3 +116,44 @@ CREATE TABLE element_info(
   FOREIGN KEY (element_id) REFERENCES elements(id) ON DELETE CASCADE,
   FOREIGN KEY (doc_id) REFERENCES info_docs(id) ON DELETE CASCADE
 );
+
+-- Elements planned for a bulk reindex. Rows are marked done as their
+-- InfoSet entries are written, so an interrupted run can resume.
+CREATE TABLE IF NOT EXISTS reindex_tasks (
+  element_id TEXT PRIMARY KEY,
+  type INTEGER NOT NULL,
+  done BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+-- Version of each world definition. Bumped on every change to the world
+-- or its elements. Keeps element caches coherent across processes.
+-- The row with an empty world_id counts changes to all worlds.
+CREATE TABLE IF NOT EXISTS world_version (
+  world_id TEXT PRIMARY KEY,
+  version INTEGER NOT NULL DEFAULT 0,
+  updated INTEGER NOT NULL          -- timestamp last changed
+);
+
+-- Image generation requests run in the background.
+CREATE TABLE IF NOT EXISTS image_jobs (
+  id TEXT PRIMARY KEY,
+  world_id TEXT NOT NULL,
+  parent_id TEXT NOT NULL,          -- element the image is for
+  prompt TEXT NOT NULL,             -- prompt recorded on the image
+  request TEXT NOT NULL,            -- prompt sent to the generator
+  filename TEXT NOT NULL,
+  status TEXT NOT NULL,             -- pending, running, done, failed
+  image_id TEXT,                    -- set when done
+  error TEXT,
+  created INTEGER NOT NULL,
+  updated INTEGER NOT NULL
+);
+
+-- Content hashes of image files, for content addressed URLs.
+-- Files are not changed once written.
+CREATE TABLE IF NOT EXISTS image_files (
+  name TEXT PRIMARY KEY,            -- file name in the instance directory
+  sha256 TEXT NOT NULL,
+  size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS image_files_sha256 ON image_files(sha256);
@@ -6,8 +6,10 @@ Flask server  - main server module
 """
 
 
+import atexit
 import functools
 import logging
+import mimetypes
 import os
 import os.path
 import sys
@@ -17,13 +19,16 @@ import time
 import click
 import flask
 import openai
-from flask import Blueprint, Flask, current_app, g, request, session
+from flask import (Blueprint, Flask, current_app, g, has_request_context,
+                   request, session)
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.wrappers import Response as Response
 
-from . import (character_chat, chat, chat_cli, client, client_commands,
-               db_access, design_chat, design_functions, element_info,
-               elements, info_set, users, world_state)
+from . import (character_chat, chat, chat_cli, chat_functions, client,
+               client_commands, db_access, design_chat, design_functions,
+               element_info, elements, image_derivatives, image_files,
+               image_jobs, info_set, reindex, users, world_state,
+               write_behind)
 
 
 def create_app(instance_path=None, test_config=None):
@@ -38,6 +43,22 @@ def create_app(instance_path=None, test_config=None):
         OPENAI_API_KEY=os.getenv("OPENAI_API_KEY"),
         DATABASE=os.path.join(app.instance_path, "worldai.sqlite"),
         TESTING=False,
+        ELEMENT_CACHE_SIZE=1000,
+        STATUS_CACHE_SIZE=256,
+        AUTH_CACHE_TTL=60,
+        ACCESS_FLUSH_INTERVAL=60,
+        TOKEN_FLUSH_INTERVAL=10,
+        AUTH_TOKENS=False,
+        AUTH_TOKEN_TTL=12 * 60 * 60,
+        # Generate images in the background with this many threads.
+        # The design UI does not yet poll /api/worlds/<wid>/image_jobs/<id>
+        # for the new image, so images are generated during the request
+        # by default.
+        IMAGE_WORKERS=0,
+        IMAGE_SIZES=dict(image_derivatives.SIZES),
+        # Set to a location that nginx maps to the instance directory,
+        # e.g. "/protected-images/", to have nginx send image files.
+        IMAGE_ACCEL_REDIRECT=None,
     )
     if test_config is None:
         app.config.from_prefixed_env()
@@ -77,7 +98,58 @@ def create_app(instance_path=None, test_config=None):
     design_functions.IMAGE_DIRECTORY = app.instance_path
     chat.MESSAGE_DIRECTORY = app.instance_path
 
+    # Parsed world definitions are shared across requests.
+    if app.config["ELEMENT_CACHE_SIZE"] > 0:
+        elements.ELEMENT_CACHE = elements.ElementCache(app.config["ELEMENT_CACHE_SIZE"])
+    else:
+        elements.ELEMENT_CACHE = None
+
+    # World status sent to clients, the base for delta responses.
+    if app.config["STATUS_CACHE_SIZE"] > 0:
+        client.STATUS_CACHE = client.StatusCache(app.config["STATUS_CACHE_SIZE"])
+    else:
+        client.STATUS_CACHE = None
+
+    if app.config["AUTH_TOKENS"] and app.config["SECRET_KEY"] == "DEV":
+        logging.warning("AUTH_TOKENS enabled with the default SECRET_KEY")
+
+    # Images are generated in the background.
+    image_derivatives.SIZES = app.config["IMAGE_SIZES"]
+    if app.config["IMAGE_WORKERS"] > 0:
+        image_jobs.IMAGE_JOBS = image_jobs.ImageJobQueue(
+            app.instance_path, design_functions.image_get_request,
+            design_functions.complete_image,
+            app.config["IMAGE_WORKERS"])
+    else:
+        image_jobs.IMAGE_JOBS = None
+
+    # Auth keys are cached and access times written in batches.
+    if app.config["AUTH_CACHE_TTL"] > 0:
+        users.AUTH_CACHE = users.AuthCache(app.config["AUTH_CACHE_TTL"])
+        users.GENERATION_CACHE = users.AuthCache(app.config["AUTH_CACHE_TTL"])
+    else:
+        users.AUTH_CACHE = None
+        users.GENERATION_CACHE = None
+    if app.config["ACCESS_FLUSH_INTERVAL"] > 0:
+        users.ACCESS_LOG = users.AccessLog()
+        users.ACCESS_LOG.start(app.config["ACCESS_FLUSH_INTERVAL"])
+    else:
+        users.ACCESS_LOG = None
+
+    # Token use is totaled in memory and written in batches.
+    if app.config["TOKEN_FLUSH_INTERVAL"] > 0:
+        chat_functions.TOKEN_USAGE = chat_functions.TokenUsage()
+        chat_functions.TOKEN_USAGE.start(app.config["TOKEN_FLUSH_INTERVAL"])
+    else:
+        chat_functions.TOKEN_USAGE = None
+    # Write what is still held in memory on exit. Registered once.
+    atexit.unregister(flush_at_exit)
+    atexit.register(flush_at_exit)
+
     app.register_blueprint(bp)
+    # Run in reverse order
+    app.after_request(set_cache_headers)
+    app.after_request(flush_world_state)
     app.teardown_appcontext(close_db)
 
     bg_thread = threading.Thread(target=BgEmbedTask)
@@ -104,15 +176,51 @@ def BgEmbedTask():
     db.close()
 
 
+def flush_at_exit() -> None:
+    """
+    Write the access times and token usage held in memory.
+    """
+    write_behind.flushAll([users.ACCESS_LOG, chat_functions.TOKEN_USAGE])
+
+
 def get_db():
     if "db" not in g:
         g.db = db_access.open_db()
+        # Elements loaded more than once in a request are parsed once.
+        g.db.element_map = elements.IdentityMap()
+        if has_request_context():
+            # World states are loaded once and written once per request.
+            g.db.wstate_unit = world_state.WorldStateUnit()
     return g.db
 
 
+def flush_world_state(response):
+    """
+    Write world states changed during the request.
+    Changes are dropped if the request failed.
+    """
+    db = g.get("db")
+    unit = world_state.getWorldStateUnit(db) if db is not None else None
+    if unit is None:
+        return response
+    if response.status_code < 400:
+        for wstate in unit.flush(db):
+            if client.STATUS_CACHE is not None:
+                client.STATUS_CACHE.saved(wstate)
+    elif client.STATUS_CACHE is not None:
+        for wstate_id in unit.dirty.keys():
+            client.STATUS_CACHE.forget(wstate_id)
+    return response
+
+
 def close_db(e=None):
     db = g.pop("db", None)
     if db is not None:
+        element_map = elements.getIdentityMap(db)
+        if element_map is not None and element_map.misses > 0:
+            logging.info(
+                "element map: %d hits, %d misses", element_map.hits, element_map.misses
+            )
         db.close()
 
 
@@ -129,6 +237,19 @@ def add_user(username: str):
     click.echo("Added user %s. Auth key = %s" % (username, key))
 
 
+@bp.cli.command("reset-auth-key")
+@click.argument("user_id")
+def reset_auth_key(user_id: str):
+    """
+    Issue a new authkey for a user and print it
+    """
+    key = users.reset_auth_key(get_db(), user_id)
+    if key is None:
+        click.echo(f"Error, no such user id:{user_id}")
+    else:
+        click.echo("User %s. Auth key = %s" % (user_id, key))
+
+
 @bp.cli.command("chat")
 def run_chat_loop():
     """Text version of chat."""
@@ -143,6 +264,8 @@ def create_image_thumb(arg: str):
     image = elements.getImage(get_db(), eid)
     if image is not None:
         design_functions.create_image_thumbnail(image)
+        image_files.recordFiles(get_db(), design_functions.IMAGE_DIRECTORY,
+                                [image.getThumbName()])
         click.echo("Created thumbnail [%s] %s." % (image.getID(), image.getThumbName()))
     else:
         click.echo(f"Error, no such image id:{eid}")
@@ -155,6 +278,36 @@ def create_image_thumbs() -> None:
     for image in images:
         design_functions.create_image_thumbnail(image)
         click.echo("Created thumbnail [%s] %s." % (image.getID(), image.getThumbName()))
+    image_files.recordFiles(get_db(), design_functions.IMAGE_DIRECTORY,
+                            [image.getThumbName() for image in images])
+
+
+@bp.cli.command("hash-images")
+def hash_images() -> None:
+    """Record the content hashes of all image files."""
+    images = elements.getImages(get_db())
+    names = []
+    for image in images:
+        names.extend([image.getFilename(), image.getThumbName()])
+    count = image_files.recordFiles(get_db(), design_functions.IMAGE_DIRECTORY, names)
+    click.echo("Recorded %d image files." % count)
+
+
+@bp.cli.command("create-derivatives")
+@click.option("--workers", type=int, default=None, help="number of processes")
+def create_image_derivatives(workers: int | None) -> None:
+    """Create the resized versions of all images."""
+    images = elements.getImages(get_db())
+    count = image_derivatives.createAllDerivatives(
+        current_app.instance_path, [image.getFilename() for image in images], workers)
+    click.echo("Created %d derivatives for %d images." % (count, len(images)))
+
+
+@bp.cli.command("fail-image-jobs")
+def fail_image_jobs() -> None:
+    """Fail image jobs left unfinished when the server stopped."""
+    count = image_jobs.failInterrupted(get_db())
+    click.echo("Failed %d image jobs." % count)
 
 
 @bp.cli.command("delete-image")
@@ -199,6 +352,20 @@ def delete_world(id: str):
         click.echo(f"Error, no such world id:{wid}")
 
 
+@bp.cli.command("migrate-world-state")
+def migrate_world_state():
+    """Upgrade stored world states to the current format."""
+    count = world_state.migrateWorldStates(get_db())
+    click.echo("Migrated %d world states." % count)
+
+
+@bp.cli.command("migrate-token-usage")
+def migrate_token_usage():
+    """Merge token usage rows and create the totals row."""
+    chat_functions.migrate_token_usage(get_db())
+    click.echo("Migrated token usage.")
+
+
 @bp.cli.command("list-worlds")
 def list_worlds_cli():
     worlds = elements.listWorlds(get_db())
@@ -302,6 +469,37 @@ def update_all_embeddings() -> None:
             update_world_embeddings(world)
 
 
+@bp.cli.command("reindex")
+@click.option("--world", "world_name", default=None, help="limit a new run to one world")
+@click.option("--workers", type=int, default=None, help="number of chunking processes")
+@click.option("--embed-workers", type=int, default=4, help="concurrent embedding requests")
+@click.option("--restart", is_flag=True, help="discard an unfinished run")
+def reindex_info(world_name: str | None, workers: int | None, embed_workers: int,
+                 restart: bool) -> None:
+    """Rebuild element info and embeddings, resuming an unfinished run."""
+    pending = len(reindex.pendingTasks(get_db()))
+    if restart or pending == 0:
+        world_id = None
+        if world_name is not None:
+            world = elements.findWorld(get_db(), world_name)
+            if world is None:
+                click.echo("No such world %s" % world_name)
+                return
+            world_id = world.getID()
+        pending = reindex.planTasks(get_db(), world_id)
+        click.echo("Planned %d elements." % pending)
+    else:
+        click.echo("Resuming with %d elements." % pending)
+
+    def progress(stats: reindex.ReindexStats) -> None:
+        click.echo("%d/%d elements, %d chunks, %.1f chunks/s"
+                   % (stats.elements, stats.total, stats.chunks, stats.chunkRate()))
+
+    stats = reindex.reindex(get_db(), workers, embed_workers, progress=progress)
+    click.echo("Reindexed %d elements, %d chunks at %.1f chunks/s."
+               % (stats.elements, stats.chunks, stats.chunkRate()))
+
+
 def list_images(parent_id: elements.ElemID) -> None:
     print("Listing images...")
     image_list = elements.listImages(get_db(), parent_id)
@@ -417,9 +615,13 @@ def auth_required(view):
 
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        # Verify auth matches
+        # Verify auth matches. Either a signed token or an auth key.
         auth = extract_auth_key(request.headers)
-        user_id = users.find_by_auth_key(get_db(), auth)
+        if current_app.config["AUTH_TOKENS"] and auth is not None and "." in auth:
+            props = users.find_by_token(get_db(), current_app.config["SECRET_KEY"], auth)
+            user_id = props["uid"] if props is not None else None
+        else:
+            user_id = users.find_by_auth_key(get_db(), auth)
         if user_id is None:
             logging.info("auth failed: %s", auth)
             return {"error": "Invalid authorization header"}, 401
@@ -504,8 +706,7 @@ def play_page():
     with open(html_file) as f:
         html = f.read()
 
-    auth_key = users.get_auth_key(get_db(), g.user_id)
-    return flask.render_template_string(html, auth_key=auth_key)
+    return flask.render_template_string(html, auth_key=get_client_auth())
 
 
 @bp.route("/ui/design", methods=["GET"])
@@ -518,8 +719,18 @@ def design_page():
     with open(html_file) as f:
         html = f.read()
 
-    auth_key = users.get_auth_key(get_db(), g.user_id)
-    return flask.render_template_string(html, auth_key=auth_key)
+    return flask.render_template_string(html, auth_key=get_client_auth())
+
+
+def get_client_auth() -> str | None:
+    """
+    Return the bearer value the UI uses for the JSON API.
+    A signed token if enabled, otherwise the user's auth key.
+    """
+    if current_app.config["AUTH_TOKENS"]:
+        return users.make_token(get_db(), current_app.config["SECRET_KEY"],
+                                g.user_id, current_app.config["AUTH_TOKEN_TTL"])
+    return users.get_auth_key(get_db(), g.user_id)
 
 
 @bp.route("/ui/<path:path>", methods=["GET"])
@@ -672,10 +883,7 @@ def get_image(iid: elements.ElemID):
     if image is None:
         return "Image not found", 404
 
-    image_file = os.path.join(current_app.instance_path, image.filename)
-    if not os.path.isfile(image_file):
-        return "Image file not found", 404
-    return flask.send_file(image_file, mimetype="image/webp")
+    return send_image_file(image.filename)
 
 
 @bp.route("/images/<iid>/thumb", methods=["GET"])
@@ -688,10 +896,152 @@ def get_image_thumb(iid: elements.ElemID):
     if image is None:
         return "Image not found", 404
 
-    image_file = os.path.join(current_app.instance_path, image.getThumbName())
+    return send_image_file(image.getThumbName())
+
+
+@bp.route("/images/<iid>/<size>", methods=["GET"])
+@login_required
+def get_image_size(iid: elements.ElemID, size: str):
+    """
+    Return a resized image in the best format the client accepts.
+    The original is returned if the derivative has not been made.
+    """
+    if size not in image_derivatives.SIZES:
+        return "Unknown image size", 404
+    image = elements.getImage(get_db(), iid)
+    if image is None:
+        return "Image not found", 404
+
+    accept = [value for value, quality in request.accept_mimetypes]
+    entry = image_derivatives.findDerivative(
+        current_app.instance_path, image.filename, size, accept)
+    if entry is not None:
+        response = flask.send_file(entry[0], mimetype=entry[1])
+        response.vary.add("Accept")
+        return response
+
+    return send_image_file(image.filename)
+
+
+@bp.route("/image-content/<name>", methods=["GET"])
+@login_required
+def get_image_content(name: str):
+    """
+    Return an image file by the hash of its content.
+    The content never changes, clients may cache it forever.
+    """
+    filename = image_files.findFile(get_db(), name)
+    if filename is None:
+        return "Image not found", 404
+    response = send_image_file(filename, etag=os.path.splitext(name)[0])
+    # Images of a world are only for logged in users.
+    if response.status_code in (200, 206, 304):
+        response.cache_control.private = True
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    return response
+
+
+def send_image_file(filename: str, etag: str | bool = True):
+    """
+    Send a file from the instance directory, with ETag and Range
+    support. With IMAGE_ACCEL_REDIRECT, nginx sends the file.
+    """
+    image_file = os.path.join(current_app.instance_path, filename)
     if not os.path.isfile(image_file):
-        return "Image file not found", 404
-    return flask.send_file(image_file, mimetype="image/webp")
+        return Response("Image file not found", 404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    prefix = current_app.config["IMAGE_ACCEL_REDIRECT"]
+    if prefix is not None:
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = prefix + filename
+        return response
+    return flask.send_file(image_file, mimetype=mimetype, conditional=True, etag=etag)
+
+
+def image_url(image_id: elements.ElemID, filename: str, endpoint: str,
+              digest: str | None) -> str:
+    """
+    Return a content addressed URL for an image file if the hash is
+    recorded, otherwise the URL of the endpoint.
+    """
+    if digest is not None:
+        name = image_files.hashName(digest, filename)
+        return flask.url_for("worldai.get_image_content", name=name)
+    return flask.url_for(endpoint, iid=image_id)
+
+
+def check_modified(etag: str, last_modified: float) -> Response | None:
+    """
+    Conditional GET. Return a 304 response if the client has the
+    current version (If-None-Match or If-Modified-Since), otherwise None.
+    The ETag and Last-Modified headers are added by set_cache_headers.
+    If-Modified-Since is used only without If-None-Match.
+    """
+    g.etag = (etag, last_modified)
+    if "If-None-Match" in request.headers:
+        if request.if_none_match.contains(etag):
+            return Response(status=304)
+    elif (last_modified > 0 and request.if_modified_since is not None and
+          int(last_modified) <= request.if_modified_since.timestamp()):
+        return Response(status=304)
+    return None
+
+
+def check_world_modified(wid: elements.WorldID) -> Response | None:
+    """
+    Conditional GET on content from the world definition.
+    """
+    version, updated = elements.getWorldModified(get_db(), wid)
+    return check_modified(f"{wid}-{version}", updated)
+
+
+def instance_validators(wid: elements.WorldID) -> tuple[str, float] | None:
+    """
+    Return an ETag and modified time for the world definition and
+    the user's world state. None if the user has no world state yet.
+    Only reads.
+    """
+    found = world_state.findWorldState(get_db(), get_user_id(), wid)
+    if found is None:
+        return None
+    wstate_id, state_updated = found
+    version, updated = elements.getWorldModified(get_db(), wid)
+    return (f"{wid}-{version}-{wstate_id}-{state_updated}",
+            max(updated, state_updated))
+
+
+def check_instance_modified(wid: elements.WorldID) -> Response | None:
+    """
+    Conditional GET on content from the world definition and the
+    user's world state.
+    """
+    g.etag_instance = wid
+    validators = instance_validators(wid)
+    if validators is None:
+        return None
+    return check_modified(*validators)
+
+
+def set_cache_headers(response):
+    """
+    Add validators for responses set up by check_modified.
+    Clients must revalidate, responses are per user.
+    Runs after world states are flushed.
+    """
+    entry = g.get("etag")
+    if response.status_code == 200 and "etag_instance" in g:
+        # The world state may have been written by this request
+        entry = instance_validators(g.etag_instance)
+    if entry is not None and response.status_code in (200, 304):
+        etag, last_modified = entry
+        response.set_etag(etag)
+        # Whole seconds only: skip a second that can still change
+        if last_modified > 0 and int(last_modified) < int(time.time()):
+            response.last_modified = int(last_modified)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
 
 
 def get_user_id() -> str:
@@ -741,6 +1091,19 @@ def design_chat_api():
     return flask.jsonify(content)
 
 
+@bp.route("/api/worlds/<wid>/image_jobs/<jid>", methods=["GET"])
+@auth_required
+def image_job_api(wid, jid):
+    """
+    Poll the status of an image generation job
+    Returns an image_jobs.ImageJob
+    """
+    job = image_jobs.loadJob(get_db(), jid)
+    if job is None or job.world_id != wid:
+        return {"error": "Job not found"}, 404
+    return job.model_dump()
+
+
 @bp.route("/api/design_chat/view", methods=["GET"])
 @auth_required
 def design_chat_view_api():
@@ -771,15 +1134,21 @@ def worlds_list():
     """
     API to access worldlist
     """
+    version, updated = elements.getWorldsModified(get_db())
+    not_modified = check_modified(f"worlds-{version}", updated)
+    if not_modified is not None:
+        return not_modified
+
     world_list = []
-    worlds = elements.listWorlds(get_db())
-    for entry in worlds:
-        wid = entry.getID()
-        world = elements.loadWorld(get_db(), wid)
-        image_prop = getElementThumbProperty(world)
+    worlds = elements.loadWorlds(get_db())
+    thumb_ids = [world.getImageByIndex(0) for world in worlds]
+    hashes = elements.getImageHashes(
+        get_db(), [iid for iid in thumb_ids if iid is not None], thumb=True)
+    for world in worlds:
+        image_prop = getElementThumbProperty(world, hashes=hashes)
         world_list.append(
             {
-                "id": wid,
+                "id": world.getID(),
                 "name": world.getName(),
                 "description": world.getDescription(),
                 "image": image_prop,
@@ -795,6 +1164,9 @@ def worlds_api(wid):
     """
     API to access a world
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world == None:
         return {"error", "World not found"}, 404
@@ -823,28 +1195,45 @@ def worlds_api(wid):
     return result
 
 
-def getElementThumbProperty(element):
+def getElementThumbProperty(element, summaries=None, hashes=None):
     """
-    Return a property referencing an image for an element
+    Return a property referencing an image for an element.
+    List endpoints pass the image summaries of the world, or
+    the thumbnail hashes from getImageHashes.
     """
-    # May be None
-    image_id = element.getImageByIndex(0)
-    if image_id is None:
-        url = flask.url_for("static", filename="question-square-fill.svg")
-        image_prop = {"id": "0", "url": url}
+    image = None
+    digest = None
+    if summaries is not None:
+        summary = summaries.get(element.getID())
+        if summary is not None:
+            image = summary.image
+            digest = summary.thumb_hash
     else:
-        image_prop = {
-            "id": image_id,
-            "url": flask.url_for("worldai.get_image_thumb", iid=image_id),
-        }
-    return image_prop
+        # May be None
+        image_id = element.getImageByIndex(0)
+        if image_id is not None:
+            if hashes is None:
+                hashes = elements.getImageHashes(get_db(), [image_id], thumb=True)
+            if image_id in hashes:
+                image, digest = hashes[image_id]
+
+    if image is None:
+        url = flask.url_for("static", filename="question-square-fill.svg")
+        return {"id": "0", "url": url}
+    url = image_url(image.getID(), image.getThumbName(),
+                    "worldai.get_image_thumb", digest)
+    return {"id": image.getID(), "url": url}
 
 
 def getElementImageProps(element):
     images = []
-    for image in element.getImages():
-        url = flask.url_for("worldai.get_image", iid=image)
-        images.append({"id": image, "url": url})
+    found = elements.getImageHashes(get_db(), element.getImages())
+    for image_id in element.getImages():
+        url = flask.url_for("worldai.get_image", iid=image_id)
+        if image_id in found:
+            image, digest = found[image_id]
+            url = image_url(image_id, image.filename, "worldai.get_image", digest)
+        images.append({"id": image_id, "url": url})
 
     if len(images) == 0:
         url = flask.url_for("static", filename="question-square-fill.svg")
@@ -859,15 +1248,18 @@ def characters_list(wid):
     API to get the list of characters for a world
     """
     character_list = []
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
-    characters = elements.listCharacters(get_db(), wid)
+    characters = elements.loadCharacters(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in characters:
-        cid = entry.getID()
-        character = elements.loadCharacter(get_db(), cid)
-        image_prop = getElementThumbProperty(character)
+    for character in characters:
+        cid = character.getID()
+        image_prop = getElementThumbProperty(character, summaries)
 
         character_list.append(
             {
@@ -892,17 +1284,20 @@ def characters_inst_list(wid):
 
     character_list = []
     user_id = get_user_id()
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
     wstate_id = world_state.getWorldStateID(get_db(), user_id, wid)
     wstate = world_state.loadWorldState(get_db(), wstate_id)
-    characters = elements.listCharacters(get_db(), wid)
+    characters = elements.loadCharacters(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in characters:
-        cid = entry.getID()
-        character = elements.loadCharacter(get_db(), cid)
-        image_prop = getElementThumbProperty(character)
+    for character in characters:
+        cid = character.getID()
+        image_prop = getElementThumbProperty(character, summaries)
 
         character_list.append(
             {
@@ -923,6 +1318,9 @@ def characters_api(wid, cid):
     """
     API to access a character
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     character = elements.loadCharacter(get_db(), cid)
     if character == None or character.parent_id != wid:
         return {"error", "Character not found"}, 404
@@ -941,6 +1339,9 @@ def character_stats(wid, cid):
     API to get character status
     """
     user_id = get_user_id()
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -961,6 +1362,9 @@ def doc_list_api(wid: elements.WorldID):
     """
     Return a list of documents for the world
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     if elements.loadWorld(get_db(), wid) is None:
         return Response({"error", "World not found"}, 404)
     doc_list = []
@@ -972,6 +1376,9 @@ def doc_list_api(wid: elements.WorldID):
 @bp.route("/api/worlds/<wid>/documents/<did>")
 @auth_required
 def docs_api(wid: elements.WorldID, did: elements.ElemID):
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     if elements.loadWorld(get_db(), wid) is None:
         return Response({"error", "World not found"}, 404)
     doc = elements.loadDocument(get_db(), did)
@@ -991,18 +1398,21 @@ def site_list_api(wid):
     """
     Get a list of sites
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     # Save last opened in session
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
 
     site_list = []
-    sites = elements.listSites(get_db(), wid)
+    sites = elements.loadSites(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in sites:
-        sid = entry.getID()
-        site = elements.loadSite(get_db(), sid)
-        image_prop = getElementThumbProperty(site)
+    for site in sites:
+        sid = site.getID()
+        image_prop = getElementThumbProperty(site, summaries)
 
         site_list.append(
             {
@@ -1021,6 +1431,9 @@ def site_instances_list(wid):
     """
     Get a list of sites
     """
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -1032,12 +1445,12 @@ def site_instances_list(wid):
     user_id = get_user_id()
     wstate_id = world_state.getWorldStateID(get_db(), user_id, wid)
     wstate = world_state.loadWorldState(get_db(), wstate_id)
-    sites = elements.listSites(get_db(), wid)
+    sites = elements.loadSites(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in sites:
-        sid = entry.getID()
-        site = elements.loadSite(get_db(), sid)
-        image_prop = getElementThumbProperty(site)
+    for site in sites:
+        sid = site.getID()
+        image_prop = getElementThumbProperty(site, summaries)
         site_list.append(
             {
                 "id": sid,
@@ -1056,6 +1469,9 @@ def site_api(wid, sid):
     """
     API to load a site
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -1077,6 +1493,9 @@ def site_instance(wid, sid):
     API to load info and state for a site
     """
     user_id = get_user_id()
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -1139,16 +1558,19 @@ def items_list(wid):
     """
     API to get the items for a world
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     item_list = []
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
-    items = elements.listItems(get_db(), wid)
+    items = elements.loadItems(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in items:
-        iid = entry.getID()
-        item = elements.loadItem(get_db(), iid)
-        image_prop = getElementThumbProperty(item)
+    for item in items:
+        iid = item.getID()
+        image_prop = getElementThumbProperty(item, summaries)
 
         item_list.append(
             {
@@ -1171,6 +1593,9 @@ def items_intances_list(wid):
     """
     item_list = []
     user_id = get_user_id()
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -1179,12 +1604,12 @@ def items_intances_list(wid):
 
     wstate_id = world_state.getWorldStateID(get_db(), user_id, wid)
     wstate = world_state.loadWorldState(get_db(), wstate_id)
-    items = elements.listItems(get_db(), wid)
+    items = elements.loadItems(get_db(), wid)
+    summaries = elements.getImageSummaries(get_db(), wid)
 
-    for entry in items:
-        iid = entry.getID()
-        item = elements.loadItem(get_db(), iid)
-        image_prop = getElementThumbProperty(item)
+    for item in items:
+        iid = item.getID()
+        image_prop = getElementThumbProperty(item, summaries)
         
         item_list.append(
             {
@@ -1206,6 +1631,9 @@ def item_api(wid, iid):
     """
     API to access an item
     """
+    not_modified = check_world_modified(wid)
+    if not_modified is not None:
+        return not_modified
     item = elements.loadItem(get_db(), iid)
     if item == None or item.parent_id != wid:
         return {"error", "Item not found"}, 404
@@ -1232,6 +1660,9 @@ def item_instance(wid, iid):
     API to access an item instance
     """
     user_id = get_user_id()
+    not_modified = check_instance_modified(wid)
+    if not_modified is not None:
+        return not_modified
     item = elements.loadItem(get_db(), iid)
     if item == None or item.parent_id != wid:
         return {"error", "Item not found"}, 404
@@ -1264,6 +1695,10 @@ def state(wid):
     Load and return the world status
     """
     user_id = get_user_id()
+    if request.method == "GET":
+        not_modified = check_instance_modified(wid)
+        if not_modified is not None:
+            return not_modified
     world = elements.loadWorld(get_db(), wid)
     if world is None:
         return {"error", "World not found"}, 404
@@ -1273,6 +1708,9 @@ def state(wid):
         wstate = world_state.loadWorldState(get_db(), wstate_id)
         response = client.WorldStatus()
         client.update_world_status(get_db(), wstate, response)
+        delta = get_status_delta(wstate, response)
+        if delta is not None:
+            return delta.model_dump()
         return response.model_dump()
 
     logging.info("Reset game %s:%s:%s", user_id, world.getID(), wstate_id)
@@ -1286,6 +1724,19 @@ def state(wid):
 # User can alter the world state with a command, a character chat, or character action
 #
 
+def get_status_delta(wstate: world_state.WorldState,
+                     status: client.WorldStatus) -> client.WorldStatusDelta | None:
+    """
+    If the client sent the version it has (?since=<version>), return the
+    changes since then. None if not requested or the version is unknown,
+    in which case the full status is sent.
+    """
+    since = request.args.get("since", type=int)
+    if since is None:
+        return None
+    return client.get_status_delta(wstate, since, status)
+
+
 @bp.route("/api/worlds/<wid>/command", methods=["POST"])
 @auth_required
 def command_api(wid):
@@ -1314,8 +1765,49 @@ def command_api(wid):
         logging.info("COMMAND: save world state")
         world_state.saveWorldState(get_db(), wstate)
 
-    print(response.model_dump())
-    return response.model_dump()
+    response.world_status_delta = get_status_delta(wstate, response.world_status)
+    if response.world_status_delta is not None:
+        return response.model_dump(exclude={"world_status"})
+    return response.model_dump(exclude={"world_status_delta"})
+
+
+@bp.route("/api/worlds/<wid>/commands", methods=["POST"])
+@auth_required
+def commands_api(wid):
+    """
+    API to make a list of player changes in one call
+
+    Commands are applied in order against one world state. If any
+    command fails, none are saved.
+
+    Returns a client_command.BatchCommandResponse
+    """
+    user_id = get_user_id()
+    world = elements.loadWorld(get_db(), wid)
+    if world is None:
+        return {"error", "World not found"}, 404
+    wstate_id = world_state.getWorldStateID(get_db(), user_id, wid)
+    wstate = world_state.loadWorldState(get_db(), wstate_id)
+
+    batch = client_commands.BatchCommand(**request.json)
+    logging.info("batch of %d commands", len(batch.commands))
+    client_actions = client_commands.ClientActions(get_db(), world, wstate, "Travler")
+    response = client_actions.ExecCommands(batch)
+
+    if response.failed >= 0:
+        logging.info("COMMANDS: command %d failed, discard changes", response.failed)
+        world_state.forgetWorldState(get_db(), wstate_id)
+        if client.STATUS_CACHE is not None:
+            client.STATUS_CACHE.forget(wstate_id)
+    elif response.world_status.changed:
+        logging.info("COMMANDS: save world state")
+        world_state.saveWorldState(get_db(), wstate)
+
+    if response.failed < 0:
+        response.world_status_delta = get_status_delta(wstate, response.world_status)
+    if response.world_status_delta is not None:
+        return response.model_dump(exclude={"world_status"})
+    return response.model_dump(exclude={"world_status_delta"})
 
 
 @bp.route("/api/worlds/<wid>/characters/<cid>/thread", methods=["GET", "POST"])
@@ -1432,7 +1924,7 @@ def action_api(wid, cid):
             world_status = client_actions.DropItem(item_id, item)
 
         if world_status.changed:
-            # Save state since chat functions may load it again
+            # Written after the request. Chat functions share this instance
             world_state.saveWorldState(get_db(), wstate)
 
         reply = chat_session.chat_event_start(get_db(), world_status.last_event)
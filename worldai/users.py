@@ -6,9 +6,16 @@ Users are players of the game
     http://github.com/jmwanderer
 """
 
+import base64
+import hashlib
+import hmac
+import json
 import os
+import threading
 import time
 
+from . import write_behind
+
 # add user(name) --> AUTH KEY
 # lookup auth (auth key) --> ID
 
@@ -24,18 +31,197 @@ def add_user(db, username: str) -> str:
     db.commit()
     return auth_key
 
+class AuthCache:
+    """
+    Process wide cache of auth key -> user id.
+    Entries expire after ttl seconds. Changing a key revokes
+    the entry in this process, other processes wait for the ttl.
+    """
+
+    def __init__(self, ttl: float = 60) -> None:
+        self.ttl = ttl
+        self.entries: dict[str, tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, auth_key: str) -> str|None:
+        with self.lock:
+            entry = self.entries.get(auth_key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[auth_key]
+                return None
+            return entry[0]
+
+    def put(self, auth_key: str, user_id: str) -> None:
+        with self.lock:
+            self.entries[auth_key] = (user_id, time.time() + self.ttl)
+
+    def remove(self, auth_key: str) -> None:
+        with self.lock:
+            self.entries.pop(auth_key, None)
+
+    def revoke(self, user_id: str) -> None:
+        with self.lock:
+            for auth_key in [ key for key, entry in self.entries.items()
+                              if entry[0] == user_id ]:
+                del self.entries[auth_key]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+class AccessLog(write_behind.WriteBehind):
+    """
+    Write-behind of user access times.
+    Keeps the latest access per user until flushed.
+    """
+
+    def __init__(self) -> None:
+        write_behind.WriteBehind.__init__(
+            self, "access times",
+            "UPDATE users SET accessed = MAX(accessed, ?) WHERE id = ?",
+            lambda pending: [ (now, user_id) for user_id, now in pending.items() ],
+            max)
+
+    def record(self, user_id: str, now: float) -> None:
+        self.add(user_id, now)
+
+
+# Set to share auth lookups across requests.
+AUTH_CACHE: AuthCache|None = None
+# Set to share key generation lookups for tokens: user id -> generation
+GENERATION_CACHE: AuthCache|None = None
+# Set to defer access time updates. Flushed by the owner.
+ACCESS_LOG: AccessLog|None = None
+
+
 def find_by_auth_key(db, auth_key: str) -> str|None:
-    c = db.cursor()
-    q = c.execute("SELECT id, username FROM users WHERE auth_key = ?", (auth_key,))
-    r = q.fetchone()
-    if r is None:
-        return None
-    (user_id, username) = r
+    user_id = None
+    if AUTH_CACHE is not None and auth_key is not None:
+        user_id = AUTH_CACHE.get(auth_key)
+    if user_id is None:
+        c = db.cursor()
+        q = c.execute("SELECT id, username FROM users WHERE auth_key = ?", (auth_key,))
+        r = q.fetchone()
+        if r is None:
+            return None
+        (user_id, username) = r
+        if AUTH_CACHE is not None:
+            AUTH_CACHE.put(auth_key, user_id)
+
     now = time.time()
-    c.execute("UPDATE users SET accessed = ? WHERE id = ?", (now, user_id))
-    db.commit()
+    if ACCESS_LOG is not None:
+        ACCESS_LOG.record(user_id, now)
+    else:
+        db.execute("UPDATE users SET accessed = ? WHERE id = ?", (now, user_id))
+        db.commit()
     return user_id
 
+
+def reset_auth_key(db, user_id: str) -> str|None:
+    """
+    Assign a new auth key to a user. The old key stops working.
+    """
+    auth_key = os.urandom(12).hex()
+    c = db.cursor()
+    c.execute("UPDATE users SET auth_key = ? WHERE id = ?", (auth_key, user_id))
+    db.commit()
+    if c.rowcount == 0:
+        return None
+    if AUTH_CACHE is not None:
+        AUTH_CACHE.revoke(user_id)
+    if GENERATION_CACHE is not None:
+        GENERATION_CACHE.remove(user_id)
+    return auth_key
+
+
+#
+# Signed tokens for the JSON API. Carry the user id, admin flag,
+# expiry time and the generation of the user's auth key. Verified
+# without a DB lookup, except to refresh the cached key generation.
+# Resetting the auth key invalidates all tokens issued with it.
+#
+
+def key_generation(auth_key: str) -> str:
+    """
+    Identify an auth key without revealing it.
+    """
+    return hashlib.sha256(auth_key.encode()).hexdigest()[:16]
+
+
+def b64encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).decode().rstrip("=")
+
+
+def b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def sign(secret: str, payload: str) -> str:
+    digest = hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest()
+    return b64encode(digest)
+
+
+def make_token(db, secret: str, user_id: str, ttl: int) -> str|None:
+    """
+    Issue a signed token for a user, valid for ttl seconds.
+    """
+    auth_key = get_auth_key(db, user_id)
+    if auth_key is None:
+        return None
+    payload = b64encode(json.dumps({
+        "uid": user_id,
+        "exp": int(time.time()) + ttl,
+        "gen": key_generation(auth_key),
+    }).encode())
+    return payload + "." + sign(secret, payload)
+
+
+def read_token(secret: str, token: str) -> dict|None:
+    """
+    Return the contents of a token if the signature is valid and
+    it has not expired.
+    """
+    payload, _, signature = token.partition(".")
+    # Compare bytes: str arguments must be ASCII
+    if not hmac.compare_digest(signature.encode(), sign(secret, payload).encode()):
+        return None
+    try:
+        props = json.loads(b64decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(props, dict) or props.get("exp", 0) < time.time():
+        return None
+    return props
+
+
+def find_by_token(db, secret: str, token: str) -> dict|None:
+    """
+    Return the contents of a valid token issued for the user's
+    current auth key.
+    """
+    props = read_token(secret, token)
+    if props is None:
+        return None
+    user_id = props["uid"]
+    generation = None
+    if GENERATION_CACHE is not None:
+        generation = GENERATION_CACHE.get(user_id)
+    if generation is None:
+        auth_key = get_auth_key(db, user_id)
+        if auth_key is None:
+            return None
+        generation = key_generation(auth_key)
+        if GENERATION_CACHE is not None:
+            GENERATION_CACHE.put(user_id, generation)
+    if generation != props["gen"]:
+        return None
+    if ACCESS_LOG is not None:
+        ACCESS_LOG.record(user_id, time.time())
+    return props
+
 def get_auth_key(db, user_id: str) -> str|None:
     c = db.cursor()
     q = c.execute("SELECT auth_key FROM users WHERE id = ?",  (user_id,))
@@ -0,0 +1,327 @@
+"""
+Bulk simulation of many instances of a world.
+
+A WorldStateBatch holds the state of many instances of the same world
+definition as NumPy arrays, one row per instance. Used for offline
+balancing runs: random starts, item placement, status decay and
+end condition checks across thousands of instances at once.
+
+Character events, friendship and chat state are not simulated.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import numpy as np
+
+from . import elements, world_state
+from .elements import CharStatus
+
+# Character status values with a bit in the status mask
+STATUS_LIST: list[CharStatus] = [status for status in CharStatus if status != CharStatus.NONE]
+STATUS_INDEX: dict[CharStatus, int] = {status: index for index, status in enumerate(STATUS_LIST)}
+
+# Location index for no location
+NO_PLACE = -1
+
+
+class WorldStateBatch:
+    """
+    Struct of arrays for a batch of world states.
+
+    Locations are indexes into place_ids: the sites followed by the
+    characters. The player is character 0.
+    """
+
+    def __init__(self,
+                 char_ids: list[elements.ElemID],
+                 item_ids: list[elements.ElemID],
+                 site_ids: list[elements.ElemID],
+                 count: int) -> None:
+        if elements.PLAYER_ID in char_ids:
+            char_ids = [cid for cid in char_ids if cid != elements.PLAYER_ID]
+        self.char_ids = [elements.PLAYER_ID] + list(char_ids)
+        self.item_ids = list(item_ids)
+        self.site_ids = list(site_ids)
+        self.place_ids = self.site_ids + self.char_ids
+        self.char_index = {cid: index for index, cid in enumerate(self.char_ids)}
+        self.item_index = {iid: index for index, iid in enumerate(self.item_ids)}
+        self.place_index = {pid: index for index, pid in enumerate(self.place_ids)}
+        self.count = count
+
+        chars = len(self.char_ids)
+        defaults = world_state.CharState(char_id=elements.PLAYER_ID)
+        self.char_location = np.full((count, chars), NO_PLACE, dtype=np.int32)
+        self.item_location = np.full((count, len(self.item_ids)), NO_PLACE, dtype=np.int32)
+        self.site_open = np.ones((count, len(self.site_ids)), dtype=bool)
+        self.credits = np.full((count, chars), defaults.credits, dtype=np.int32)
+        self.health = np.full((count, chars), defaults.health, dtype=np.int32)
+        self.max_health = np.full((count, chars), defaults.max_health, dtype=np.int32)
+        self.strength = np.full((count, chars), defaults.strength, dtype=np.int32)
+        self.max_strength = np.full((count, chars), defaults.max_strength, dtype=np.int32)
+        # Bit per STATUS_LIST entry, with update time and count per status
+        self.status = np.zeros((count, chars), dtype=np.uint16)
+        self.status_time = np.zeros((count, chars, len(STATUS_LIST)), dtype=np.int32)
+        self.status_count = np.zeros((count, chars, len(STATUS_LIST)), dtype=np.int32)
+        self.current_time = np.zeros(count, dtype=np.int32)
+        self.game_won = np.zeros(count, dtype=bool)
+        # Models the batch was built from. Keeps state that is not simulated.
+        self.models: list[world_state.WorldStateModel] | None = None
+
+    def placeIndex(self, eid: elements.ElemID) -> int:
+        return self.place_index.get(eid, NO_PLACE)
+
+    def placeID(self, index: int) -> elements.ElemID:
+        if index == NO_PLACE:
+            return elements.ELEM_ID_NONE
+        return self.place_ids[index]
+
+    def hasStatus(self, status: CharStatus) -> np.ndarray:
+        """
+        Return a bool array (instances x characters) for a status.
+        """
+        return (self.status & (1 << STATUS_INDEX[status])) != 0
+
+    def addStatus(self, mask: np.ndarray, status: CharStatus) -> None:
+        """
+        Add a status to the characters selected by a bool mask
+        (instances x characters).
+        """
+        index = STATUS_INDEX[status]
+        record = world_state.CharStatusRecord(char_status=status)
+        self.status[mask] |= np.uint16(1 << index)
+        self.status_time[:, :, index][mask] = np.broadcast_to(
+            self.current_time[:, None], mask.shape)[mask]
+        self.status_count[:, :, index][mask] = record.count
+
+    def removeStatus(self, mask: np.ndarray, status: CharStatus) -> None:
+        self.status[mask] &= np.uint16(~(1 << STATUS_INDEX[status]) & 0xFFFF)
+
+    @staticmethod
+    def fromWorld(world: elements.World,
+                  characters: list[elements.Character],
+                  sites: list[elements.Site],
+                  items: list[elements.Item],
+                  count: int,
+                  rng: np.random.Generator | None = None) -> "WorldStateBatch":
+        """
+        Create a batch of new instances with random starts.
+        Follows the start conditions and assignment rules of checkWorldState.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        batch = WorldStateBatch([c.getID() for c in characters],
+                                [i.getID() for i in items],
+                                [s.getID() for s in sites], count)
+        start = elements.StartConditionIndex.forWorld(world)
+
+        for index, site in enumerate(sites):
+            batch.site_open[:, index] = site.getDefaultOpen()
+        open_sites = np.array([index for index, site in enumerate(sites)
+                               if site.getDefaultOpen()], dtype=np.int32)
+        if len(open_sites) == 0:
+            return batch
+
+        for character in characters:
+            cindex = batch.char_index[character.getID()]
+            site_id = start.getCharStartSite(character.getID())
+            if site_id != elements.ELEM_ID_NONE and site_id in batch.place_index:
+                batch.char_location[:, cindex] = batch.place_index[site_id]
+            else:
+                batch.char_location[:, cindex] = rng.choice(open_sites, size=count)
+            if start.isCharStatus(character.getID(), CharStatus.INJURED):
+                batch.health[:, cindex] -= 5
+            mask = np.zeros(batch.status.shape, dtype=bool)
+            mask[:, cindex] = True
+            for status in world_state.TIMED_STATUS:
+                if start.isCharStatus(character.getID(), status):
+                    batch.addStatus(mask, status)
+
+        # Places for mobile items: open sites and characters
+        places = np.concatenate([
+            np.array([batch.place_index[c.getID()] for c in characters], dtype=np.int32),
+            open_sites])
+        for item in items:
+            iindex = batch.item_index[item.getID()]
+            place_id = start.getItemStartPlace(item.getID())
+            if place_id != elements.ELEM_ID_NONE and place_id in batch.place_index:
+                batch.item_location[:, iindex] = batch.place_index[place_id]
+            elif item.getIsMobile():
+                batch.item_location[:, iindex] = rng.choice(places, size=count)
+            else:
+                batch.item_location[:, iindex] = rng.choice(open_sites, size=count)
+        return batch
+
+    @staticmethod
+    def fromModels(models: list[world_state.WorldStateModel],
+                   char_ids: list[elements.ElemID] | None = None,
+                   item_ids: list[elements.ElemID] | None = None,
+                   site_ids: list[elements.ElemID] | None = None) -> "WorldStateBatch":
+        """
+        Build a batch from world state models.
+        Ids default to those present in any of the models.
+        """
+        if char_ids is None:
+            char_ids = list(dict.fromkeys(cid for model in models
+                                          for cid in model.char_state.keys()))
+        if item_ids is None:
+            item_ids = list(dict.fromkeys(iid for model in models
+                                          for iid in model.item_state.keys()))
+        if site_ids is None:
+            site_ids = list(dict.fromkeys(sid for model in models
+                                          for sid in model.site_state.keys()))
+        batch = WorldStateBatch(char_ids, item_ids, site_ids, len(models))
+        batch.models = models
+
+        for row, model in enumerate(models):
+            batch.current_time[row] = model.current_time
+            batch.game_won[row] = model.game_won
+            for char_id, char_state in model.char_state.items():
+                cindex = batch.char_index.get(char_id)
+                if cindex is None:
+                    continue
+                batch.char_location[row, cindex] = batch.placeIndex(char_state.location)
+                batch.credits[row, cindex] = char_state.credits
+                batch.health[row, cindex] = char_state.health
+                batch.max_health[row, cindex] = char_state.max_health
+                batch.strength[row, cindex] = char_state.strength
+                batch.max_strength[row, cindex] = char_state.max_strength
+                for status, record in char_state.status_recs.items():
+                    sindex = STATUS_INDEX.get(status)
+                    if sindex is None:
+                        continue
+                    batch.status[row, cindex] |= np.uint16(1 << sindex)
+                    batch.status_time[row, cindex, sindex] = record.update_time
+                    batch.status_count[row, cindex, sindex] = record.count
+            for item_id, item_state in model.item_state.items():
+                iindex = batch.item_index.get(item_id)
+                if iindex is not None:
+                    batch.item_location[row, iindex] = batch.placeIndex(item_state.location)
+            for site_id, site_state in model.site_state.items():
+                if site_id in batch.place_index:
+                    batch.site_open[row, batch.place_index[site_id]] = site_state.is_open
+        return batch
+
+    def toModels(self) -> list[world_state.WorldStateModel]:
+        """
+        Return a world state model for each instance.
+        State that is not simulated is kept from the source models.
+        """
+        result = []
+        for row in range(self.count):
+            if self.models is not None:
+                model = self.models[row].model_copy(deep=True)
+            else:
+                model = world_state.WorldStateModel()
+            model.current_time = int(self.current_time[row])
+            model.game_won = bool(self.game_won[row])
+            for cindex, char_id in enumerate(self.char_ids):
+                location = int(self.char_location[row, cindex])
+                mask = int(self.status[row, cindex])
+                if (location == NO_PLACE and mask == 0 and
+                        char_id not in model.char_state):
+                    continue
+                char_state = world_state.CharState(
+                    char_id=char_id,
+                    location=self.placeID(location),
+                    credits=int(self.credits[row, cindex]),
+                    health=int(self.health[row, cindex]),
+                    max_health=int(self.max_health[row, cindex]),
+                    strength=int(self.strength[row, cindex]),
+                    max_strength=int(self.max_strength[row, cindex]),
+                    status_recs={})
+                for sindex, status in enumerate(STATUS_LIST):
+                    if mask & (1 << sindex):
+                        char_state.status_recs[status] = world_state.CharStatusRecord(
+                            char_status=status,
+                            update_time=int(self.status_time[row, cindex, sindex]),
+                            count=int(self.status_count[row, cindex, sindex]))
+                model.char_state[char_id] = char_state
+            for iindex, item_id in enumerate(self.item_ids):
+                location = int(self.item_location[row, iindex])
+                if location != NO_PLACE or item_id in model.item_state:
+                    model.item_state[item_id] = world_state.ItemState(
+                        location=self.placeID(location))
+            for sindex, site_id in enumerate(self.site_ids):
+                model.site_state[site_id] = world_state.SiteState(
+                    is_open=bool(self.site_open[row, sindex]))
+
+            # Reschedule status updates from the records
+            wstate = world_state.WorldState(world_state.WORLD_STATE_ID_NONE)
+            wstate.set_model(model)
+            result.append(wstate.get_model())
+        return result
+
+    def advanceTime(self, minutes: int | np.ndarray) -> None:
+        """
+        Advance the clock of every instance and apply the due status
+        updates, including the periods missed in a large jump.
+        """
+        self.current_time += np.asarray(minutes, dtype=np.int32)
+        now = self.current_time[:, None]
+        for status in world_state.TIMED_STATUS:
+            sindex = STATUS_INDEX[status]
+            active = self.hasStatus(status)
+            update_time = self.status_time[:, :, sindex]
+            count = self.status_count[:, :, sindex]
+            due = active & (update_time + world_state.STATUS_PERIOD <= now)
+            if not due.any():
+                continue
+            periods = np.minimum((now - update_time) // world_state.STATUS_PERIOD, count)
+            periods = np.where(due, periods, 0)
+            count -= periods
+            update_time[due] = np.broadcast_to(now, due.shape)[due]
+            if status == CharStatus.POISONED:
+                self.health -= periods
+            self.removeStatus(due & (count <= 0), status)
+
+    def evalEndConditions(self, world: elements.World) -> np.ndarray:
+        """
+        Evaluate end conditions for every instance.
+        Return a bool array, TRUE where all are true.
+        """
+        conditions = world.endConditions()
+        # If no end conditions, then does not eval to true.
+        if len(conditions) == 0:
+            return np.zeros(self.count, dtype=bool)
+
+        result = np.ones(self.count, dtype=bool)
+        for condition in conditions:
+            result &= self.evalEndCondition(condition)
+        return result
+
+    def evalEndCondition(self, condition: elements.ConditionProp) -> np.ndarray:
+        none = np.zeros(self.count, dtype=bool)
+        cindex = self.char_index.get(condition.char_id)
+        iindex = self.item_index.get(condition.item_id)
+
+        if condition.verb == elements.ConditionVerb.AT:
+            site = self.placeIndex(condition.site_id)
+            if condition.char_id != elements.ELEM_ID_NONE:
+                if cindex is None:
+                    return none
+                return self.char_location[:, cindex] == site
+            if condition.item_id != elements.ELEM_ID_NONE:
+                if iindex is None:
+                    return none
+                return self.item_location[:, iindex] == site
+
+        if condition.verb == elements.ConditionVerb.HAS:
+            if iindex is None:
+                return none
+            return self.item_location[:, iindex] == self.placeIndex(condition.char_id)
+
+        if condition.verb == elements.ConditionVerb.IS:
+            if cindex is None or condition.char_status not in STATUS_INDEX:
+                return none
+            return self.hasStatus(condition.char_status)[:, cindex]
+
+        # TODO: capture item usage events
+        return none
+
+    def checkEndConditions(self, world: elements.World) -> np.ndarray:
+        """
+        Update and return the won status. A win is sticky.
+        """
+        self.game_won |= self.evalEndConditions(world)
+        return self.game_won
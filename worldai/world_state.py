@@ -15,6 +15,7 @@ A player interacting with a specific world
 #
 
 import enum
+import heapq
 import json
 import logging
 import os
@@ -76,58 +77,446 @@ class WorldStateModel(pydantic.BaseModel):
     site_state: typing.Dict[elements.ElemID, SiteState] = {}
     character_events: typing.Dict[elements.ElemID, list[str]] = {}
     current_time: int = 0
+    # Version of the world definition last reconciled by checkWorldState
+    world_version: int = -1
+    # Heap of timed status updates: (due time, char_id, status)
+    status_schedule: list[tuple[int, elements.ElemID, CharStatus]] = []
+    # Format of the stored state, missing from the oldest
+    schema_version: int = 0
+    # Incremented for each saved change, identifies a client view
+    state_version: int = 0
+
+
+# Current format of the stored state
+SCHEMA_VERSION = 2
+
+
+def migrateV0(props: dict) -> None:
+    """
+    Sites record is_open rather than locked.
+    """
+    for site in props["site_state"].values():
+        if site.get("locked") is not None:
+            site["is_open"] = not site.pop("locked")
+
+
+def migrateV1(props: dict) -> None:
+    """
+    Add the state version.
+    """
+    props.setdefault("state_version", 0)
+
+
+# Upgrades of the stored state, by the version they upgrade from.
+# Each brings a state to the next version. To change the format, add
+# an entry here and increment SCHEMA_VERSION.
+MIGRATIONS: dict[int, typing.Callable[[dict], None]] = {
+    0: migrateV0,
+    1: migrateV1,
+}
+
+
+def migrateState(props: dict) -> bool:
+    """
+    Bring the JSON form of a stored state up to SCHEMA_VERSION.
+    Return True if any migration was applied.
+    """
+    version = props.get("schema_version", 0)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"unknown world state schema version {version}")
+    migrated = False
+    while version < SCHEMA_VERSION:
+        logging.info("world_state: migrate from schema version %d", version)
+        MIGRATIONS[version](props)
+        version += 1
+        props["schema_version"] = version
+        migrated = True
+    return migrated
+
+#
+# Runtime forms of the models above, used while handling a request.
+# Slotted classes with no validation. States stored in the current
+# format are loaded directly into these. Pydantic validates only at the
+# boundary: states in an older format, and get_model / set_model.
+#
+
+class CharStatusRec:
+    __slots__ = ("char_status", "update_time", "count")
+
+    def __init__(self, char_status: CharStatus, update_time: int = 0, count: int = 3) -> None:
+        self.char_status = char_status
+        self.update_time = update_time
+        self.count = count
+
+    @staticmethod
+    def fromDict(props: dict) -> "CharStatusRec":
+        return CharStatusRec(CharStatus(props["char_status"]), props["update_time"],
+                             props["count"])
+
+    def toDict(self) -> dict:
+        return {"char_status": self.char_status.value,
+                "update_time": self.update_time, "count": self.count}
+
+
+class CharRec:
+    __slots__ = ("char_id", "location", "credits", "health", "max_health",
+                 "strength", "max_strength", "status_recs")
+
+    def __init__(self, char_id: elements.ElemID) -> None:
+        self.char_id = char_id
+        self.location = elements.ELEM_ID_NONE
+        self.credits = 1000
+        self.health = 10
+        self.max_health = 10
+        self.strength = 8
+        self.max_strength = 8
+        self.status_recs: dict[CharStatus, CharStatusRec] = {}
+
+    @staticmethod
+    def fromDict(props: dict) -> "CharRec":
+        char = CharRec(props["char_id"])
+        char.location = props["location"]
+        char.credits = props["credits"]
+        char.health = props["health"]
+        char.max_health = props["max_health"]
+        char.strength = props["strength"]
+        char.max_strength = props["max_strength"]
+        for entry in props["status_recs"].values():
+            status_rec = CharStatusRec.fromDict(entry)
+            char.status_recs[status_rec.char_status] = status_rec
+        return char
+
+    def toDict(self) -> dict:
+        return {"char_id": self.char_id, "location": self.location,
+                "credits": self.credits, "health": self.health,
+                "max_health": self.max_health, "strength": self.strength,
+                "max_strength": self.max_strength,
+                "status_recs": {status.value: rec.toDict()
+                                for status, rec in self.status_recs.items()}}
+
+
+class PlayerRec:
+    __slots__ = ("friendship", "chat_who_id", "selected_item_id")
+
+    def __init__(self) -> None:
+        self.friendship: dict[elements.ElemID, int] = {}
+        self.chat_who_id = elements.ELEM_ID_NONE
+        self.selected_item_id = elements.ELEM_ID_NONE
+
+    @staticmethod
+    def fromDict(props: dict) -> "PlayerRec":
+        player = PlayerRec()
+        player.friendship = props["friendship"]
+        player.chat_who_id = props["chat_who_id"]
+        player.selected_item_id = props["selected_item_id"]
+        return player
+
+    def toDict(self) -> dict:
+        return {"friendship": self.friendship, "chat_who_id": self.chat_who_id,
+                "selected_item_id": self.selected_item_id}
+
+
+class ItemRec:
+    __slots__ = ("location",)
+
+    def __init__(self, location: elements.ElemID = elements.ELEM_ID_NONE) -> None:
+        self.location = location
+
+    def toDict(self) -> dict:
+        return {"location": self.location}
+
+
+class SiteRec:
+    __slots__ = ("is_open",)
+
+    def __init__(self, is_open: bool = True) -> None:
+        self.is_open = is_open
+
+    def toDict(self) -> dict:
+        return {"is_open": self.is_open}
+
+
+class StateRec:
+    """
+    Runtime form of WorldStateModel
+    """
+    __slots__ = ("game_won", "char_state", "player_state", "item_state",
+                 "site_state", "character_events", "current_time",
+                 "world_version", "status_schedule", "schema_version",
+                 "state_version")
+
+    def __init__(self) -> None:
+        self.game_won = False
+        self.char_state: dict[elements.ElemID, CharRec] = {}
+        self.player_state = PlayerRec()
+        self.item_state: dict[elements.ElemID, ItemRec] = {}
+        self.site_state: dict[elements.ElemID, SiteRec] = {}
+        self.character_events: dict[elements.ElemID, list[str]] = {}
+        self.current_time = 0
+        self.world_version = -1
+        self.status_schedule: list[tuple[int, elements.ElemID, CharStatus]] = []
+        self.schema_version = SCHEMA_VERSION
+        self.state_version = 0
+
+    @staticmethod
+    def fromDict(props: dict) -> "StateRec":
+        """
+        Build from a dict in the current format. Not validated.
+        """
+        state = StateRec()
+        state.game_won = props["game_won"]
+        state.char_state = {cid: CharRec.fromDict(entry)
+                            for cid, entry in props["char_state"].items()}
+        state.player_state = PlayerRec.fromDict(props["player_state"])
+        state.item_state = {iid: ItemRec(entry["location"])
+                            for iid, entry in props["item_state"].items()}
+        state.site_state = {sid: SiteRec(entry["is_open"])
+                            for sid, entry in props["site_state"].items()}
+        state.character_events = props["character_events"]
+        state.current_time = props["current_time"]
+        state.world_version = props["world_version"]
+        state.status_schedule = [(due, cid, CharStatus(status))
+                                 for due, cid, status in props.get("status_schedule", [])]
+        state.schema_version = props["schema_version"]
+        state.state_version = props["state_version"]
+        return state
+
+    def toDict(self) -> dict:
+        return {"game_won": self.game_won,
+                "char_state": {cid: char.toDict() for cid, char in self.char_state.items()},
+                "player_state": self.player_state.toDict(),
+                "item_state": {iid: item.toDict() for iid, item in self.item_state.items()},
+                "site_state": {sid: site.toDict() for sid, site in self.site_state.items()},
+                "character_events": self.character_events,
+                "current_time": self.current_time,
+                "world_version": self.world_version,
+                "status_schedule": [[due, cid, status.value]
+                                    for due, cid, status in self.status_schedule],
+                "schema_version": self.schema_version,
+                "state_version": self.state_version}
+
 
 # Types for IDs
 WorldStateID = typing.NewType("WorldStateID", str)
 WORLD_STATE_ID_NONE = WorldStateID("")
 
+# Minutes between periodic updates of a character status
+STATUS_PERIOD = 60
+# Status records with periodic updates that expire
+TIMED_STATUS = [CharStatus.PARALIZED, CharStatus.POISONED, CharStatus.SLEEPING]
+
+
+class StateSection(str, enum.Enum):
+    """
+    Parts of the world state model tracked for changes.
+    """
+    CHAR = "char"        # char_state entry
+    ITEM = "item"        # item_state entry
+    SITE = "site"        # site_state entry
+    EVENTS = "events"    # character_events entry
+    PLAYER = "player"    # player_state
+    WORLD = "world"      # top level field
+
+
+# Changes logged before the full state is written again.
+CHANGE_LOG_LIMIT = 50
+
+
 class WorldState:
     def __init__(self, wstate_id: WorldStateID) -> None:
         self.wstate_id: WorldStateID = wstate_id
         self.user_id = None
         self.world_id: elements.WorldID = elements.WORLD_ID_NONE
-        self.model: WorldStateModel = WorldStateModel()
-
-    def set_model_str(self, value: str) -> None:
+        self.model: StateRec = StateRec()
+        # Entries changed since last save. Ordered set of (section, key)
+        self.changes: dict[tuple[StateSection, str], None] = {}
+        # Write the complete model on the next save
+        self.full_save = True
+        # Number of changes in the DB log not yet compacted
+        self.logged_changes = 0
+        # The state version was returned, the next change starts a new one
+        self.version_seen = False
+        # Latest version read from or written to the DB
+        self.saved_version = 0
+        # Reverse indexes: location -> ids (ordered sets).
+        # Characters are also locations for the items they hold.
+        # Insertion order differs between live changes and a load,
+        # so the getters sort the ids.
+        self.items_at: dict[elements.ElemID, dict[elements.ElemID, None]] = {}
+        self.chars_at: dict[elements.ElemID, dict[elements.ElemID, None]] = {}
+        # Tracks end conditions satisfied, set by checkEndConditions
+        self.end_tracker: EndConditionTracker | None = None
+
+    def set_model_str(self, value: str,
+                      changes: typing.Sequence[tuple[str, str, str]] = ()) -> None:
+        """
+        Load the model from a JSON string and apply logged
+        changes: (section, key, value) in order.
+        """
         props = json.loads(value)
-        # Fix up from old formats
-        for site in props["site_state"]:
-            if props["site_state"][site].get("locked") is not None:
-                locked = props["site_state"][site]["locked"]
-                del props["site_state"][site]["locked"]
-                props["site_state"][site]["is_open"] = not locked
-        self.model = WorldStateModel(**props)
+        for section, key, entry in changes:
+            applyChange(props, StateSection(section), key, json.loads(entry))
+
+        if props.get("schema_version") == SCHEMA_VERSION:
+            # Current format, load directly
+            self.model = StateRec.fromDict(props)
+            self.full_save = False
+        else:
+            # Older format, upgrade and validate. Saved in full.
+            migrateState(props)
+            model = WorldStateModel(**props)
+            self.model = StateRec.fromDict(model.model_dump(mode="json"))
+            self.full_save = True
+
+        self.changes = {}
+        self.logged_changes = len(changes)
+        self.build_indexes()
+        if "status_schedule" not in props:
+            self.build_schedule()
+
+    def set_model(self, model: WorldStateModel) -> None:
+        """
+        Set the state from a validated model.
+        """
+        self.model = StateRec.fromDict(model.model_dump(mode="json"))
+        self.model.schema_version = SCHEMA_VERSION
+        self.full_save = True
+        self.build_indexes()
+        self.build_schedule()
+        # Keep the version of the model
+        self.model.state_version = model.state_version
+        self.changes = {}
+
+    def get_model(self) -> WorldStateModel:
+        """
+        Return the state as a validated model.
+        """
+        return WorldStateModel(**self.model.toDict())
+
+    def build_indexes(self) -> None:
+        self.items_at = {}
+        for item_id, item_state in self.model.item_state.items():
+            self.items_at.setdefault(item_state.location, {})[item_id] = None
+        self.chars_at = {}
+        for char_id, char_state in self.model.char_state.items():
+            self.chars_at.setdefault(char_state.location, {})[char_id] = None
+
+    def build_schedule(self) -> None:
+        """
+        Schedule the updates for all timed status records
+        """
+        self.model.status_schedule = []
+        for char_id, char_state in self.model.char_state.items():
+            for char_status_rec in char_state.status_recs.values():
+                if char_status_rec.char_status in TIMED_STATUS:
+                    self.model.status_schedule.append(
+                        (char_status_rec.update_time + STATUS_PERIOD, char_id,
+                         char_status_rec.char_status))
+        heapq.heapify(self.model.status_schedule)
+        self.mark(StateSection.WORLD, "status_schedule")
 
     def get_model_str(self) -> str:
-        return self.model.model_dump_json()
+        return json.dumps(self.model.toDict())
+
+    def mark(self, section: StateSection, key: str = "") -> None:
+        """
+        Record a changed entry for the next save.
+        """
+        if len(self.changes) == 0 or self.version_seen:
+            # First change since the version was saved or seen
+            self.model.state_version += 1
+            self.changes[(StateSection.WORLD, "state_version")] = None
+            self.version_seen = False
+        self.changes[(section, key)] = None
+
+    def getStateVersion(self) -> int:
+        """
+        Version identifying the current state.
+        A later change will have a new version.
+        """
+        self.version_seen = True
+        return self.model.state_version
+
+    def notify(self, eid: elements.ElemID) -> None:
+        """
+        Re-evaluate the end conditions that reference a changed entity.
+        """
+        if self.end_tracker is not None:
+            self.end_tracker.update(self, eid)
 
-    def get_char(self, char_id: elements.ElemID) -> CharState:
+    def get_change(self, section: StateSection, key: str) -> str:
+        """
+        Return the JSON encoded value of a changed entry.
+        """
+        if section == StateSection.CHAR:
+            return json.dumps(self.model.char_state[elements.ElemID(key)].toDict())
+        if section == StateSection.ITEM:
+            return json.dumps(self.model.item_state[elements.ElemID(key)].toDict())
+        if section == StateSection.SITE:
+            return json.dumps(self.model.site_state[elements.ElemID(key)].toDict())
+        if section == StateSection.EVENTS:
+            return json.dumps(self.model.character_events[elements.ElemID(key)])
+        if section == StateSection.PLAYER:
+            return json.dumps(self.model.player_state.toDict())
+        return json.dumps(getattr(self.model, key))
+
+    def get_char(self, char_id: elements.ElemID) -> CharRec:
         """
         Helper function to get (perhaps allocate) a Character State entry
         """
         if not char_id in self.model.char_state.keys():
-            self.model.char_state[char_id] = CharState(char_id=char_id)
+            self.model.char_state[char_id] = CharRec(char_id)
+            self.chars_at.setdefault(elements.ELEM_ID_NONE, {})[char_id] = None
+            self.mark(StateSection.CHAR, char_id)
         return self.model.char_state[char_id]
 
-    def get_item(self, item_id: elements.ElemID) -> ItemState:
+    def find_char(self, char_id: elements.ElemID) -> CharRec | None:
+        """
+        Return the Character State entry if present. Does not allocate.
+        """
+        return self.model.char_state.get(char_id)
+
+    def find_item(self, item_id: elements.ElemID) -> ItemRec | None:
+        """
+        Return the Item State entry if present. Does not allocate.
+        """
+        return self.model.item_state.get(item_id)
+
+    def get_item(self, item_id: elements.ElemID) -> ItemRec:
         """
         Helper function to get and perhaps create an Item State entry
         """
         if not item_id in self.model.item_state.keys():
-            self.model.item_state[item_id] = ItemState()
+            self.model.item_state[item_id] = ItemRec()
+            self.items_at.setdefault(elements.ELEM_ID_NONE, {})[item_id] = None
+            self.mark(StateSection.ITEM, item_id)
         return self.model.item_state[item_id]
 
-    def get_site(self, site_id: elements.ElemID) -> SiteState:
+    def move_item(self, item_id: elements.ElemID, location: elements.ElemID) -> None:
+        """
+        Helper function to set an item location and maintain the index
+        """
+        item_state = self.get_item(item_id)
+        if item_state.location != location:
+            removeIndexEntry(self.items_at, item_state.location, item_id)
+            item_state.location = location
+            self.items_at.setdefault(location, {})[item_id] = None
+        self.mark(StateSection.ITEM, item_id)
+        self.notify(item_id)
+
+    def get_site(self, site_id: elements.ElemID) -> SiteRec:
         """
         Helper function to get and perhaps create a Site State entry
         """
         if not site_id in self.model.site_state.keys():
-            self.model.site_state[site_id] = SiteState()
+            self.model.site_state[site_id] = SiteRec()
+            self.mark(StateSection.SITE, site_id)
         return self.model.site_state[site_id]
 
     def get_events(self, char_id: elements.ElemID) -> list[str]:
         if not char_id in self.model.character_events.keys():
             self.model.character_events[char_id] = []
+            self.mark(StateSection.EVENTS, char_id)
         return self.model.character_events[char_id]
 
     def isSiteInitialized(self, site_id: elements.ElemID) -> bool:
@@ -139,10 +528,12 @@ class WorldState:
 
     def advanceTime(self, minutes: int) -> None:
         self.model.current_time = self.model.current_time + minutes
+        self.mark(StateSection.WORLD, "current_time")
         self.processCharStatusUpdates()
 
     def addCharacterEvent(self, char_id: elements.ElemID, event: str) -> None:
         self.get_events(char_id).append(event)
+        self.mark(StateSection.EVENTS, char_id)
 
     def removeCharacterEvent(self, char_id: elements.ElemID) -> str|None:
         """
@@ -153,6 +544,7 @@ class WorldState:
         if len(events) == 0:
             return None
         # Remove and return 1st item in the list
+        self.mark(StateSection.EVENTS, char_id)
         return events.pop(0)
 
     def getCharacterEvents(self, char_id: elements.ElemID) -> list[str]:
@@ -162,20 +554,24 @@ class WorldState:
         events = self.get_events(char_id)
         if len(events) != 0:
             self.model.character_events[char_id] = []
+            self.mark(StateSection.EVENTS, char_id)
         return events
 
     def getCharacterLocation(self, char_id: elements.ElemID) -> elements.ElemID:
         return self.get_char(char_id).location
 
     def setCharacterLocation(self, char_id: elements.ElemID, site_id: elements.ElemID) -> None:
-        self.get_char(char_id).location = site_id
+        char_state = self.get_char(char_id)
+        if char_state.location != site_id:
+            removeIndexEntry(self.chars_at, char_state.location, char_id)
+            char_state.location = site_id
+            self.chars_at.setdefault(site_id, {})[char_id] = None
+        self.mark(StateSection.CHAR, char_id)
+        self.notify(char_id)
 
     def getCharactersAtLocation(self, site_id: elements.ElemID) -> list[elements.ElemID]:
-        result = []
-        for char_id in self.model.char_state.keys():
-            if char_id != elements.PLAYER_ID and self.getCharacterLocation(char_id) == site_id:
-                result.append(char_id)
-        return result
+        return [char_id for char_id in sorted(self.chars_at.get(site_id, {}))
+                if char_id != elements.PLAYER_ID]
 
     def setLocation(self, site_id: elements.ElemID = elements.ELEM_ID_NONE) -> None:
         """
@@ -201,9 +597,11 @@ class WorldState:
 
     def setCharacterStrength(self, char_id: elements.ElemID, value:int ) -> None:
         self.get_char(char_id).strength = value
+        self.mark(StateSection.CHAR, char_id)
 
     def setCharacterToMaxStrength(self, char_id: elements.ElemID) -> None:
         self.get_char(char_id).strength = self.get_char(char_id).max_strength
+        self.mark(StateSection.CHAR, char_id)
 
     def getCharacterHealth(self, char_id: elements.ElemID) -> int:
         return self.get_char(char_id).health
@@ -217,9 +615,11 @@ class WorldState:
 
     def setCharacterHealth(self, char_id: elements.ElemID, value: int) -> None:
         self.get_char(char_id).health = value
+        self.mark(StateSection.CHAR, char_id)
 
     def setCharacterToMaxHealth(self, char_id: elements.ElemID) -> None:
         self.get_char(char_id).health = self.get_char(char_id).max_health
+        self.mark(StateSection.CHAR, char_id)
 
     def getCharacterMaxHealth(self, char_id: elements.ElemID) -> int:
         return self.get_char(char_id).max_health
@@ -229,6 +629,7 @@ class WorldState:
 
     def setCharacterCredits(self, char_id: elements.ElemID, value: int) -> None:
         self.get_char(char_id).credits = value
+        self.mark(StateSection.CHAR, char_id)
 
     def addCharacterStatus(self, char_id: elements.ElemID, status: CharStatus) -> None:
         """
@@ -237,9 +638,14 @@ class WorldState:
         Adds a status to the list of CharStatus
         state: CharStatus
         """
-        char_status = CharStatusRecord(char_status=status)
-        char_status.update_time = self.getCurrentTime()
+        char_status = CharStatusRec(status, self.getCurrentTime())
         self.get_char(char_id).status_recs.update({ status: char_status})
+        self.mark(StateSection.CHAR, char_id)
+        self.notify(char_id)
+        if status in TIMED_STATUS:
+            heapq.heappush(self.model.status_schedule,
+                           (char_status.update_time + STATUS_PERIOD, char_id, status))
+            self.mark(StateSection.WORLD, "status_schedule")
 
     def removeCharacterStatus(self, char_id: elements.ElemID, status: CharStatus) -> None:
         """
@@ -248,8 +654,10 @@ class WorldState:
         """
         if self.get_char(char_id).status_recs.get(status) != None:
             del self.get_char(char_id).status_recs[status]
+            self.mark(StateSection.CHAR, char_id)
+            self.notify(char_id)
 
-    def getCharacterStatusRecord(self, char_id: elements.ElemID, status: CharStatus) -> CharStatusRecord|None:
+    def getCharacterStatusRecord(self, char_id: elements.ElemID, status: CharStatus) -> CharStatusRec|None:
         return self.get_char(char_id).status_recs.get(status)
 
     def hasCharacterStatus(self, char_id: elements.ElemID, status: CharStatus) -> bool:
@@ -269,43 +677,63 @@ class WorldState:
         return self.hasCharacterStatus(elements.PLAYER_ID, status)
 
     def processCharStatusUpdates(self) -> None:
-        for char_state in self.model.char_state.values():
-            # Build list of items to remove done after the iteration is complete.
-            remove_list = []
-            for char_status_rec in char_state.status_recs.values():
-                # Process every hour
-                if char_status_rec.update_time + 60 <= self.getCurrentTime():
-                    self.updateCharStatus(char_state.char_id, char_status_rec)
-                if char_status_rec.count <= 0:
-                    remove_list.append(char_status_rec.char_status)
-            for char_status in remove_list:
-                logging.info("Status %s expired for character: %s", char_status, char_state.char_id)
-                self.removeCharacterStatus(char_state.char_id, char_status)
-                if char_status == CharStatus.PARALIZED:
-                    self.addCharacterEvent(char_state.char_id, "{name} is no longer paralized")
-                elif char_status == CharStatus.POISONED:
-                    self.addCharacterEvent(char_state.char_id, "{name} is no longer poisoned")
-                elif char_status == CharStatus.SLEEPING:
-                    # TODO: condsider removing the time limit on sleep
-                    self.addCharacterEvent(char_state.char_id, "{name} is now awake")
+        """
+        Run the status updates that are due.
+        Entries for status records since removed or replaced are skipped.
+        """
+        schedule = self.model.status_schedule
+        now = self.getCurrentTime()
+        if len(schedule) == 0 or schedule[0][0] > now:
+            return
+
+        while len(schedule) > 0 and schedule[0][0] <= now:
+            (due, char_id, status) = heapq.heappop(schedule)
+            char_state = self.model.char_state.get(char_id)
+            if char_state is None:
+                continue
+            char_status_rec = char_state.status_recs.get(status)
+            if (char_status_rec is None or
+                char_status_rec.update_time + STATUS_PERIOD != due):
+                continue
+
+            # Catch up on all periods passed in a large time jump
+            periods = (now - char_status_rec.update_time) // STATUS_PERIOD
+            self.updateCharStatus(char_id, char_status_rec,
+                                  min(periods, char_status_rec.count))
+            if char_status_rec.count > 0:
+                heapq.heappush(schedule,
+                               (char_status_rec.update_time + STATUS_PERIOD, char_id, status))
+                continue
+
+            logging.info("Status %s expired for character: %s", status, char_id)
+            self.removeCharacterStatus(char_id, status)
+            if status == CharStatus.PARALIZED:
+                self.addCharacterEvent(char_id, "{name} is no longer paralized")
+            elif status == CharStatus.POISONED:
+                self.addCharacterEvent(char_id, "{name} is no longer poisoned")
+            elif status == CharStatus.SLEEPING:
+                # TODO: condsider removing the time limit on sleep
+                self.addCharacterEvent(char_id, "{name} is now awake")
+        self.mark(StateSection.WORLD, "status_schedule")
 
     def updateCharStatus(self, char_id: elements.ElemID, 
-                         char_status_rec: CharStatusRecord) -> None:
+                         char_status_rec: CharStatusRec, periods: int = 1) -> None:
         """"
         Implement the periodic updates for Character Status records
         """
         char_status_rec.update_time = self.getCurrentTime()
+        self.mark(StateSection.CHAR, char_id)
         if char_status_rec.char_status == CharStatus.PARALIZED:
-            char_status_rec.count -= 1
+            char_status_rec.count -= periods
 
         elif char_status_rec.char_status == CharStatus.POISONED:
-            char_status_rec.count -= 1
+            char_status_rec.count -= periods
             logging.info("Reduce health for poisoned character: %s", char_id)
-            self.setCharacterHealth(char_id, self.getCharacterHealth(char_id) - 1)
+            self.setCharacterHealth(char_id, self.getCharacterHealth(char_id) - periods)
 
         elif char_status_rec.char_status == CharStatus.SLEEPING:
             # TODO: condier removing the time limit on sleep
-            char_status_rec.count -= 1
+            char_status_rec.count -= periods
 
         
     def healCharacter(self, char_id: elements.ElemID) -> None:
@@ -372,14 +800,10 @@ class WorldState:
         self.setCharacterCredits(elements.PLAYER_ID, value)
 
     def getCharacterItems(self, char_id: elements.ElemID) -> list[elements.ElemID]:
-        result = []
-        for item_id in self.model.item_state.keys():
-            if self.model.item_state[item_id].location == char_id:
-                result.append(item_id)
-        return result
+        return sorted(self.items_at.get(char_id, {}))
 
     def addCharacterItem(self, char_id: elements.ElemID, item_id: elements.ElemID) -> None:
-        self.get_item(item_id).location = char_id
+        self.move_item(item_id, char_id)
 
     def hasCharacterItem(self, char_id: elements.ElemID, item_id: elements.ElemID) -> bool:
         # True if a character has an item
@@ -388,18 +812,20 @@ class WorldState:
     def selectItem(self, item_id: elements.ElemID) -> None:
         # mark item as selected by the player. May be empty string
         self.model.player_state.selected_item_id = item_id
+        self.mark(StateSection.PLAYER)
 
     def getSelectedItem(self) -> elements.ElemID:
         return self.model.player_state.selected_item_id
 
     def addItem(self, item_id: elements.ElemID) -> None:
         # Give an item to the player
-        self.get_item(item_id).location = elements.PLAYER_ID
+        self.move_item(item_id, elements.PLAYER_ID)
 
     def dropItem(self, item_id: elements.ElemID) -> None:
-        self.get_item(item_id).location = self.getLocation()
+        self.move_item(item_id, self.getLocation())
         if self.getSelectedItem() == item_id:
             self.model.player_state.selected_item_id = elements.ELEM_ID_NONE
+            self.mark(StateSection.PLAYER)
 
     def hasItem(self, item_id: elements.ElemID) -> bool:
         # True if player has this item
@@ -409,15 +835,11 @@ class WorldState:
         """
         Return a list of item ids possesed by the player
         """
-        result = []
-        for item_id in self.model.item_state.keys():
-            if self.model.item_state[item_id].location == elements.PLAYER_ID:
-                result.append(item_id)
-        return result
+        return self.getCharacterItems(elements.PLAYER_ID)
 
     def setItemLocation(self, item_id: elements.ElemID, site_id: elements.ElemID) -> None:
         # Set the location of an item
-        self.get_item(item_id).location = site_id
+        self.move_item(item_id, site_id)
 
     def getItemLocation(self, item_id: elements.ElemID) -> elements.ElemID:
         # Return the location of an item
@@ -425,19 +847,17 @@ class WorldState:
 
     def getItemsAtLocation(self, site_id: elements.ElemID) -> list[elements.ElemID]:
         # Return list of item_ids at a specific site
-        result = []
-        for item_id in self.model.item_state.keys():
-            if self.model.item_state[item_id].location == site_id:
-                result.append(item_id)
-        return result
+        return sorted(self.items_at.get(site_id, {}))
 
     def increaseFriendship(self, char_id: elements.ElemID, amount: int =5) -> None:
         level = self.getFriendship(char_id) + amount
         self.model.player_state.friendship[char_id] = level
+        self.mark(StateSection.PLAYER)
 
     def decreaseFriendship(self, char_id: elements.ElemID, amount: int =5) -> None:
         level = self.getFriendship(char_id) - amount
         self.model.player_state.friendship[char_id] = level
+        self.mark(StateSection.PLAYER)
 
     def getFriendship(self, char_id: elements.ElemID) -> int:
         if self.model.player_state.friendship.get(char_id) is None:
@@ -446,6 +866,7 @@ class WorldState:
 
     def setChatCharacter(self, char_id: elements.ElemID=elements.ELEM_ID_NONE) -> None:
         self.model.player_state.chat_who_id = char_id
+        self.mark(StateSection.PLAYER)
 
     def getChatCharacter(self) -> elements.ElemID:
         """
@@ -464,6 +885,7 @@ class WorldState:
         Record if site is open
         """
         self.get_site(site_id).is_open = value
+        self.mark(StateSection.SITE, site_id)
 
     def gameWonStatus(self) -> bool:
         return self.model.game_won
@@ -471,11 +893,47 @@ class WorldState:
     def checkEndConditions(self, world: elements.World) -> bool:
         if self.model.game_won:
             return True
-        self.model.game_won = evalEndConditions(self, world)
+        # Conditions are evaluated once, then as the entities change
+        condition_set = EndConditionSet.forWorld(world)
+        if self.end_tracker is None or self.end_tracker.condition_set is not condition_set:
+            self.end_tracker = EndConditionTracker(condition_set, self)
+        if self.end_tracker.allSatisfied():
+            self.model.game_won = True
+            self.mark(StateSection.WORLD, "game_won")
         logging.info("game won status: %s",  self.model.game_won)
         return self.model.game_won
 
 
+def removeIndexEntry(index: dict[elements.ElemID, dict[elements.ElemID, None]],
+                     location: elements.ElemID, eid: elements.ElemID) -> None:
+    """
+    Remove an id from a location index, dropping empty locations.
+    """
+    entries = index.get(location)
+    if entries is not None:
+        entries.pop(eid, None)
+        if len(entries) == 0:
+            del index[location]
+
+
+def applyChange(props: dict, section: StateSection, key: str, value) -> None:
+    """
+    Apply a logged change to the JSON form of a model.
+    """
+    if section == StateSection.CHAR:
+        props["char_state"][key] = value
+    elif section == StateSection.ITEM:
+        props["item_state"][key] = value
+    elif section == StateSection.SITE:
+        props["site_state"][key] = value
+    elif section == StateSection.EVENTS:
+        props["character_events"][key] = value
+    elif section == StateSection.PLAYER:
+        props["player_state"] = value
+    else:
+        props[key] = value
+
+
 def getWorldStateID(db, user_id: str, world_id: elements.WorldID) -> WorldStateID:
     """
     Get an ID for a World State record - create if needed.
@@ -505,20 +963,57 @@ def getWorldStateID(db, user_id: str, world_id: elements.WorldID) -> WorldStateI
     return wstate_id
 
 
+def migrateWorldStates(db) -> int:
+    """
+    Upgrade all stored states in an older format.
+    Return the number upgraded.
+    """
+    c = db.cursor()
+    c.execute(
+        "SELECT id FROM world_state "
+        + "WHERE COALESCE(json_extract(state, '$.schema_version'), 0) < ?",
+        (SCHEMA_VERSION,),
+    )
+    wstate_ids = [WorldStateID(r[0]) for r in c.fetchall()]
+    for wstate_id in wstate_ids:
+        loadWorldState(db, wstate_id)
+    return len(wstate_ids)
+
+
+def findWorldState(db, user_id: str,
+                   world_id: elements.WorldID) -> tuple[WorldStateID, float] | None:
+    """
+    Return the id of a world state and the time it was last written,
+    None if there is none yet. Does not create the record.
+    """
+    q = db.execute(
+        "SELECT id, updated FROM world_state WHERE user_id = ? and world_id = ?",
+        (user_id, world_id),
+    )
+    r = q.fetchone()
+    if r is None:
+        return None
+    return (WorldStateID(r[0]), r[1])
+
+
 def checkWorldState(db, wstate: WorldState) -> bool:
     """
     Ensure all characters and items are assigned.
     Initializes everything on first load. Will also
     set locations for newly added items and characters.
 
-    TODO: make this more efficient and lightweight
+    Records the world definition version once everything is
+    assigned, so the check is skipped until the definition changes.
     """
 
     changed = False
 
+    # Read before the definition so a concurrent change forces a recheck.
+    version = elements.getWorldVersion(db, wstate.world_id)
     world = elements.loadWorld(db, wstate.world_id)
     if world is None:
         return False
+    start = elements.StartConditionIndex.forWorld(world)
 
     characters = elements.listCharacters(db, wstate.world_id)
     sites = elements.listSites(db, wstate.world_id)
@@ -540,19 +1035,19 @@ def checkWorldState(db, wstate: WorldState) -> bool:
         for character in characters:
             if wstate.getCharacterLocation(character.getID()) == "":
                 # Character is not yet initialized
-                site_id = elements.Condition.getCharStartSite(world.startConditions(), character.getID())
+                site_id = start.getCharStartSite(character.getID())
                 if site_id == elements.ELEM_ID_NONE:
                     site_entry = random.choice(avail_sites)
                     site_id = site_entry.getID()
                 wstate.setCharacterLocation(character.getID(), site_id)
-                if elements.Condition.isCharStatus(world.startConditions(), character.getID(), CharStatus.INJURED):
+                if start.isCharStatus(character.getID(), CharStatus.INJURED):
                     wstate.setCharacterHealth(character.getID(), 
                                               wstate.getCharacterHealth(character.getID()) - 5)
-                if elements.Condition.isCharStatus(world.startConditions(), character.getID(), CharStatus.SLEEPING):
+                if start.isCharStatus(character.getID(), CharStatus.SLEEPING):
                     wstate.addCharacterStatus(character.getID(), CharStatus.SLEEPING)
-                if elements.Condition.isCharStatus(world.startConditions(), character.getID(), CharStatus.POISONED):
+                if start.isCharStatus(character.getID(), CharStatus.POISONED):
                     wstate.addCharacterStatus(character.getID(), CharStatus.POISONED)
-                if elements.Condition.isCharStatus(world.startConditions(), character.getID(), CharStatus.PARALIZED):
+                if start.isCharStatus(character.getID(), CharStatus.PARALIZED):
                     wstate.addCharacterStatus(character.getID(), CharStatus.PARALIZED)
                     
                 changed = True
@@ -571,8 +1066,8 @@ def checkWorldState(db, wstate: WorldState) -> bool:
                     changed = True
                     item = elements.loadItem(db, item_entry.getID())
                     if item is not None:
-                        place_id = elements.Condition.getItemStartPlace(world.startConditions(), item.getID())
-                        if place_id is elements.ELEM_ID_NONE:
+                        place_id = start.getItemStartPlace(item.getID())
+                        if place_id == elements.ELEM_ID_NONE:
                             # Place non-mobile items at sites
                             if item.getIsMobile():
                                 place_id = random.choice(places).getID()
@@ -581,8 +1076,73 @@ def checkWorldState(db, wstate: WorldState) -> bool:
                         wstate.setItemLocation(item.getID(), place_id)
                         logging.info("place item %s: %s", item.getName(), place_id)
 
+    # Without an open site, characters and items are left to a later check.
+    complete = len(avail_sites) > 0 or (len(characters) == 0 and len(items) == 0)
+    if complete and wstate.model.world_version != version:
+        wstate.model.world_version = version
+        wstate.mark(StateSection.WORLD, "world_version")
+        changed = True
+
     return changed
 
+class EndConditionSet:
+    """
+    End conditions of a world definition, indexed by the ids of the
+    characters and items whose state they depend on.
+    """
+
+    def __init__(self, conditions: list[elements.ConditionProp]) -> None:
+        self.conditions = list(conditions)
+        self.by_entity: dict[elements.ElemID, list[int]] = {}
+        for index, condition in enumerate(self.conditions):
+            if condition.verb == elements.ConditionVerb.AT:
+                # Character or item location, indexed under both if both set
+                eids = [eid for eid in (condition.char_id, condition.item_id)
+                        if eid != elements.ELEM_ID_NONE]
+            elif condition.verb == elements.ConditionVerb.HAS:
+                eids = [condition.item_id]
+            else:
+                eids = [condition.char_id]
+            for eid in eids:
+                self.by_entity.setdefault(eid, []).append(index)
+
+    @staticmethod
+    def forWorld(world: elements.World) -> "EndConditionSet":
+        """
+        Return the compiled end conditions for the world.
+        """
+        return END_CONDITIONS.forWorld(world)
+
+
+# Compiled end conditions by world id and version
+END_CONDITIONS = elements.WorldVersionCache(
+    lambda world: EndConditionSet(world.endConditions()))
+
+
+class EndConditionTracker:
+    """
+    Satisfied state of each end condition for a world state.
+    Kept current by notifications of changed entities.
+    """
+
+    def __init__(self, condition_set: EndConditionSet, wstate: "WorldState") -> None:
+        self.condition_set = condition_set
+        self.satisfied = [evalEndCondition(wstate, condition)
+                          for condition in condition_set.conditions]
+        self.count = sum(self.satisfied)
+
+    def update(self, wstate: "WorldState", eid: elements.ElemID) -> None:
+        for index in self.condition_set.by_entity.get(eid, []):
+            value = evalEndCondition(wstate, self.condition_set.conditions[index])
+            if value != self.satisfied[index]:
+                self.satisfied[index] = value
+                self.count += 1 if value else -1
+
+    def allSatisfied(self) -> bool:
+        # If no end conditions, then does not eval to true.
+        return len(self.satisfied) > 0 and self.count == len(self.satisfied)
+
+
 def evalEndConditions(wstate: WorldState, world: elements.World) -> bool:
     """
     Evaluate end conditions against the current world state.
@@ -599,35 +1159,95 @@ def evalEndConditions(wstate: WorldState, world: elements.World) -> bool:
 
 def evalEndCondition(wstate: WorldState, condition: elements.ConditionProp) -> bool:
     """
-    Evaluate and end condition agains the current world state
+    Evaluate and end condition agains the current world state.
+    Read only: missing state entries are not allocated.
     """
-    logging.info("eval end condition: %s", condition.verb)
     if condition.verb == elements.ConditionVerb.AT:
         if condition.char_id != elements.ELEM_ID_NONE:
-            return wstate.getCharacterLocation(condition.char_id) == condition.site_id
+            char_state = wstate.find_char(condition.char_id)
+            location = char_state.location if char_state else elements.ELEM_ID_NONE
+            return location == condition.site_id
         if condition.item_id != elements.ELEM_ID_NONE:
-            return wstate.getItemLocation(condition.item_id) == condition.site_id
+            return itemLocation(wstate, condition.item_id) == condition.site_id
     
     if condition.verb == elements.ConditionVerb.HAS:
-        result =  wstate.getItemLocation(condition.item_id) == condition.char_id
-        return wstate.getItemLocation(condition.item_id) == condition.char_id
+        return itemLocation(wstate, condition.item_id) == condition.char_id
 
     if condition.verb == elements.ConditionVerb.IS:
-        return wstate.hasCharacterStatus(condition.char_id, condition.char_status)
+        char_state = wstate.find_char(condition.char_id)
+        return char_state is not None and condition.char_status in char_state.status_recs
 
     if condition.verb == elements.ConditionVerb.USES:
         # TODO: capture item usage events
         pass
     return False
 
+def itemLocation(wstate: WorldState, item_id: elements.ElemID) -> elements.ElemID:
+    item_state = wstate.find_item(item_id)
+    return item_state.location if item_state else elements.ELEM_ID_NONE
+
+class WorldStateUnit:
+    """
+    Unit of work for the world states used by a request.
+
+    Attached to a DB connection (as 'wstate_unit'). Each world state
+    is loaded once and the instance is shared by all callers.
+    saveWorldState only marks a state dirty, flush writes each
+    dirty state once.
+    """
+
+    def __init__(self) -> None:
+        self.states: dict[WorldStateID, WorldState] = {}
+        self.dirty: dict[WorldStateID, bool] = {}
+
+    def get(self, wstate_id: WorldStateID) -> WorldState | None:
+        return self.states.get(wstate_id)
+
+    def put(self, wstate: WorldState) -> None:
+        self.states[wstate.wstate_id] = wstate
+
+    def markDirty(self, wstate: WorldState) -> None:
+        self.states[wstate.wstate_id] = wstate
+        self.dirty[wstate.wstate_id] = True
+
+    def remove(self, wstate_id: WorldStateID) -> None:
+        self.states.pop(wstate_id, None)
+        self.dirty.pop(wstate_id, None)
+
+    def flush(self, db) -> list[WorldState]:
+        """
+        Write the dirty states. Return the states written.
+        """
+        written = [self.states[wstate_id] for wstate_id in self.dirty.keys()]
+        for wstate in written:
+            writeWorldState(db, wstate)
+        self.dirty.clear()
+        return written
+
+
+def getWorldStateUnit(db) -> WorldStateUnit | None:
+    """
+    Return the unit of work attached to the DB connection, if any.
+    """
+    return getattr(db, "wstate_unit", None)
+
+
 def loadWorldState(db, wstate_id: WorldStateID) -> WorldState:
     """
     Get or create a world state.
     """
+    unit = getWorldStateUnit(db)
+    if unit is not None:
+        cached = unit.get(wstate_id)
+        if cached is not None:
+            return cached
+
     wstate = WorldState(WORLD_STATE_ID_NONE)
     c = db.cursor()
     c.execute(
-        "SELECT user_id, world_id, state FROM world_state WHERE id = ?", (wstate_id,)
+        "SELECT w.user_id, w.world_id, w.state, v.version FROM world_state w "
+        + "LEFT JOIN world_version v ON v.world_id = w.world_id WHERE w.id = ?",
+        (wstate_id,),
     )
 
     r = c.fetchone()
@@ -635,37 +1255,108 @@ def loadWorldState(db, wstate_id: WorldStateID) -> WorldState:
         wstate = WorldState(wstate_id)
         wstate.user_id = r[0]
         wstate.world_id = r[1]
-        wstate.set_model_str(r[2])
-
-        if checkWorldState(db, wstate):
+        c.execute(
+            "SELECT section, key, value FROM world_state_changes "
+            + "WHERE wstate_id = ? ORDER BY seq",
+            (wstate_id,),
+        )
+        wstate.set_model_str(r[2], c.fetchall())
+        wstate.saved_version = wstate.model.state_version
+        if unit is not None:
+            unit.put(wstate)
+
+        # Reconcile only when the world definition has changed.
+        version = r[3] if r[3] is not None else 0
+        if wstate.model.world_version != version and checkWorldState(db, wstate):
             logging.info("check world state changed!")
             saveWorldState(db, wstate)
+        elif wstate.full_save:
+            # Persist the upgrade from an older format
+            saveWorldState(db, wstate)
 
     return wstate
 
 
+def forgetWorldState(db, wstate_id: WorldStateID) -> None:
+    """
+    Discard unsaved changes to a world state.
+    The next load reads the state from the DB.
+    """
+    unit = getWorldStateUnit(db)
+    if unit is not None:
+        unit.remove(wstate_id)
+
+
 def saveWorldState(db, state: WorldState) -> None:
     """
     Update world state.
+    Deferred until the unit of work is flushed, if there is one.
+    """
+    unit = getWorldStateUnit(db)
+    if unit is not None:
+        unit.markDirty(state)
+        return
+    writeWorldState(db, state)
+
+
+def writeWorldState(db, state: WorldState) -> None:
+    """
+    Write the world state to the DB.
+
+    Changed entries are appended to the change log. The complete
+    model is written when the log grows past CHANGE_LOG_LIMIT.
     """
+    if not state.full_save and len(state.changes) == 0:
+        return
     logging.info("world_state: save world state")
     logging.info("location: %s", state.getLocation())
     now = time.time()
     c = db.cursor()
     c.execute("BEGIN EXCLUSIVE")
-    # Support changing the user_id (Still figuring that out)
-    c.execute(
-        "UPDATE world_state SET user_id = ?, "
-        + "updated = ?, state = ? WHERE id = ?",
-        (state.user_id, now, state.get_model_str(), state.wstate_id),
-    )
+    if state.full_save or state.logged_changes + len(state.changes) > CHANGE_LOG_LIMIT:
+        # Support changing the user_id (Still figuring that out)
+        c.execute(
+            "UPDATE world_state SET user_id = ?, "
+            + "updated = ?, state = ? WHERE id = ?",
+            (state.user_id, now, state.get_model_str(), state.wstate_id),
+        )
+        c.execute("DELETE FROM world_state_changes WHERE wstate_id = ?",
+                  (state.wstate_id,))
+        state.logged_changes = 0
+    else:
+        c.execute(
+            "SELECT COALESCE(MAX(seq), 0) FROM world_state_changes WHERE wstate_id = ?",
+            (state.wstate_id,),
+        )
+        seq = c.fetchone()[0]
+        entries = []
+        for section, key in state.changes.keys():
+            seq += 1
+            entries.append((state.wstate_id, seq, section.value, key,
+                            state.get_change(section, key)))
+        c.executemany(
+            "INSERT INTO world_state_changes (wstate_id, seq, section, key, value) "
+            + "VALUES (?, ?, ?, ?, ?)",
+            entries,
+        )
+        c.execute(
+            "UPDATE world_state SET user_id = ?, updated = ? WHERE id = ?",
+            (state.user_id, now, state.wstate_id),
+        )
+        state.logged_changes += len(entries)
     db.commit()
+    state.changes = {}
+    state.full_save = False
+    state.saved_version = state.model.state_version
 
 def clearWorldState(db, wstate_id: WorldStateID) -> None:
     """
     Reset an instance of world state.
     Erase all related data.
     """
+    unit = getWorldStateUnit(db)
+    if unit is not None:
+        unit.remove(wstate_id)
     db.execute("BEGIN TRANSACTION")
     sql = "DELETE FROM info_chunks WHERE doc_id IN (SELECT id FROM info_docs WHERE wstate_id = ?)"
     db.execute(sql, (wstate_id,))
@@ -678,5 +1369,6 @@ def clearWorldState(db, wstate_id: WorldStateID) -> None:
         thread_id = entry[0]
         db.execute("DELETE FROM character_threads WHERE thread_id = ?", (thread_id,))
         db.execute("DELETE FROM threads where id = ?", (thread_id,))
+    db.execute("DELETE FROM world_state_changes where wstate_id = ?", (wstate_id,))
     db.execute("DELETE FROM world_state where id = ?", (wstate_id,))
     db.commit()
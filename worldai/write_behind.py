@@ -0,0 +1,103 @@
+"""
+Write-behind buffers.
+
+Values are combined in memory by key and written in one transaction
+when flushed: by a background thread every interval, and at exit.
+A failed write keeps the values for the next flush.
+
+    Jim Wanderer
+    http://github.com/jmwanderer
+"""
+
+import logging
+import threading
+import time
+import typing
+
+from . import db_access
+
+# Rows for the flush SQL from the pending values by key
+RowBuilder = typing.Callable[[dict[str, typing.Any]], list[tuple]]
+
+# Combine a pending value with a newer one
+Merge = typing.Callable[[typing.Any, typing.Any], typing.Any]
+
+
+class WriteBehind:
+    """
+    Buffer of pending values by key, written with one SQL statement
+    executed for each row.
+    """
+
+    def __init__(self, name: str, sql: str, rows: RowBuilder, merge: Merge) -> None:
+        self.name = name
+        self.sql = sql
+        self.rows = rows
+        self.merge = merge
+        self.pending: dict[str, typing.Any] = {}
+        self.lock = threading.Lock()
+
+    def add(self, key: str, value: typing.Any) -> None:
+        with self.lock:
+            if key in self.pending:
+                value = self.merge(self.pending[key], value)
+            self.pending[key] = value
+
+    def flush(self, db) -> int:
+        """
+        Write the pending values. Return the number of keys.
+        On failure the values are kept for the next flush.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if len(pending) == 0:
+            return 0
+        try:
+            db.executemany(self.sql, self.rows(pending))
+            db.commit()
+        except Exception:
+            db.rollback()
+            for key, value in pending.items():
+                self.add(key, value)
+            raise
+        return len(pending)
+
+    def tryFlush(self, db) -> None:
+        """
+        Flush and log any error.
+        """
+        try:
+            self.flush(db)
+        except Exception:
+            logging.exception("Failed to write %s", self.name)
+
+    def start(self, interval: float) -> None:
+        """
+        Flush every interval seconds in a daemon thread.
+        """
+        thread = threading.Thread(target=self.run, args=(interval,))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, interval: float) -> None:
+        db = db_access.open_db()
+        while True:
+            time.sleep(interval)
+            self.tryFlush(db)
+
+
+def flushAll(buffers: list[WriteBehind | None]) -> None:
+    """
+    Write the values held by the buffers, e.g. at exit.
+    Opens the DB only if something is pending.
+    """
+    pending = [
+        entry for entry in buffers if entry is not None and len(entry.pending) > 0
+    ]
+    if len(pending) == 0:
+        return
+    db = db_access.open_db()
+    for entry in pending:
+        entry.tryFlush(db)
+    db.close()